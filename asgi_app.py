@@ -0,0 +1,56 @@
+# asgi_app.py
+# ASGI-приложение: uvicorn asgi_app:app или gunicorn -k uvicorn_worker.UvicornWorker asgi_app:app.
+# Один процесс ведет много запусков в одном цикле событий: пока запуск ждет Gmail, GCS или Gemini, воркер обслуживает
+# другие запросы, а не простаивает, как синхронный воркер gunicorn. Логика запросов — в main.check_unread_emails_async;
+# здесь только протокол ASGI: разбор запроса, потоковая отправка ответа и lifespan.
+
+from urllib.parse import parse_qsl
+
+import main
+
+
+class AsgiRequest:
+    # Те же атрибуты, что main берет у request Flask/Functions Framework: method, path, args
+    def __init__(self, scope):
+        self.method = scope.get('method', 'GET')
+        self.path = scope.get('path', '/')
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan': return await _lifespan(receive, send)
+    if scope['type'] != 'http': return
+    body, status_code, headers = await main.check_unread_emails_async(AsgiRequest(scope))
+    try:
+        # Отправка заголовков — тоже внутри try: если клиент уже отключился, тело все равно закрывается (аренда ящика, запуск)
+        await send({'type': 'http.response.start', 'status': status_code,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]})
+        if isinstance(body, str): await _send_chunk(send, body)
+        elif hasattr(body, '__aiter__'):
+            async for chunk in body: await _send_chunk(send, chunk)
+        else:
+            # Синхронный генератор (отчет из архива /history): каждый шаг читает файл, поэтому выполняется в пуле потоков
+            iterator = iter(body)
+            while True:
+                chunk = await main.run_blocking(next, iterator, None)
+                if chunk is None: break
+                await _send_chunk(send, chunk)
+    finally:
+        if hasattr(body, 'aclose'): await body.aclose()
+        elif hasattr(body, 'close'): body.close()
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def _send_chunk(send, chunk):
+    if chunk: await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+
+
+async def _lifespan(receive, send):
+    # Клиенты GCS и Gemini прогреваются при импорте main (PREWARM_CLIENTS); при остановке освобождаем пул потоков
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup': await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            main.shutdown_blocking_executor()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,594 @@
+# benchmarks.py
+# Офлайн-бенчмарки конвейера на локальных заглушках из local_fakes.py.
+# Запуск: python benchmarks.py <сценарий> [параметры], например: python benchmarks.py fetch --count 500 --latency 0.05
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import glob
+import html
+import io
+import json
+import os
+import pickle
+import posixpath
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+import asgi_app
+import mail_body
+import main
+import summary_cache
+from local_fakes import FakeGenerativeModel, FakeGmailService, FakeStorageClient, generate_fake_messages
+
+
+def _timed(func, *args, **kwargs):
+    # Логи конвейера (print) глушим, чтобы они не искажали замер и не засоряли вывод
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def _http_call(request):
+    # Ответ обработчика целиком: потоковое тело (генератор) дочитывается, как это сделал бы сервер
+    body, status, headers = main.check_unread_emails_http(request)
+    return (body if isinstance(body, str) else "".join(body)), status, headers
+
+
+def bench_fetch(args):
+    messages = generate_fake_messages(args.count)
+
+    def sequential(service):
+        for msg_id in main.list_unread_message_ids(service, 'me', max_results=args.count):
+            if main.get_email_details(service, 'me', msg_id): main.mark_email_as_read(service, 'me', msg_id)
+
+    def batched(service):
+        msg_ids = main.list_unread_message_ids(service, 'me', max_results=args.count)
+        details = main.fetch_email_details_batch(service, 'me', msg_ids)
+        main.mark_emails_as_read_batch(service, 'me', [m_id for m_id, d in zip(msg_ids, details) if d])
+
+    print(f"Писем: {args.count}, задержка round trip: {args.latency * 1000:.0f} мс, размер batch: {main.GMAIL_BATCH_SIZE}")
+    for name, func in (("По одному письму", sequential), ("Batch + batchModify", batched)):
+        service = FakeGmailService(messages, latency=args.latency)
+        _, elapsed = _timed(func, service)
+        print(f"  {name:22s} {elapsed:8.2f} с, round trips: {service.round_trips:5d}, осталось непрочитанных: {service.unread_count()}")
+
+
+def bench_summarize(args):
+    bodies = [message['snippet'] for message in generate_fake_messages(args.count)]
+    main.GEMINI_RETRY_BASE_DELAY = args.retry_delay
+
+    print(f"Писем: {args.count}, задержка LLM: {args.latency * 1000:.0f} мс, доля ошибок 429/503: {args.error_rate:.0%}")
+    for name, workers in (("Последовательно", 1), (f"Пул из {args.workers} потоков", args.workers)):
+        model = FakeGenerativeModel(latency=args.latency, error_rate=args.error_rate)
+        limiter = main.RateLimiter(args.rpm, args.tpm)
+        summaries, elapsed = _timed(main.summarize_emails_concurrently, bodies, main.GCP_PROJECT_ID, main.GCP_REGION, main.GEMINI_MODEL_NAME,
+                                    model=model, max_workers=workers, rate_limiter=limiter, batch=False)
+        failed = sum(1 for summary in summaries if summary.startswith("Ошибка"))
+        print(f"  {name:22s} {elapsed:8.2f} с, вызовов: {model.calls:4d}, ошибок API: {model.errors:3d}, не удалось: {failed}, пик параллельности: {model.peak_concurrency}")
+
+
+def bench_cache(args):
+    # Рассылки: доля писем — копии уже встречавшихся, часть копий отличается только "хвостом" (ссылкой отписки и т.п.)
+    rng = random.Random(7)
+    originals = [message['snippet'] + " " + " ".join(f"word{rng.randint(0, 5000)}" for _ in range(120)) for message in generate_fake_messages(args.count)]
+    bodies = []
+    for i, body in enumerate(originals):
+        if i and rng.random() < args.duplicate_rate:
+            source = rng.choice(bodies)
+            body = source if rng.random() < 0.5 else source + f" unsubscribe-id-{i}"
+        bodies.append(body)
+
+    print(f"Писем: {args.count}, доля копий: {args.duplicate_rate:.0%}, порог SimHash: {args.near_distance}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        backends = {'none': None, 'memory': summary_cache.MemoryCacheBackend(), 'sqlite': summary_cache.SqliteCacheBackend(os.path.join(tmp_dir, 'cache.sqlite3'))}
+        for name, backend in backends.items():
+            cache = summary_cache.SummaryCache(backend, main.SUMMARY_PROMPT_VERSION, main.SUMMARY_MAX_CHARS, 3600, 10000, args.near_distance) if backend is not None else None
+            for run in (1, 2):
+                model = FakeGenerativeModel(latency=args.latency)
+                _, elapsed = _timed(main.summarize_emails_concurrently, bodies, main.GCP_PROJECT_ID, main.GCP_REGION, main.GEMINI_MODEL_NAME, model=model, cache=cache, batch=False)
+                stats = cache.stats() if cache is not None else {'hit_rate': 0.0}
+                print(f"  {name:7s} запуск {run}: {elapsed:6.2f} с, вызовов LLM: {model.calls:4d}, доля попаданий: {stats['hit_rate']:.0%}")
+                if cache is not None: cache.flush(); cache.reset_stats()
+
+
+def _legacy_categorize(email_details):
+    # Прежний линейный проход по CATEGORIZATION_RULES — эталон для сравнения скорости и результатов
+    sender_domain = main.extract_domain(email_details.get('from', '').lower())
+    subject_lower = email_details.get('subject', '').lower()
+    for rule in main.CATEGORIZATION_RULES:
+        if sender_domain and rule.get("senders_domains") and sender_domain in rule["senders_domains"]: return rule["name"]
+        if rule.get("subject_keywords") and any(keyword.lower() in subject_lower for keyword in rule["subject_keywords"]): return rule["name"]
+    return main.DEFAULT_CATEGORY
+
+
+def _synthetic_headers(count, seed=3):
+    rng = random.Random(seed)
+    domains = sorted({d for rule in main.CATEGORIZATION_RULES for d in rule["senders_domains"]}) + [f"shop{i}.example.com" for i in range(200)]
+    keywords = [k for rule in main.CATEGORIZATION_RULES for k in rule["subject_keywords"]]
+    filler = "your weekly digest news update account order invoice meeting hello team report new offer sale".split()
+    emails = []
+    for _ in range(count):
+        words = [rng.choice(filler) for _ in range(rng.randint(3, 9))]
+        if rng.random() < 0.4: words.insert(rng.randrange(len(words) + 1), rng.choice(keywords))
+        emails.append({'from': f"Sender <noreply@{rng.choice(domains)}>", 'subject': " ".join(words).capitalize()})
+    return emails
+
+
+def bench_categorize(args):
+    emails = _synthetic_headers(args.count)
+    legacy, legacy_time = _timed(lambda: [_legacy_categorize(e) for e in emails])
+    single, single_time = _timed(lambda: [main.categorize_email(e) for e in emails])
+    batch, batch_time = _timed(main.categorize_emails, emails)
+    print(f"Писем: {args.count}")
+    print(f"  Линейный проход правил      {legacy_time:7.3f} с")
+    print(f"  CompiledCategorizer         {single_time:7.3f} с  (x{legacy_time / single_time:.1f})")
+    print(f"  CompiledCategorizer, пакет  {batch_time:7.3f} с  (x{legacy_time / batch_time:.1f})")
+    print(f"  Расхождений с линейным проходом: {sum(1 for a, b in zip(legacy, single) if a != b)}, между одиночным и пакетным режимом: {sum(1 for a, b in zip(single, batch) if a != b)}")
+    subdomain = main.categorize_email({'from': 'Binance <do-not-reply@news.binance.com>', 'subject': 'Weekly digest'})
+    print(f"  Поддомен news.binance.com -> {subdomain}")
+
+
+def _write_marketing_eml_corpus(directory, count, seed=11):
+    # Тяжелые маркетинговые рассылки: вложенные таблицы, инлайновые стили, большой <style> и трекинговые ссылки
+    rng = random.Random(seed)
+    for i in range(count):
+        rows = "".join(f'<tr><td style="padding:{rng.randint(1, 20)}px;font-family:Arial"><a href="https://click.example.com/t/{rng.getrandbits(64):x}">'
+                       f'<img src="https://img.example.com/{i}/{j}.png" width="600" alt="Offer {j}"></a><p>Deal number {j}: save {rng.randint(5, 70)}% &amp; more</p></td></tr>'
+                       for j in range(rng.randint(200, 1500)))
+        css = "".join(f".c{j}{{color:#{rng.getrandbits(24):06x};margin:{j}px}}" for j in range(rng.randint(500, 3000)))
+        message = EmailMessage()
+        message['Subject'] = f"Big sale #{i}"
+        message['From'] = "Shop <news@shop.example.com>"
+        message['Date'] = 'Mon, 1 Jan 2024 10:00:00 +0000'
+        message.set_content(f"<html><head><style>{css}</style></head><body><table>{rows}</table></body></html>", subtype='html')
+        with open(os.path.join(directory, f"mail_{i:04d}.eml"), 'wb') as f: f.write(bytes(message))
+
+
+def _measure(func, items):
+    # Время и пик памяти — отдельными проходами: tracemalloc сильно замедляет код, активно выделяющий память
+    started = time.perf_counter()
+    for item in items: func(item)
+    elapsed = time.perf_counter() - started
+    peak = 0
+    for item in items:
+        tracemalloc.start()
+        func(item)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_mime(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        eml_dir = args.eml_dir
+        if not eml_dir:
+            eml_dir = tmp_dir
+            _write_marketing_eml_corpus(eml_dir, args.count)
+        raw_messages = []
+        for path in sorted(glob.glob(os.path.join(eml_dir, '*.eml'))):
+            with open(path, 'rb') as f: raw_messages.append(f.read())
+    html_bodies = []
+    for raw in raw_messages:
+        part = mail_body.email.message_from_bytes(raw, policy=mail_body.email.policy.default).get_body(preferencelist=('html',))
+        if part is not None: html_bodies.append(part.get_content())
+    print(f"Писем .eml: {len(raw_messages)}, из них с HTML: {len(html_bodies)}, средний размер HTML: {sum(map(len, html_bodies)) // max(len(html_bodies), 1) // 1024} КБ")
+
+    try:
+        from bs4 import BeautifulSoup
+        legacy = lambda body: BeautifulSoup(body, "html.parser").get_text(separator='\n', strip=True)[:main.SUMMARY_MAX_CHARS]
+        elapsed, peak = _measure(legacy, html_bodies)
+        print(f"  BeautifulSoup html.parser       {elapsed:7.2f} с, пик памяти на письмо {peak / 2**20:6.1f} МБ")
+    except ImportError:
+        print("  BeautifulSoup не установлен — сравнение с прежним разбором пропущено")
+    elapsed, peak = _measure(lambda body: mail_body.html_to_text(body, main.SUMMARY_MAX_CHARS), html_bodies)
+    print(f"  mail_body.html_to_text          {elapsed:7.2f} с, пик памяти на письмо {peak / 2**20:6.1f} МБ")
+    elapsed, peak = _measure(lambda raw: mail_body.parse_raw_message(raw, main.MAIL_BODY_MAX_BYTES, main.SUMMARY_MAX_CHARS), raw_messages)
+    print(f"  mail_body.parse_raw_message     {elapsed:7.2f} с, пик памяти на письмо {peak / 2**20:6.1f} МБ (разбор .eml целиком)")
+
+
+def make_fake_token_pickle(token='fake-token', valid_for=datetime.timedelta(hours=1)):
+    # Настоящий объект Credentials с фиктивными значениями: проходит проверку isinstance и creds.valid без сети
+    creds = main.Credentials(token=token, refresh_token='fake-refresh', client_id='fake-client', client_secret='fake-secret',
+                             token_uri='https://oauth2.googleapis.com/token', expiry=datetime.datetime.utcnow() + valid_for)
+    return pickle.dumps(creds)
+
+
+def bench_startup(args):
+    import_times = []
+    for _ in range(args.imports):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import main'], check=True, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True)
+        import_times.append(time.perf_counter() - started)
+    print(f"Холодный старт процесса с import main: {min(import_times):.2f} с (лучший из {args.imports})")
+
+    objects = {main.BUCKET_NAME: {main.TOKEN_PICKLE_GCS_PATH: make_fake_token_pickle()}}
+    def storage_client_factory():
+        time.sleep(args.client_latency) # поиск учетных данных и создание HTTP-сессии
+        return FakeStorageClient(objects, latency=args.gcs_latency)
+    def model_factory(project_id, location, model_name):
+        time.sleep(args.model_latency) # vertexai.init + GenerativeModel
+        return FakeGenerativeModel()
+    main.SERVICES = main.ServiceContainer(storage_client_factory=storage_client_factory, model_factory=model_factory)
+
+    def request_setup():
+        service = main.get_gmail_service_automated()
+        main.SERVICES.gemini_model(main.GCP_PROJECT_ID, main.GCP_REGION, main.GEMINI_MODEL_NAME)
+        return service
+
+    cold = []
+    for _ in range(args.requests):
+        main.SERVICES.reset() # так вел себя каждый запрос до появления ServiceContainer
+        service, elapsed = _timed(request_setup)
+        cold.append(elapsed)
+    main.SERVICES.reset()
+    _timed(request_setup)
+    warm = [_timed(request_setup)[1] for _ in range(args.requests)]
+    print(f"Подготовка клиентов на запрос (GCS {args.gcs_latency * 1000:.0f} мс, storage.Client {args.client_latency * 1000:.0f} мс, модель {args.model_latency * 1000:.0f} мс):")
+    print(f"  Без переиспользования   {sum(cold) / len(cold) * 1000:8.1f} мс")
+    print(f"  ServiceContainer        {sum(warm) / len(warm) * 1000:8.1f} мс")
+
+
+class FakeRequest:
+    method = 'GET'
+
+    def __init__(self, path='/', **args):
+        self.path = path
+        self.args = args
+
+
+def bench_multi(args):
+    # Полный прогон многоящичного режима на локальных GCS/Gmail/Gemini: манифест и токены лежат в фиктивном бакете
+    manifest = {'accounts': [{'name': f"user{i}@example.com", 'token_path': f"gmail_tokens/user{i}/token.pickle", 'max_emails': args.max_emails}
+                             for i in range(args.accounts)]}
+    manifest['accounts'].append({'name': "broken@example.com", 'token_path': "gmail_tokens/broken/token.pickle"}) # токена нет — проверка изоляции ошибок
+    # Сравниваем именно параллельность: без общего лимита Gemini и без кэша резюме между прогонами
+    main.GEMINI_RATE_LIMITER = main.RateLimiter(0, 0)
+    main._summary_cache, main._summary_cache_initialized = None, True
+    print(f"Ящиков: {args.accounts} (+1 без токена), писем на ящик: {args.emails}, max_emails: {args.max_emails}, задержка Gmail: {args.latency * 1000:.0f} мс, Gemini: {args.llm_latency * 1000:.0f} мс")
+    for workers in (1, args.workers):
+        objects = {main.BUCKET_NAME: {main.ACCOUNTS_MANIFEST_GCS_PATH: json.dumps(manifest).encode('utf-8')}}
+        mailboxes = {}
+        for i, account in enumerate(manifest['accounts'][:-1]):
+            objects[main.BUCKET_NAME][account['token_path']] = make_fake_token_pickle(token=account['name'])
+            mailboxes[account['name']] = FakeGmailService(generate_fake_messages(args.emails, seed=i), latency=args.latency)
+        model = FakeGenerativeModel(latency=args.llm_latency)
+        main.SERVICES = main.ServiceContainer(storage_client_factory=lambda: FakeStorageClient(objects), gmail_builder=lambda creds: mailboxes[creds.token],
+                                              model_factory=lambda *a: model)
+        main.MULTI_ACCOUNT_MAX_WORKERS = workers
+        (body, status, _), elapsed = _timed(_http_call, FakeRequest(mode='multi'))
+        unread_left = sum(mailbox.unread_count() for mailbox in mailboxes.values())
+        error_isolated = 'broken@example.com' in body and 'class="error"' in body
+        print(f"  Потоков: {workers:3d}  {elapsed:7.2f} с, статус {status}, вызовов LLM: {model.calls}, непрочитанных осталось: {unread_left}, "
+              f"ошибка аккаунта без токена в отчете: {error_isolated}")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f: f.write(body)
+        print(f"  Сводный отчет сохранен в {args.report}")
+
+
+def bench_drain(args):
+    # Разбор большой очереди непрочитанных одним запросом с дедлайном против обычных запусков по MAX_EMAILS_TO_PROCESS
+    main.GEMINI_RATE_LIMITER = main.RateLimiter(0, 0)
+    main._summary_cache, main._summary_cache_initialized = None, True
+    mailbox = FakeGmailService(generate_fake_messages(args.emails), latency=args.latency)
+    model = FakeGenerativeModel(latency=args.llm_latency)
+    objects = {main.BUCKET_NAME: {main.TOKEN_PICKLE_GCS_PATH: make_fake_token_pickle()}}
+    main.SERVICES = main.ServiceContainer(storage_client_factory=lambda: FakeStorageClient(objects), gmail_builder=lambda creds: mailbox,
+                                          model_factory=lambda *a: model)
+    print(f"Непрочитанных: {args.emails}, задержка Gmail: {args.latency * 1000:.0f} мс, Gemini: {args.llm_latency * 1000:.0f} мс, "
+          f"дедлайн: {args.deadline:.0f} с, блок: {main.DRAIN_CHUNK_SIZE}")
+    (_, status, _), elapsed = _timed(_http_call, FakeRequest())
+    per_email = elapsed / main.MAX_EMAILS_TO_PROCESS
+    print(f"  Обычный запуск ({main.MAX_EMAILS_TO_PROCESS} писем)  {elapsed:6.2f} с, статус {status}; "
+          f"запусков на всю очередь: ~{(args.emails + main.MAX_EMAILS_TO_PROCESS - 1) // main.MAX_EMAILS_TO_PROCESS}")
+    for run in range(1, args.runs + 1):
+        unread_before, calls_before = mailbox.unread_count(), model.calls
+        (body, status, _), elapsed = _timed(_http_call, FakeRequest(mode='drain', deadline_seconds=str(args.deadline)))
+        processed = unread_before - mailbox.unread_count()
+        print(f"  Разбор очереди, запуск {run}  {elapsed:6.2f} с, статус {status}, обработано: {processed} ({processed / elapsed:.0f} писем/с, "
+              f"обычными запусками ~{per_email * processed:.0f} с), вызовов LLM: {model.calls - calls_before}, осталось: {mailbox.unread_count()}, "
+              f"остановлен по дедлайну: {'лимиту времени' in body}")
+        if not mailbox.unread_count(): break
+
+
+def bench_batch(args):
+    # День рассылок: много коротких уведомлений и немного длинных писем. Резюме заглушки детерминированы,
+    # поэтому пакетный режим обязан дать ровно те же резюме, что и запросы по одному, в том числе после отката.
+    rng = random.Random(5)
+    bodies = [message['snippet'] + " " + " ".join(f"news{rng.randint(0, 900)}" for _ in range(rng.randint(10, 80))) for message in generate_fake_messages(args.count)]
+    for i in range(0, len(bodies), max(int(1 / args.long_share), 1) if args.long_share else len(bodies) + 1):
+        bodies[i] += " " + " ".join(f"длинный{rng.randint(0, 5000)}" for _ in range(600)) # длиннее SUMMARY_BATCH_EMAIL_MAX_CHARS
+    long_count = sum(1 for body in bodies if len(body) > main.SUMMARY_BATCH_EMAIL_MAX_CHARS)
+    print(f"Писем: {args.count} (длинных: {long_count}), задержка LLM: {args.latency * 1000:.0f} мс, бюджет пакета: {main.SUMMARY_BATCH_TOKEN_BUDGET} токенов, "
+          f"до {main.SUMMARY_BATCH_MAX_EMAILS} писем")
+    reference = None
+    for name, batch, drop_rate, malformed_rate in (("По одному письму", False, 0.0, 0.0), ("Пакетами", True, 0.0, 0.0),
+                                                   (f"Пакетами, потери {args.drop_rate:.0%}/не JSON {args.malformed_rate:.0%}", True, args.drop_rate, args.malformed_rate)):
+        model = FakeGenerativeModel(latency=args.latency, batch_drop_rate=drop_rate, batch_malformed_rate=malformed_rate)
+        summaries, elapsed = _timed(main.summarize_emails_concurrently, bodies, main.GCP_PROJECT_ID, main.GCP_REGION, main.GEMINI_MODEL_NAME,
+                                    model=model, rate_limiter=main.RateLimiter(0, 0), batch=batch)
+        reference = reference or summaries
+        print(f"  {name:34s} {elapsed:6.2f} с, запросов: {model.calls:4d} (пакетных: {model.batch_calls:3d}), токенов: вход {model.prompt_tokens:7d}, "
+              f"выход {model.output_tokens:6d}, резюме совпадают с поштучными: {summaries == reference}")
+
+    # Разбор пакетного ответа: валидируются только непустые строки под ожидаемыми id
+    keys = ['m1', 'm2', 'm3']
+    cases = [('{"m1": "a", "m2": " ", "m3": 5, "m9": "x"}', {'m1': 'a'}), ('```json\n{"m2": "b"}\n```', {'m2': 'b'}),
+             ('["m1"]', {}), ('не JSON', {}), (None, {})]
+    with contextlib.redirect_stdout(io.StringIO()):
+        parse_ok = all(main.parse_batch_summaries(text, keys) == expected for text, expected in cases)
+    print(f"  Разбор ответов (лишние/пустые/нестроковые id, ```json, не объект, не JSON): {'OK' if parse_ok else 'ОШИБКА'}")
+
+
+def record_fixtures(args):
+    # Записывает письма реального ящика (format=full) в JSON-фикстуру для replay. Нужны те же переменные окружения и
+    # доступ к токену в GCS, что и у сервиса; письма только читаются, пометки не меняются. В фикстуре — содержимое писем!
+    service = main.get_gmail_service_automated()
+    if service is None: sys.exit("Не удалось получить сервис Gmail.")
+    msg_ids = main.list_unread_message_ids(service, 'me', max_results=args.count, query=args.query)
+    messages = [service.users().messages().get(userId='me', id=msg_id, format='full').execute() for msg_id in msg_ids]
+    with open(args.output, 'w', encoding='utf-8') as f: json.dump({'messages': messages}, f, ensure_ascii=False)
+    print(f"Записано писем: {len(messages)} в {args.output}")
+
+
+def bench_replay(args):
+    # Прогон записанных (или синтетических) писем через весь конвейер одним запуском разбора очереди;
+    # p50/p95 по этапам берутся из JSON-сводки запуска в логе, как их увидит Cloud Logging
+    if args.fixtures:
+        with open(args.fixtures, 'r', encoding='utf-8') as f: messages = json.load(f)['messages']
+    else: messages = generate_fake_messages(args.count)
+    for message in messages:
+        message['labelIds'] = list(dict.fromkeys(message.get('labelIds', []) + ['UNREAD']))
+    main.GEMINI_RATE_LIMITER = main.RateLimiter(0, 0)
+    main._summary_cache, main._summary_cache_initialized = None, True
+    mailbox = FakeGmailService(messages, latency=args.latency)
+    model = FakeGenerativeModel(latency=args.llm_latency)
+    objects = {main.BUCKET_NAME: {main.TOKEN_PICKLE_GCS_PATH: make_fake_token_pickle()}}
+    main.SERVICES = main.ServiceContainer(storage_client_factory=lambda: FakeStorageClient(objects, latency=args.gcs_latency),
+                                          gmail_builder=lambda creds: mailbox, model_factory=lambda *a: model)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        _, status, _ = _http_call(FakeRequest(mode='drain', deadline_seconds=str(main.REQUEST_TIMEOUT_SECONDS)))
+    run = next(json.loads(line) for line in log.getvalue().splitlines() if line.startswith('{') and json.loads(line).get('message') == 'pipeline_run')
+    print(f"Писем: {len(messages)} ({args.fixtures or 'синтетические'}), задержка Gmail: {args.latency * 1000:.0f} мс, Gemini: {args.llm_latency * 1000:.0f} мс, "
+          f"GCS: {args.gcs_latency * 1000:.0f} мс; статус {status}, запуск {run['duration_seconds']:.2f} с")
+    print(f"  {'Этап':22s} {'вызовов':>8s} {'всего, с':>9s} {'p50, мс':>9s} {'p95, мс':>9s} {'max, мс':>9s}")
+    for stage, stats in run['stages'].items():
+        print(f"  {stage:22s} {stats['count']:8d} {stats['total_seconds']:9.3f} {stats['p50_ms']:9.2f} {stats['p95_ms']:9.2f} {stats['max_ms']:9.2f}")
+    print(f"  Счетчики: {run['counters']}")
+    metrics_text, _, headers = main.check_unread_emails_http(FakeRequest(path='/metrics'))
+    series = [line for line in metrics_text.splitlines() if line and not line.startswith('#')]
+    print(f"  /metrics: {len(series)} рядов, {headers['Content-Type']}")
+
+
+def bench_stream(args):
+    # Потоковый отчет разбора очереди: время до первой строки таблицы против полного ответа, затем архив запусков —
+    # постраничная история в GCS и отчет прошлого запуска, совпадающий с тем, что получил клиент
+    main.GEMINI_RATE_LIMITER = main.RateLimiter(0, 0)
+    main._summary_cache, main._summary_cache_initialized = None, True
+    mailbox = FakeGmailService(generate_fake_messages(args.emails), latency=args.latency)
+    model = FakeGenerativeModel(latency=args.llm_latency)
+    objects = {main.BUCKET_NAME: {main.TOKEN_PICKLE_GCS_PATH: make_fake_token_pickle()}}
+    main.SERVICES = main.ServiceContainer(storage_client_factory=lambda: FakeStorageClient(objects), gmail_builder=lambda creds: mailbox,
+                                          model_factory=lambda *a: model)
+    print(f"Непрочитанных: {args.emails}, запусков: {args.runs} по {args.per_run} писем, задержка Gmail: {args.latency * 1000:.0f} мс, "
+          f"Gemini: {args.llm_latency * 1000:.0f} мс, блок: {main.DRAIN_CHUNK_SIZE}")
+    bodies = []
+    for run in range(1, args.runs + 1):
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            body, status, _ = main.check_unread_emails_http(FakeRequest(mode='drain', max_emails=str(args.per_run)))
+            chunks, first_row = [], None
+            for chunk in body:
+                if first_row is None and '<tr><td>' in chunk: first_row = time.perf_counter() - started
+                chunks.append(chunk)
+            elapsed = time.perf_counter() - started
+        bodies.append("".join(chunks))
+        print(f"  Запуск {run}: статус {status}, первая строка через {first_row or 0:.2f} с, весь отчет {elapsed:.2f} с, частей ответа: {len(chunks)}")
+
+    prefix = posixpath.join(main.RUN_ARCHIVE_GCS_PREFIX, '')
+    archived = sorted(name for name in objects[main.BUCKET_NAME] if name.startswith(prefix))
+    print(f"  Архивов в GCS: {len(archived)}, без временных файлов: {not glob.glob(os.path.join(main.TEMP_RUN_ARCHIVE_DIR, 'run_*.jsonl.gz'))}")
+    pages, page_token = 0, None
+    while True:
+        with contextlib.redirect_stdout(io.StringIO()):
+            history, status, _ = _http_call(FakeRequest(path='/history', page_size=str(args.page_size), **({'page_token': page_token} if page_token else {})))
+        pages += 1
+        page_token = (re.search(r'page_token=([^&"]+)', history) or [None, None])[1]
+        if not page_token: break
+        page_token = urllib.parse.unquote(page_token)
+    newest = re.search(r'href="/history\?run=([^"]+)"', history if pages == 1 else _http_call(FakeRequest(path='/history'))[0])
+    with contextlib.redirect_stdout(io.StringIO()):
+        replayed, status, _ = _http_call(FakeRequest(path='/history', run=urllib.parse.unquote(html.unescape(newest[1]))))
+        rejected = _http_call(FakeRequest(path='/history', run=main.TOKEN_PICKLE_GCS_PATH))[1]
+    same_rows = re.findall(r'<tr><td>.*?</tr>', replayed) == re.findall(r'<tr><td>.*?</tr>', bodies[-1])
+    print(f"  История: страниц по {args.page_size}: {pages}; отчет последнего запуска из архива: статус {status}, строки совпадают: {same_rows}; "
+          f"чужой объект по ?run=: статус {rejected}")
+
+
+async def _asgi_get(app, path='/', **args):
+    # Один запрос к ASGI-приложению без сервера: статус и тело собираются из сообщений send
+    messages = []
+
+    async def receive(): return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message): messages.append(message)
+
+    await app({'type': 'http', 'method': 'GET', 'path': path, 'query_string': urllib.parse.urlencode(args).encode('ascii')}, receive, send)
+    return messages[0]['status'], b"".join(message.get('body', b'') for message in messages[1:]).decode('utf-8')
+
+
+def bench_asgi(args):
+    # Нагрузочный тест экземпляра на локальных GCS/Gmail/Gemini: N одновременных запросов, по ящику на запрос (?account=,
+    # как триггер планировщика на каждый ящик). Синхронный обработчик с W потоками (1 — синхронный воркер gunicorn,
+    # больше — gthread) против asgi_app в одном цикле событий. Затем single-flight: пересекающиеся запросы к одному
+    # ящику и аренда ящика, взятая другим экземпляром (действующая и истекшая).
+    names = [f"user{i}@example.com" for i in range(args.requests)]
+    manifest = {'accounts': [{'name': name, 'token_path': f"gmail_tokens/user{i}/token.pickle", 'max_emails': args.max_emails} for i, name in enumerate(names)]}
+    main.GEMINI_RATE_LIMITER = main.RateLimiter(0, 0)
+    main._summary_cache, main._summary_cache_initialized = None, True
+
+    def fresh_instance():
+        objects = {main.BUCKET_NAME: {main.ACCOUNTS_MANIFEST_GCS_PATH: json.dumps(manifest).encode('utf-8')}}
+        for i, account in enumerate(manifest['accounts']): objects[main.BUCKET_NAME][account['token_path']] = make_fake_token_pickle(token=account['name'])
+        mailboxes = {name: FakeGmailService(generate_fake_messages(args.emails, seed=i), latency=args.latency) for i, name in enumerate(names)}
+        model = FakeGenerativeModel(latency=args.llm_latency)
+        main.SERVICES = main.ServiceContainer(storage_client_factory=lambda: FakeStorageClient(objects, latency=args.gcs_latency),
+                                              gmail_builder=lambda creds: mailboxes[creds.token], model_factory=lambda *a: model)
+        return objects, mailboxes, model
+
+    def report(name, elapsed, statuses, mailboxes, model):
+        processed = sum(args.emails - mailbox.unread_count() for mailbox in mailboxes.values())
+        print(f"  {name:34s} {elapsed:6.2f} с, {len(statuses) / elapsed:6.1f} запросов/с, статусы: {dict(collections.Counter(statuses))}, "
+              f"обработано писем: {processed}, вызовов LLM: {model.calls}")
+
+    print(f"Одновременных запросов: {args.requests} (по ящику), писем на ящик: {args.emails}, max_emails: {args.max_emails}, задержка Gmail: "
+          f"{args.latency * 1000:.0f} мс, GCS: {args.gcs_latency * 1000:.0f} мс, Gemini: {args.llm_latency * 1000:.0f} мс")
+    for threads in (1, args.threads):
+        _, mailboxes, model = fresh_instance()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            responses, elapsed = _timed(lambda: list(pool.map(lambda name: _http_call(FakeRequest(mode='multi', account=name)), names)))
+        report(f"Синхронный обработчик, потоков: {threads}", elapsed, [status for _, status, _ in responses], mailboxes, model)
+
+    async def concurrent_requests(account_names):
+        return await asyncio.gather(*(_asgi_get(asgi_app.app, '/', mode='multi', account=name) for name in account_names))
+
+    _, mailboxes, model = fresh_instance()
+    responses, elapsed = _timed(asyncio.run, concurrent_requests(names))
+    report("asgi_app, один цикл событий", elapsed, [status for status, _ in responses], mailboxes, model)
+
+    objects, mailboxes, model = fresh_instance()
+    responses, _ = _timed(asyncio.run, concurrent_requests([names[0]] * args.overlap))
+    statuses = collections.Counter(status for status, _ in responses)
+    processed = args.emails - mailboxes[names[0]].unread_count()
+    print(f"  Single-flight: {args.overlap} пересекающихся запросов к одному ящику -> {dict(statuses)}, обработано писем: {processed} "
+          f"(лимит запуска {args.max_emails}), вызовов LLM: {model.calls}")
+    lease_path = manifest['accounts'][1]['token_path'] + '.lease'
+    results = []
+    for expires_in in (600, -1): # аренда другого экземпляра: действующая, затем истекшая (экземпляр упал)
+        objects[main.BUCKET_NAME][lease_path] = json.dumps({'owner': 'other-instance', 'expires_at': time.time() + expires_in}).encode('utf-8')
+        (status, _), = _timed(asyncio.run, concurrent_requests([names[1]]))[0]
+        results.append(status)
+    leases_left = [name for name in objects[main.BUCKET_NAME] if name.endswith('.lease')]
+    print(f"  Аренда другого экземпляра: действующая -> {results[0]}, истекшая -> {results[1]}; аренд после запусков: {len(leases_left)}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки Gmail AI агента")
+    subparsers = parser.add_subparsers(dest='scenario', required=True)
+
+    fetch = subparsers.add_parser('fetch', help="Загрузка и пометка писем: по одному против batch")
+    fetch.add_argument('--count', type=int, default=200)
+    fetch.add_argument('--latency', type=float, default=0.05)
+    fetch.set_defaults(func=bench_fetch)
+
+    summarize = subparsers.add_parser('summarize', help="Суммирование: последовательно против пула с лимитами и повторами")
+    summarize.add_argument('--count', type=int, default=40)
+    summarize.add_argument('--latency', type=float, default=0.2)
+    summarize.add_argument('--error-rate', type=float, default=0.1)
+    summarize.add_argument('--workers', type=int, default=main.GEMINI_MAX_CONCURRENCY)
+    summarize.add_argument('--rpm', type=int, default=0, help="Лимит запросов в минуту (0 — без ограничения)")
+    summarize.add_argument('--tpm', type=int, default=0, help="Лимит токенов в минуту (0 — без ограничения)")
+    summarize.add_argument('--retry-delay', type=float, default=0.05, help="Базовая задержка повтора, с")
+    summarize.set_defaults(func=bench_summarize)
+
+    cache = subparsers.add_parser('cache', help="Кэш резюме: вызовы LLM без кэша и с кэшем в памяти/SQLite, повторный запуск")
+    cache.add_argument('--count', type=int, default=100)
+    cache.add_argument('--latency', type=float, default=0.05)
+    cache.add_argument('--duplicate-rate', type=float, default=0.3)
+    cache.add_argument('--near-distance', type=int, default=3)
+    cache.set_defaults(func=bench_cache)
+
+    categorize = subparsers.add_parser('categorize', help="Категоризация: линейный проход правил против скомпилированного классификатора")
+    categorize.add_argument('--count', type=int, default=100000)
+    categorize.set_defaults(func=bench_categorize)
+
+    mime = subparsers.add_parser('mime', help="Извлечение текста из HTML-писем: BeautifulSoup против mail_body")
+    mime.add_argument('--eml-dir', help="Каталог с файлами .eml; по умолчанию генерируется синтетический корпус рассылок")
+    mime.add_argument('--count', type=int, default=30, help="Размер синтетического корпуса")
+    mime.set_defaults(func=bench_mime)
+
+    startup = subparsers.add_parser('startup', help="Холодный старт и подготовка клиентов на запрос: без кэша против ServiceContainer")
+    startup.add_argument('--imports', type=int, default=3)
+    startup.add_argument('--requests', type=int, default=10)
+    startup.add_argument('--gcs-latency', type=float, default=0.03)
+    startup.add_argument('--client-latency', type=float, default=0.05)
+    startup.add_argument('--model-latency', type=float, default=0.1)
+    startup.set_defaults(func=bench_startup)
+
+    multi = subparsers.add_parser('multi', help="Многоящичный режим end-to-end на локальных GCS/Gmail: последовательно против пула")
+    multi.add_argument('--accounts', type=int, default=12)
+    multi.add_argument('--emails', type=int, default=30)
+    multi.add_argument('--max-emails', type=int, default=10)
+    multi.add_argument('--workers', type=int, default=8)
+    multi.add_argument('--latency', type=float, default=0.05)
+    multi.add_argument('--llm-latency', type=float, default=0.2)
+    multi.add_argument('--report', help="Куда сохранить сводный HTML-отчет")
+    multi.set_defaults(func=bench_multi)
+
+    drain = subparsers.add_parser('drain', help="Разбор очереди непрочитанных до дедлайна против обычных запусков по MAX_EMAILS_TO_PROCESS")
+    drain.add_argument('--emails', type=int, default=2000)
+    drain.add_argument('--deadline', type=float, default=5.0)
+    drain.add_argument('--runs', type=int, default=3)
+    drain.add_argument('--latency', type=float, default=0.02)
+    drain.add_argument('--llm-latency', type=float, default=0.05)
+    drain.set_defaults(func=bench_drain)
+
+    batch = subparsers.add_parser('batch', help="Суммирование коротких писем: запрос на письмо против пакетных JSON-запросов")
+    batch.add_argument('--count', type=int, default=200)
+    batch.add_argument('--latency', type=float, default=0.05)
+    batch.add_argument('--long-share', type=float, default=0.05, help="Доля длинных писем, которые суммируются отдельно")
+    batch.add_argument('--drop-rate', type=float, default=0.1, help="Доля записей, пропущенных моделью в пакетном ответе")
+    batch.add_argument('--malformed-rate', type=float, default=0.1, help="Доля пакетных ответов, не являющихся JSON")
+    batch.set_defaults(func=bench_batch)
+
+    replay = subparsers.add_parser('replay', help="Прогон записанных писем через конвейер: p50/p95 по этапам")
+    replay.add_argument('--fixtures', help="JSON-фикстура из сценария record; по умолчанию синтетические письма")
+    replay.add_argument('--count', type=int, default=300, help="Число синтетических писем")
+    replay.add_argument('--latency', type=float, default=0.02)
+    replay.add_argument('--llm-latency', type=float, default=0.1)
+    replay.add_argument('--gcs-latency', type=float, default=0.03)
+    replay.set_defaults(func=bench_replay)
+
+    asgi = subparsers.add_parser('asgi', help="Нагрузочный тест: одновременные запросы к синхронному обработчику и к asgi_app, single-flight")
+    asgi.add_argument('--requests', type=int, default=32)
+    asgi.add_argument('--emails', type=int, default=30)
+    asgi.add_argument('--max-emails', type=int, default=10)
+    asgi.add_argument('--threads', type=int, default=8)
+    asgi.add_argument('--overlap', type=int, default=5)
+    asgi.add_argument('--latency', type=float, default=0.05)
+    asgi.add_argument('--gcs-latency', type=float, default=0.03)
+    asgi.add_argument('--llm-latency', type=float, default=0.2)
+    asgi.set_defaults(func=bench_asgi)
+
+    stream = subparsers.add_parser('stream', help="Потоковый отчет (время до первой строки) и архив запусков с постраничной историей")
+    stream.add_argument('--emails', type=int, default=300)
+    stream.add_argument('--runs', type=int, default=5)
+    stream.add_argument('--per-run', type=int, default=50)
+    stream.add_argument('--page-size', type=int, default=2)
+    stream.add_argument('--latency', type=float, default=0.02)
+    stream.add_argument('--llm-latency', type=float, default=0.05)
+    stream.set_defaults(func=bench_stream)
+
+    record = subparsers.add_parser('record', help="Записать письма реального ящика в JSON-фикстуру для replay (только чтение)")
+    record.add_argument('--output', default='gmail_fixtures.json')
+    record.add_argument('--count', type=int, default=200)
+    record.add_argument('--query', default='in:inbox')
+    record.set_defaults(func=record_fixtures)
+    return parser
+
+
+if __name__ == '__main__':
+    parsed_args = build_parser().parse_args()
+    parsed_args.func(parsed_args)
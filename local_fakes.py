@@ -0,0 +1,428 @@
+# local_fakes.py
+# Локальные заглушки Google API и Gemini для офлайн-бенчмарков (без сети и без учетных данных).
+# Задержка latency имитирует один сетевой round trip: каждый execute() одиночного запроса
+# и каждый execute() batch-запроса "стоит" одну задержку.
+
+import base64
+import copy
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from google.cloud.exceptions import NotFound, PreconditionFailed
+
+FAKE_SENDER_DOMAINS = ["binance.com", "news.binance.com", "coinmarketcap.com", "tradingview.com", "email.heygen.com",
+                       "openai.com", "autodesk.com", "investing.com", "example.org", "friends.example.net"]
+FAKE_SUBJECTS = ["Weekly market update", "Claim now your free tokens", "New model release: GPT tools", "Fusion 360 toolpath tips",
+                 "Your portfolio dividend report", "Meeting notes", "Bitcoin and Ethereum news digest", "Invoice for March",
+                 "Airdrop alert: snapshot tomorrow", "Hello from the team"]
+
+
+class FakeBlob:
+    def __init__(self, client, bucket_name, name, metadata=None):
+        self._client = client
+        self._bucket_name = bucket_name
+        self.name = name
+        self.metadata = metadata # как у storage.Blob: задается до upload и сохраняется вместе с объектом
+        self.generation = None # заполняется после upload и reload
+
+    def _objects(self):
+        return self._client.objects.setdefault(self._bucket_name, {})
+
+    def _check_generation(self, if_generation_match):
+        # Предусловие GCS: 0 — объекта не должно быть, иначе его generation должна совпасть; вызывается под блокировкой клиента
+        if if_generation_match is None: return
+        current = self._client.object_generations.get((self._bucket_name, self.name), 1) if self.name in self._objects() else 0
+        if current != if_generation_match: raise PreconditionFailed(f"Precondition failed: {self._bucket_name}/{self.name}")
+
+    def reload(self):
+        self._client._round_trip()
+        with self._client._lock:
+            if self.name not in self._objects(): raise NotFound(f"No such object: {self._bucket_name}/{self.name}")
+            self.generation = self._client.object_generations.get((self._bucket_name, self.name), 1)
+
+    def exists(self, client=None):
+        self._client._round_trip()
+        with self._client._lock: return self.name in self._objects()
+
+    def download_as_bytes(self, if_generation_match=None):
+        self._client._round_trip()
+        with self._client._lock:
+            if self.name not in self._objects(): raise NotFound(f"No such object: {self._bucket_name}/{self.name}")
+            self._check_generation(if_generation_match)
+            return self._objects()[self.name]
+
+    def download_to_filename(self, filename):
+        data = self.download_as_bytes()
+        with open(filename, 'wb') as f: f.write(data)
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        self._client._round_trip()
+        with self._client._lock:
+            self._check_generation(if_generation_match)
+            self._objects()[self.name] = data.encode('utf-8') if isinstance(data, str) else bytes(data)
+            self._client.object_metadata.setdefault(self._bucket_name, {})[self.name] = dict(self.metadata) if self.metadata else None
+            self._client.generation_counter += 1
+            self.generation = self._client.object_generations[(self._bucket_name, self.name)] = self._client.generation_counter
+
+    def delete(self, if_generation_match=None):
+        self._client._round_trip()
+        with self._client._lock:
+            if self.name not in self._objects(): raise NotFound(f"No such object: {self._bucket_name}/{self.name}")
+            self._check_generation(if_generation_match)
+            del self._objects()[self.name]
+
+    def upload_from_filename(self, filename):
+        with open(filename, 'rb') as f: self.upload_from_string(f.read())
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self._client = client
+        self.name = name
+
+    def blob(self, name): return FakeBlob(self._client, self.name, name)
+
+
+class FakeStorageClient:
+    # Заглушка google.cloud.storage.Client: объекты хранятся в памяти, objects[бакет][путь] = bytes
+    def __init__(self, objects=None, latency=0.0):
+        self.objects = objects if objects is not None else {}
+        self.object_metadata = {}
+        self.object_generations = {} # (бакет, путь) -> generation; у объектов, заданных в objects напрямую, generation 1
+        self.generation_counter = 1
+        self.latency = latency
+        self.round_trips = 0
+        self._lock = threading.Lock()
+
+    def bucket(self, name): return FakeBucket(self, name)
+
+    def list_blobs(self, bucket_or_name, max_results=None, page_token=None, prefix=None):
+        return _FakeBlobIterator(self, getattr(bucket_or_name, 'name', bucket_or_name), prefix or '', max_results, page_token)
+
+    def _round_trip(self):
+        with self._lock: self.round_trips += 1
+        if self.latency: time.sleep(self.latency)
+
+
+class _FakeBlobIterator:
+    # Как HTTPIterator из google.api_core: одна страница за round trip в pages, после нее — next_page_token.
+    # Объекты в лексикографическом порядке имен; токен — имя последнего объекта страницы.
+    def __init__(self, client, bucket_name, prefix, max_results, page_token):
+        self._client = client
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+        self._max_results = max_results
+        self._page_token = page_token
+        self.next_page_token = None
+
+    @property
+    def pages(self):
+        self._client._round_trip()
+        with self._client._lock:
+            names = sorted(name for name in self._client.objects.get(self._bucket_name, {}) if name.startswith(self._prefix) and (not self._page_token or name > self._page_token))
+            metadata = self._client.object_metadata.get(self._bucket_name, {})
+            page = names[:self._max_results] if self._max_results else names
+            blobs = [FakeBlob(self._client, self._bucket_name, name, metadata.get(name)) for name in page]
+        self.next_page_token = page[-1] if len(page) < len(names) else None
+        yield blobs
+
+
+class FakeHttpError(Exception):
+    # Повторяет интерфейс googleapiclient.errors.HttpError: статус лежит в resp.status
+    def __init__(self, status, message=''):
+        super().__init__(message or f"HTTP {status}")
+        self.resp = type('FakeResponse', (), {'status': status})()
+
+
+def _b64(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def make_fake_message(index, rng=None, unread=True):
+    rng = rng or random
+    domain = rng.choice(FAKE_SENDER_DOMAINS)
+    subject = f"{rng.choice(FAKE_SUBJECTS)} #{index}"
+    text = f"Hello! This is message number {index} from {domain}.\n" + "Lorem ipsum dolor sit amet. " * rng.randint(5, 60)
+    headers = [{'name': 'Subject', 'value': subject}, {'name': 'From', 'value': f"News <news@{domain}>"},
+               {'name': 'Date', 'value': 'Mon, 1 Jan 2024 10:00:00 +0000'}]
+    if rng.random() < 0.5:
+        payload = {'mimeType': 'multipart/alternative', 'headers': headers, 'parts': [
+            {'mimeType': 'text/plain', 'body': {'data': _b64(text)}},
+            {'mimeType': 'text/html', 'body': {'data': _b64(f"<html><body><p>{text}</p></body></html>")}}]}
+    else:
+        payload = {'mimeType': 'text/html', 'headers': headers,
+                   'body': {'data': _b64(f"<html><head><style>p{{color:red}}</style></head><body><div><p>{text}</p></div></body></html>")}}
+    return {'id': f"msg{index:08d}", 'threadId': f"thr{index:08d}", 'labelIds': ['INBOX', 'UNREAD'] if unread else ['INBOX'],
+            'snippet': text[:100], 'payload': payload}
+
+
+def generate_fake_messages(count, seed=42, unread=True):
+    rng = random.Random(seed)
+    return [make_fake_message(i, rng, unread=unread) for i in range(count)]
+
+
+class _FakeRequest:
+    def __init__(self, service, func):
+        self._service = service
+        self._func = func
+
+    def execute(self):
+        self._service._round_trip()
+        return self._func()
+
+
+class FakeBatchHttpRequest:
+    def __init__(self, service, callback=None):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if len(self._requests) >= FakeGmailService.MAX_BATCH_SIZE:
+            raise ValueError(f"Batch не может содержать больше {FakeGmailService.MAX_BATCH_SIZE} запросов")
+        request_id = request_id if request_id is not None else str(len(self._requests) + 1)
+        self._requests.append((request_id, request, callback or self._callback))
+
+    def execute(self):
+        self._service._round_trip()
+        for request_id, request, callback in self._requests:
+            try: response, exception = request._func(), None
+            except Exception as e: response, exception = None, e
+            if callback: callback(request_id, response, exception)
+
+
+class _FakeMessages:
+    def __init__(self, service):
+        self._service = service
+
+    def list(self, userId, q=None, maxResults=100, pageToken=None, **kwargs):
+        return _FakeRequest(self._service, lambda: self._service._list(q, maxResults, pageToken))
+
+    def get(self, userId, id, format='full', **kwargs):
+        return _FakeRequest(self._service, lambda: self._service._get(id, format))
+
+    def modify(self, userId, id, body):
+        return _FakeRequest(self._service, lambda: self._service._modify([id], body))
+
+    def batchModify(self, userId, body):
+        if len(body.get('ids', [])) > FakeGmailService.MAX_BATCH_MODIFY_IDS:
+            raise ValueError(f"batchModify принимает не больше {FakeGmailService.MAX_BATCH_MODIFY_IDS} ids")
+        return _FakeRequest(self._service, lambda: self._service._modify(body.get('ids', []), body) and None)
+
+
+class _FakeLabels:
+    def __init__(self, service):
+        self._service = service
+
+    def get(self, userId, id):
+        return _FakeRequest(self._service, lambda: self._service._label(id))
+
+
+class _FakeHistory:
+    def __init__(self, service):
+        self._service = service
+
+    def list(self, userId, startHistoryId, historyTypes=None, pageToken=None, maxResults=100, **kwargs):
+        return _FakeRequest(self._service, lambda: self._service._history_list(int(startHistoryId), pageToken, maxResults))
+
+
+class _FakeUsers:
+    def __init__(self, service):
+        self._service = service
+
+    def messages(self): return _FakeMessages(self._service)
+
+    def labels(self): return _FakeLabels(self._service)
+
+    def history(self): return _FakeHistory(self._service)
+
+    def getProfile(self, userId):
+        return _FakeRequest(self._service, lambda: {'emailAddress': 'me@example.com', 'historyId': str(self._service.history_id)})
+
+
+class FakeGmailService:
+    # Поддерживает подмножество Gmail API v1, которое использует main.py.
+    MAX_BATCH_SIZE = 100
+    MAX_BATCH_MODIFY_IDS = 1000
+
+    def __init__(self, messages=(), latency=0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self._lock = threading.Lock()
+        self._messages = OrderedDict((m['id'], copy.deepcopy(m)) for m in messages)
+        # Журнал истории: (historyId, id письма, labelIds на момент добавления); письма из конструктора — до начала журнала
+        self.history_id = 1000 + len(self._messages)
+        self.oldest_history_id = self.history_id
+        self._history = []
+
+    def add_message(self, message):
+        with self._lock:
+            self.history_id += 1
+            self._messages[message['id']] = copy.deepcopy(message)
+            self._history.append((self.history_id, message['id'], list(message['labelIds'])))
+
+    def expire_history(self):
+        # Имитирует устаревание истории: запросы со старым startHistoryId получат 404
+        with self._lock:
+            self._history = []
+            self.oldest_history_id = self.history_id
+
+    def users(self): return _FakeUsers(self)
+
+    def new_batch_http_request(self, callback=None): return FakeBatchHttpRequest(self, callback)
+
+    def _round_trip(self):
+        with self._lock: self.round_trips += 1
+        if self.latency: time.sleep(self.latency)
+
+    def _list(self, query, max_results, page_token):
+        # nextPageToken — курсор (ID последнего письма страницы), а не смещение: пометка прочитанными уже
+        # выданных писем не сдвигает следующие страницы, как и в настоящем Gmail API
+        with self._lock:
+            ids = [m_id for m_id, m in self._messages.items() if query != 'is:unread' or 'UNREAD' in m['labelIds']]
+            order = {m_id: position for position, m_id in enumerate(self._messages)}
+        if page_token: ids = [m_id for m_id in ids if order[m_id] > order[page_token]]
+        page = ids[:min(max_results or 100, 500)]
+        response = {'resultSizeEstimate': len(ids)}
+        if page: response['messages'] = [{'id': m_id, 'threadId': self._messages[m_id]['threadId']} for m_id in page]
+        if len(page) < len(ids): response['nextPageToken'] = page[-1]
+        return response
+
+    def _get(self, msg_id, fmt):
+        with self._lock:
+            if msg_id not in self._messages: raise FakeHttpError(404, f"Message {msg_id} not found")
+            message = copy.deepcopy(self._messages[msg_id])
+        if fmt == 'metadata':
+            payload = message['payload']
+            message['payload'] = {'mimeType': payload.get('mimeType'), 'headers': payload.get('headers', [])}
+        return message
+
+    def _modify(self, msg_ids, body):
+        with self._lock:
+            for msg_id in msg_ids:
+                if msg_id not in self._messages: raise FakeHttpError(404, f"Message {msg_id} not found")
+                labels = self._messages[msg_id]['labelIds']
+                for label in body.get('removeLabelIds', []):
+                    if label in labels: labels.remove(label)
+                for label in body.get('addLabelIds', []):
+                    if label not in labels: labels.append(label)
+        return {}
+
+    def _history_list(self, start_history_id, page_token, max_results):
+        with self._lock:
+            if start_history_id < self.oldest_history_id: raise FakeHttpError(404, f"Requested entity was not found (historyId {start_history_id})")
+            records = [r for r in self._history if r[0] > start_history_id]
+            current_history_id = self.history_id
+        start = int(page_token or 0)
+        page = records[start:start + max_results]
+        response = {'historyId': str(current_history_id)}
+        if page: response['history'] = [{'id': str(h_id), 'messagesAdded': [{'message': {'id': m_id, 'threadId': m_id, 'labelIds': labels}}]} for h_id, m_id, labels in page]
+        if start + len(page) < len(records): response['nextPageToken'] = str(start + len(page))
+        return response
+
+    def _label(self, label_id):
+        with self._lock:
+            count = sum(1 for m in self._messages.values() if label_id in m['labelIds'])
+        return {'id': label_id, 'messagesTotal': count, 'messagesUnread': count if label_id == 'UNREAD' else 0}
+
+    def unread_count(self):
+        return self._label('UNREAD')['messagesUnread']
+
+
+class FakeLLMError(Exception):
+    # Как исключения google.api_core: HTTP-код в атрибуте code
+    def __init__(self, code, message=''):
+        super().__init__(message or f"Fake Gemini error {code}")
+        self.code = code
+
+
+class _FakePart:
+    def __init__(self, text): self.text = text
+
+
+class _FakeContent:
+    def __init__(self, text): self.parts = [_FakePart(text)]
+
+
+class _FakeCandidate:
+    def __init__(self, text): self.content = _FakeContent(text)
+
+
+class _FakeUsageMetadata:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeGenerationResponse:
+    def __init__(self, text, prompt_tokens=0):
+        self.candidates = [_FakeCandidate(text)]
+        self.text = text
+        self.usage_metadata = _FakeUsageMetadata(prompt_tokens, len(text) // 4 + 1)
+
+
+_BATCH_EMAIL_RE = re.compile(r'<email id="([^"]+)">\n(.*?)\n</email>', re.S)
+
+
+class FakeGenerativeModel:
+    # Заглушка vertexai GenerativeModel: задержка на каждый вызов и случайные ошибки с кодами error_codes.
+    # Запрос с response_mime_type application/json (пакетный промпт) получает JSON {id письма: резюме}; доля записей
+    # batch_drop_rate пропускается, а с вероятностью batch_malformed_rate ответ вообще не JSON — для проверки отката по одному.
+    def __init__(self, latency=0.0, error_rate=0.0, error_codes=(429, 503), seed=0, batch_drop_rate=0.0, batch_malformed_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.batch_drop_rate = batch_drop_rate
+        self.batch_malformed_rate = batch_malformed_rate
+        self.calls = 0
+        self.batch_calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.errors = 0
+        self.peak_concurrency = 0
+        self._in_flight = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self._in_flight += 1
+            self.peak_concurrency = max(self.peak_concurrency, self._in_flight)
+            fail = self._rng.random() < self.error_rate
+            error_code = self._rng.choice(self.error_codes) if fail else None
+            if fail: self.errors += 1
+        try:
+            if self.latency: time.sleep(self.latency)
+            if error_code: raise FakeLLMError(error_code)
+            if (generation_config or {}).get('response_mime_type') == 'application/json': text = self.summarize_batch(prompt)
+            else: text = self.summarize(prompt)
+            response = FakeGenerationResponse(text, prompt_tokens=len(prompt) // 4 + 1)
+            with self._lock:
+                self.prompt_tokens += response.usage_metadata.prompt_token_count
+                self.output_tokens += response.usage_metadata.candidates_token_count
+            return response
+        finally:
+            with self._lock: self._in_flight -= 1
+
+    @staticmethod
+    def summary_for(body):
+        # Детерминированное "резюме": первые слова текста письма
+        return "Резюме: " + " ".join(body.split()[:8])
+
+    def summarize(self, prompt):
+        body = prompt.split('---', 2)[1] if prompt.count('---') >= 2 else prompt
+        return self.summary_for(body)
+
+    def summarize_batch(self, prompt):
+        with self._lock:
+            self.batch_calls += 1
+            malformed = self._rng.random() < self.batch_malformed_rate
+            emails = [(key, body) for key, body in _BATCH_EMAIL_RE.findall(prompt) if self._rng.random() >= self.batch_drop_rate]
+        if malformed: return "Извините, не могу вернуть JSON."
+        return json.dumps({key: self.summary_for(body) for key, body in emails}, ensure_ascii=False)
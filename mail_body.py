@@ -0,0 +1,136 @@
+# mail_body.py
+# Извлечение текста письма для суммирования: рекурсивный обход MIME-дерева Gmail API, декодирование только
+# первых max_bytes каждой части и быстрый потоковый HTML -> текст на регулярных выражениях вместо полного
+# разбора BeautifulSoup. Разбор останавливается, как только набрано max_chars символов текста.
+
+import base64
+import binascii
+import email
+import email.policy
+import html
+import re
+
+from pipeline_metrics import span
+
+METADATA_HEADERS = ['Subject', 'From', 'Date'] # заголовки, которые запрашивает format=metadata
+
+_CHARSET_RE = re.compile(r'charset\s*=\s*"?([\w.:-]+)', re.I)
+# Комментарии и блоки, текст которых не нужен (script/style/title...), а также любые теги. Незакрытый блок
+# поглощает остаток документа: обрезанный по max_bytes HTML часто обрывается посреди <style>. <head> целиком не пропускаем:
+# HTML5 разрешает не закрывать его, и тогда он поглотил бы тело письма; его текстовое содержимое — title, style, script.
+_HTML_MARKUP_RE = re.compile(r'<!--.*?(?:-->|$)|<(script|style|title|noscript|template|svg)\b.*?(?:</\1\s*>|$)|</?[a-zA-Z!?][^>]*>?', re.S | re.I)
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def decode_base64url_prefix(data, max_bytes=None):
+    # Декодируем только префикс base64: каждые 4 символа дают 3 байта
+    if max_bytes is not None:
+        base64_chars = (max_bytes + 2) // 3 * 4
+        data = data[:base64_chars]
+    decoded = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    return decoded if max_bytes is None else decoded[:max_bytes]
+
+
+def _header_value(part, name):
+    name = name.lower()
+    for header in part.get('headers', []):
+        if header.get('name', '').lower() == name: return header.get('value', '')
+    return ''
+
+
+def _part_charset(part):
+    match = _CHARSET_RE.search(_header_value(part, 'Content-Type'))
+    return match.group(1) if match else 'utf-8'
+
+
+def _decode_text(data, charset):
+    try: return data.decode(charset, errors='replace')
+    except LookupError: return data.decode('utf-8', errors='replace')
+
+
+def _is_attachment(part):
+    return bool(part.get('filename')) or _header_value(part, 'Content-Disposition').lower().startswith('attachment')
+
+
+def iter_leaf_parts(payload):
+    # Обход в глубину: multipart/alternative внутри multipart/mixed и т.п. Вложения пропускаются.
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get('parts')
+        if children: stack.extend(reversed(children))
+        elif not _is_attachment(part): yield part
+
+
+def find_text_parts(payload):
+    plain_part = html_part = None
+    for part in iter_leaf_parts(payload):
+        if not part.get('body', {}).get('data'): continue # большие тела приходят как attachmentId, их не тянем
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type == 'text/plain' and plain_part is None: plain_part = part
+        elif mime_type == 'text/html' and html_part is None: html_part = part
+        if plain_part is not None: break
+    return plain_part, html_part
+
+
+def _append_text(pieces, segment, total):
+    text = _WHITESPACE_RE.sub(' ', html.unescape(segment)).strip() if segment and not segment.isspace() else ''
+    if text: pieces.append(text); total += len(text) + 1
+    return total
+
+
+def html_to_text(html_text, max_chars=None):
+    # Аналог BeautifulSoup(...).get_text(separator='\n', strip=True) без построения дерева: текстовые узлы между тегами
+    # через перевод строки, без содержимого script/style/title. Останавливается после max_chars символов.
+    pieces = []
+    total = 0
+    position = 0
+    for match in _HTML_MARKUP_RE.finditer(html_text):
+        total = _append_text(pieces, html_text[position:match.start()], total)
+        position = match.end()
+        if max_chars is not None and total >= max_chars: break
+    else: _append_text(pieces, html_text[position:], total)
+    text = '\n'.join(pieces)
+    return text if max_chars is None else text[:max_chars]
+
+
+def extract_body_text(payload, max_bytes=None, max_chars=None):
+    # Текст письма из payload формата full: text/plain, иначе text/html. Пустая строка, если текстовых частей нет.
+    plain_part, html_part = find_text_parts(payload)
+    part = plain_part or html_part
+    if part is None: return ''
+    text = _decode_text(decode_base64url_prefix(part['body']['data'], max_bytes), _part_charset(part))
+    if part is html_part:
+        with span('html_parse'): return html_to_text(text, max_chars)
+    return text if max_chars is None else text[:max_chars]
+
+
+def decode_part_prefix(part, max_bytes=None):
+    # Первые max_bytes тела части email.message: закодированный payload обрезается до декодирования, а не после
+    if max_bytes is None: return part.get_payload(decode=True) or b''
+    payload = part.get_payload(decode=False)
+    if not isinstance(payload, str): return b''
+    encoding = part.get('Content-Transfer-Encoding', '').strip().lower()
+    base64_chars = (max_bytes + 2) // 3 * 4
+    try:
+        if encoding == 'base64':
+            # В MIME base64 разбит на строки: берем с запасом на переводы строк, затем ровно base64_chars символов
+            data = ''.join(payload[:base64_chars * 2].split())[:base64_chars]
+            return binascii.a2b_base64(data[:len(data) // 4 * 4])[:max_bytes]
+        if encoding == 'quoted-printable': return binascii.a2b_qp(payload[:max_bytes * 3])[:max_bytes] # =XX — до трех символов на байт
+        return payload[:max_bytes].encode('ascii', 'surrogateescape') # 7bit/8bit: байты вне ASCII хранятся как surrogateescape
+    except (binascii.Error, UnicodeEncodeError): return (part.get_payload(decode=True) or b'')[:max_bytes]
+
+
+def parse_raw_message(raw_bytes, max_bytes=None, max_chars=None):
+    # Разбор исходного RFC 822 письма (format='raw' или файл .eml) в те же поля, что и parse_email_message в main.py
+    message = email.message_from_bytes(raw_bytes, policy=email.policy.default)
+    email_data = {'subject': str(message.get('Subject', '')), 'from': str(message.get('From', '')), 'date': str(message.get('Date', '')), 'body': ''}
+    plain_part = message.get_body(preferencelist=('plain',))
+    part = plain_part or message.get_body(preferencelist=('html',))
+    if part is not None:
+        text = _decode_text(decode_part_prefix(part, max_bytes), part.get_content_charset() or 'utf-8')
+        if part is plain_part: email_data['body'] = text if max_chars is None else text[:max_chars]
+        else:
+            with span('html_parse'): email_data['body'] = html_to_text(text, max_chars)
+    return email_data
@@ -2,19 +2,35 @@
 
 import os
 import pickle
-import base64
+import json
+import hashlib
+import math
+import posixpath
 import re 
-from datetime import datetime 
+import time
+import random
+import threading
+import contextvars
+import asyncio
+import functools
+import socket
+import tempfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
 import html 
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials 
 from googleapiclient.discovery import build
 from google.cloud import storage
-from bs4 import BeautifulSoup # Для извлечения текста из HTML
+from google.cloud.exceptions import NotFound, PreconditionFailed
 
-import vertexai
-from vertexai.generative_models import GenerativeModel
+from mail_body import METADATA_HEADERS, decode_base64url_prefix, extract_body_text, parse_raw_message
+from run_archive import RunArchiveWriter, archive_blob_name, is_archive_blob_name, new_run_id, read_archive
+from pipeline_metrics import PROCESS_METRICS, begin_run, end_run, increment, iter_in_context, observe, span, submit_with_context
+from summary_cache import create_summary_cache, normalize_email_text
 
 # --- Конфигурация Gmail Агента и Google Cloud ---
 # Эти значения будут в первую очередь браться из переменных окружения Cloud Run.
@@ -23,9 +39,31 @@ BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME', 'gmailaiagent-id-gmail-agent-fil
 TOKEN_PICKLE_GCS_PATH = os.environ.get('TOKEN_PICKLE_GCS_PATH', 'gmail_tokens/token.pickle')
 CLIENT_SECRET_GCS_PATH = os.environ.get('CLIENT_SECRET_GCS_PATH', 'gmail_tokens/client_secret_desktop.json')
 
+# Состояние инкрементальной синхронизации (SYNC_MODE=history) хранится рядом с токеном
+SYNC_MODE = os.environ.get('SYNC_MODE', 'query') # query — is:unread при каждом запуске, history — только новые письма по historyId
+SYNC_STATE_GCS_PATH = os.environ.get('SYNC_STATE_GCS_PATH', posixpath.join(posixpath.dirname(TOKEN_PICKLE_GCS_PATH), 'sync_state.json'))
+TEMP_SYNC_STATE_PATH = '/tmp/sync_state.json'
+SYNC_PROCESSED_IDS_LIMIT = 5000 # Сколько последних обработанных ID помнить для идемпотентных перезапусков
+SYNC_RESYNC_MAX_IDS = 10000 # Максимум непрочитанных, которые ставятся в очередь при полной ресинхронизации
+
+# Многоящичный режим: манифест в GCS со списком токенов, аккаунты обрабатываются параллельно
+MULTI_ACCOUNT_MODE = os.environ.get('MULTI_ACCOUNT_MODE', '0') == '1' # Либо ?mode=multi в запросе
+ACCOUNTS_MANIFEST_GCS_PATH = os.environ.get('ACCOUNTS_MANIFEST_GCS_PATH', 'gmail_tokens/accounts.json')
+TEMP_ACCOUNTS_MANIFEST_PATH = '/tmp/accounts.json'
+MULTI_ACCOUNT_MAX_WORKERS = int(os.environ.get('MULTI_ACCOUNT_MAX_WORKERS', '8'))
+
+# --- Архив запусков: каждый запуск — gzip JSONL в GCS, история на /history ---
+RUN_ARCHIVE_ENABLED = os.environ.get('RUN_ARCHIVE_ENABLED', '1') == '1'
+RUN_ARCHIVE_GCS_PREFIX = os.environ.get('RUN_ARCHIVE_GCS_PREFIX', 'gmail_agent_state/runs')
+TEMP_RUN_ARCHIVE_DIR = '/tmp'
+RUN_HISTORY_PAGE_SIZE = 20
+RUN_HISTORY_MAX_PAGE_SIZE = 100
+
 SCOPES = ['https://mail.google.com/'] 
 TEMP_TOKEN_PATH = '/tmp/token.pickle'
 TEMP_CLIENT_SECRET_PATH = '/tmp/client_secret.json'
+CREDENTIALS_REFRESH_MARGIN_SECONDS = 300 # Обновляем токен заранее, чтобы он не истек посреди запуска
+PREWARM_CLIENTS = os.environ.get('PREWARM_CLIENTS', '0') == '1' # Инициализировать GCS и Gemini в фоне при импорте (включено в Dockerfile)
 
 # --- Конфигурация для Vertex AI Gemini ---
 # Предпочтительно устанавливать через переменные окружения в Cloud Run.
@@ -33,8 +71,47 @@ TEMP_CLIENT_SECRET_PATH = '/tmp/client_secret.json'
 GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "gmailaiagent-458710") 
 GCP_REGION = os.environ.get("GCP_REGION", "us-central1")
 GEMINI_MODEL_NAME = "gemini-1.5-flash-001"
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "4")) # Одновременных запросов к Gemini
+GEMINI_REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "60")) # 0 — без ограничения
+GEMINI_TOKENS_PER_MINUTE = int(os.environ.get("GEMINI_TOKENS_PER_MINUTE", "200000")) # 0 — без ограничения
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", "4")) # Повторов на 429/503
+GEMINI_RETRY_BASE_DELAY = 1.0 # Секунд, удваивается с каждой попыткой
+SUMMARY_MAX_CHARS = 25000
+SUMMARY_GENERATION_CONFIG = {"max_output_tokens": 150, "temperature": 0.3, "top_p": 0.95}
+SUMMARY_PROMPT_VERSION = "v1" # Увеличивайте при изменении build_summary_prompt/build_batch_summary_prompt — старые записи кэша перестанут совпадать
+# Пакетный режим: короткие письма (уведомления, рассылки) уходят в Gemini по несколько в одном запросе с JSON-ответом,
+# чтобы длинный системный промпт с примерами оплачивался один раз на пакет, а не на каждое письмо
+SUMMARY_BATCH_ENABLED = os.environ.get("SUMMARY_BATCH_ENABLED", "1") == "1"
+SUMMARY_BATCH_TOKEN_BUDGET = int(os.environ.get("SUMMARY_BATCH_TOKEN_BUDGET", "6000")) # Оценка входных токенов на один пакетный запрос
+SUMMARY_BATCH_MAX_EMAILS = int(os.environ.get("SUMMARY_BATCH_MAX_EMAILS", "20"))
+SUMMARY_BATCH_EMAIL_MAX_CHARS = int(os.environ.get("SUMMARY_BATCH_EMAIL_MAX_CHARS", "4000")) # Письма длиннее суммируются отдельным запросом
+
+# --- Кэш резюме ---
+SUMMARY_CACHE_BACKEND = os.environ.get("SUMMARY_CACHE_BACKEND", "memory") # none, memory, sqlite, gcs
+SUMMARY_CACHE_TTL_SECONDS = int(os.environ.get("SUMMARY_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+SUMMARY_CACHE_MAX_ENTRIES = int(os.environ.get("SUMMARY_CACHE_MAX_ENTRIES", "5000"))
+SUMMARY_CACHE_SQLITE_PATH = os.environ.get("SUMMARY_CACHE_SQLITE_PATH", "/tmp/summary_cache.sqlite3")
+SUMMARY_CACHE_GCS_PATH = os.environ.get("SUMMARY_CACHE_GCS_PATH", "gmail_agent_state/summary_cache.json")
+SUMMARY_CACHE_NEAR_DUPLICATE_DISTANCE = int(os.environ.get("SUMMARY_CACHE_NEAR_DUPLICATE_DISTANCE", "0")) # Порог SimHash в битах, 0 — только точные совпадения
 
-MAX_EMAILS_TO_PROCESS = 5 
+MAX_EMAILS_TO_PROCESS = int(os.environ.get('MAX_EMAILS_TO_PROCESS', '5')) # За обычный запуск; переопределяется параметром ?max_emails=
+DRAIN_DEADLINE_SECONDS = float(os.environ.get('DRAIN_DEADLINE_SECONDS', '240')) # Бюджет режима разбора очереди (?mode=drain или ?deadline_seconds=)
+DRAIN_CHUNK_SIZE = int(os.environ.get('DRAIN_CHUNK_SIZE', '25')) # Писем в блоке: после каждого блока пометка прочитанными и контрольная точка
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get('REQUEST_TIMEOUT_SECONDS', '300')) # Таймаут запроса сервиса Cloud Run
+DRAIN_SAFETY_MARGIN_SECONDS = 20 # Запас до таймаута на пометку прочитанными, сохранение состояния и отчет
+MAILBOX_LEASE_ENABLED = os.environ.get('MAILBOX_LEASE_ENABLED', '1') == '1' # Аренда ящика в GCS; без нее single-flight только в пределах процесса
+MAILBOX_LEASE_SECONDS = REQUEST_TIMEOUT_SECONDS + 60 # Аренду упавшего экземпляра можно перехватить после таймаута запроса
+ASYNC_BLOCKING_THREADS = int(os.environ.get('ASYNC_BLOCKING_THREADS', '64')) # Потоков для блокирующих клиентов в asgi_app (на процесс)
+ASYNC_STAGE_QUEUE_SIZE = int(os.environ.get('ASYNC_STAGE_QUEUE_SIZE', '2')) # Блоков в очереди между этапами асинхронного конвейера
+GMAIL_BATCH_SIZE = int(os.environ.get('GMAIL_BATCH_SIZE', '50')) # Gmail API допускает до 100 запросов в batch, но рекомендует не больше 50
+GMAIL_BATCH_MAX_ATTEMPTS = 3
+GMAIL_LIST_PAGE_SIZE = 500 # Максимум maxResults для messages().list
+GMAIL_BATCH_MODIFY_LIMIT = 1000 # Максимум ids для messages().batchModify
+# Единственный переключатель format для messages().get, общий для всего запуска: full — MIME-дерево с телами частей,
+# raw — исходное RFC 822 письмо (тело разбирает mail_body.parse_raw_message), metadata — только заголовки, резюме по snippet
+EMAIL_FETCH_FORMAT = os.environ.get('EMAIL_FETCH_FORMAT', 'full')
+MAIL_BODY_MAX_BYTES = int(os.environ.get('MAIL_BODY_MAX_BYTES', str(512 * 1024))) # Сколько байт тела письма декодировать
+MAIL_RAW_HEADERS_MAX_BYTES = 64 * 1024 # format=raw: сколько байт сверх MAIL_BODY_MAX_BYTES декодировать на заголовки и MIME-разметку
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
 # --- Правила Категоризации ---
@@ -57,156 +134,543 @@ CATEGORIZATION_RULES = [
     {"name": "Stock market/brokers", "senders_domains": stock_combined_domains, "subject_keywords": ["earnings report", "market update", "s&p500", "nasdaq", "portfolio", "dividend", "analyst rating", "buy/sell alert", "etf", "stock analysis"]}
 ]
 
+DEFAULT_CATEGORY = "Прочие письма и адресаты"
+
+_DOMAIN_RE = re.compile(r"@([\w.-]+)")
+
 def extract_domain(email_address):
     if not email_address: return ""
-    match = re.search(r"@([\w.-]+)", email_address)
+    match = _DOMAIN_RE.search(email_address)
     return match.group(1).lower() if match else ""
 
+def _keyword_trie_pattern(keywords):
+    # Регулярное выражение в виде префиксного дерева: "claim(?:able| now)?" вместо перебора альтернатив по одной.
+    # Жадные необязательные группы дают самое длинное ключевое слово, начинающееся в данной позиции.
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for ch in keyword: node = node.setdefault(ch, {})
+        node[''] = {}
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches: return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+    return build(trie)
+
+class CompiledCategorizer:
+    # Собирается один раз при импорте. Приоритет правил тот же, что у линейного прохода по CATEGORIZATION_RULES:
+    # побеждает первое правило, у которого совпал домен отправителя или ключевое слово в теме.
+    def __init__(self, rules, default_category=DEFAULT_CATEGORY):
+        self.category_names = [rule["name"] for rule in rules]
+        self.default_category = default_category
+        # Домен -> индекс самого приоритетного правила; поддомены ищутся по родительским доменам (news.binance.com -> binance.com)
+        self._domain_index = {}
+        keyword_rule = {}
+        for rule_index, rule in enumerate(rules):
+            for domain in rule.get("senders_domains") or []: self._domain_index.setdefault(domain.lower(), rule_index)
+            for keyword in rule.get("subject_keywords") or []: keyword_rule.setdefault(keyword.lower(), rule_index)
+        # Автомат находит в каждой позиции только самое длинное слово, поэтому для него заранее берем минимум
+        # по всем ключевым словам, которые являются его префиксами ("airdrop alert" -> min("airdrop", "airdrop alert")).
+        self._keyword_best_rule = {keyword: min(rule_index for prefix, rule_index in keyword_rule.items() if keyword.startswith(prefix)) for keyword in keyword_rule}
+        self._keywords_re = re.compile(f"(?=({_keyword_trie_pattern(keyword_rule)}))") if keyword_rule else None
+
+    def domain_rule(self, sender_domain):
+        best = None
+        labels = sender_domain.split('.')
+        for i in range(len(labels) - 1):
+            rule_index = self._domain_index.get('.'.join(labels[i:]))
+            if rule_index is not None and (best is None or rule_index < best): best = rule_index
+        return best
+
+    def subject_rule(self, subject_lower, stop_at=None):
+        # stop_at — индекс уже найденного правила по домену: менее приоритетные совпадения в теме не нужны
+        best = stop_at
+        if self._keywords_re is None: return best
+        for match in self._keywords_re.finditer(subject_lower):
+            rule_index = self._keyword_best_rule[match.group(1)]
+            if best is None or rule_index < best:
+                best = rule_index
+                if best == 0: break
+        return best
+
+    def categorize(self, sender, subject, domain_rules_cache=None):
+        sender_domain = extract_domain(sender)
+        if domain_rules_cache is None: rule_index = self.domain_rule(sender_domain) if sender_domain else None
+        elif sender_domain in domain_rules_cache: rule_index = domain_rules_cache[sender_domain]
+        else: rule_index = domain_rules_cache[sender_domain] = self.domain_rule(sender_domain) if sender_domain else None
+        if rule_index != 0: rule_index = self.subject_rule(subject.lower(), rule_index)
+        return self.default_category if rule_index is None else self.category_names[rule_index]
+
+    def categorize_batch(self, emails_details):
+        # Пакетный режим для архивов: домены отправителей сильно повторяются, поэтому разбор домена кэшируется на весь пакет
+        domain_rules_cache = {}
+        return [self.categorize(email_details.get('from', ''), email_details.get('subject', ''), domain_rules_cache) for email_details in emails_details]
+
+CATEGORIZER = CompiledCategorizer(CATEGORIZATION_RULES)
+
+class ServiceContainer:
+    # Клиенты, которые создаются лениво один раз на процесс (gunicorn-воркер) и переиспользуются между запросами:
+    # storage.Client, учетные данные Gmail (обновляются только перед истечением), сервис Gmail API и модели Gemini.
+    # Сервис Gmail на httplib2 не потокобезопасен: один и тот же токен не должен обрабатываться из нескольких потоков сразу.
+    def __init__(self, storage_client_factory=None, gmail_builder=None, model_factory=None):
+        self._storage_client_factory = storage_client_factory or storage.Client
+        self._gmail_builder = gmail_builder or _build_gmail_service
+        self._model_factory = model_factory or _create_gemini_model
+        # Отдельные блокировки: долгая инициализация модели в фоне не должна задерживать загрузку токена
+        self._storage_lock = threading.Lock()
+        self._gmail_locks_lock = threading.Lock()
+        self._gmail_locks = {} # путь токена -> Lock: разные аккаунты загружают токены параллельно
+        self._models_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._storage_client = None
+        self._gmail = {} # путь токена в GCS -> (creds, service)
+        self._models = {}
+
+    def storage_client(self):
+        with self._storage_lock:
+            if self._storage_client is None: self._storage_client = self._storage_client_factory()
+            return self._storage_client
+
+    def gmail_service(self, token_gcs_path=None):
+        token_gcs_path = token_gcs_path or TOKEN_PICKLE_GCS_PATH
+        with self._gmail_locks_lock: token_lock = self._gmail_locks.setdefault(token_gcs_path, threading.Lock())
+        with token_lock:
+            cached = self._gmail.get(token_gcs_path)
+            if cached and not _credentials_need_refresh(cached[0]): return cached[1]
+            creds = cached[0] if cached else load_gmail_credentials(token_gcs_path)
+            if creds is None: return None
+            if _credentials_need_refresh(creds) and not refresh_gmail_credentials(creds, token_gcs_path):
+                self._gmail.pop(token_gcs_path, None)
+                return None
+            if cached: return cached[1] # сервис держит ссылку на тот же объект creds, пересоздавать не нужно
+            try:
+                service = self._gmail_builder(creds)
+                print("Успешно создан сервис Gmail API!")
+            except Exception as e:
+                print(f"Ошибка при создании Gmail API service: {e}")
+                return None
+            self._gmail[token_gcs_path] = (creds, service)
+            return service
+
+    def gemini_model(self, project_id, location, model_name):
+        key = (project_id, location, model_name)
+        with self._models_lock:
+            if key not in self._models: self._models[key] = self._model_factory(project_id, location, model_name)
+            return self._models[key]
+
+    def warm_up_async(self, project_id, location, model_name):
+        # Фоновая инициализация при старте воркера: первый запрос грузит письма, пока импортируется vertexai
+        def warm_up():
+            try:
+                self.storage_client()
+                self.gemini_model(project_id, location, model_name)
+                print("Клиенты GCS и Gemini инициализированы заранее.")
+            except Exception as e: print(f"Предварительная инициализация клиентов не удалась: {e}")
+        thread = threading.Thread(target=warm_up, name='services-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+def _build_gmail_service(creds):
+    # static_discovery: документ discovery берется из копии внутри google-api-python-client, без сетевого запроса
+    return build('gmail', 'v1', credentials=creds, cache_discovery=False, static_discovery=True)
+
+def _credentials_need_refresh(creds):
+    if not creds.valid: return True
+    # creds.expiry — наивное время в UTC
+    return creds.expiry is not None and creds.expiry - datetime.utcnow() < timedelta(seconds=CREDENTIALS_REFRESH_MARGIN_SECONDS)
+
 def download_from_gcs(bucket_name, source_blob_name, destination_file_name):
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(source_blob_name)
-        if not blob.exists(storage_client):
+        blob = SERVICES.storage_client().bucket(bucket_name).blob(source_blob_name)
+        try:
+            with span('gcs_download', blob=source_blob_name): blob.download_to_filename(destination_file_name) # без отдельного exists(): на один round trip меньше
+        except NotFound:
             print(f"Файл {source_blob_name} не найден в бакете {bucket_name}.")
             return False
-        blob.download_to_filename(destination_file_name)
         print(f"Файл {source_blob_name} загружен из GCS в {destination_file_name}")
         return True
     except Exception as e:
         print(f"Ошибка при загрузке файла {source_blob_name} из GCS: {e}")
         raise 
 
-def upload_to_gcs(bucket_name, source_file_name, destination_blob_name):
+def upload_to_gcs(bucket_name, source_file_name, destination_blob_name, metadata=None):
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(source_file_name)
+        blob = SERVICES.storage_client().bucket(bucket_name).blob(destination_blob_name)
+        if metadata: blob.metadata = metadata
+        with span('gcs_upload', blob=destination_blob_name): blob.upload_from_filename(source_file_name)
         print(f"Файл {source_file_name} загружен в GCS как {destination_blob_name}")
         return True
     except Exception as e:
         print(f"Ошибка при загрузке файла {source_file_name} в GCS: {e}")
         return False
 
-def get_gmail_service_automated():
+def _temp_path_for(gcs_path, default_gcs_path, default_temp_path):
+    # Свой файл в /tmp для каждого объекта GCS: аккаунты, обрабатываемые параллельно, не перезаписывают токены и состояние друг друга
+    if gcs_path == default_gcs_path: return default_temp_path
+    root, ext = os.path.splitext(default_temp_path)
+    return f"{root}_{hashlib.sha1(gcs_path.encode('utf-8')).hexdigest()[:12]}{ext}"
+
+def load_gmail_credentials(token_gcs_path):
     creds = None
-    if not download_from_gcs(BUCKET_NAME, TOKEN_PICKLE_GCS_PATH, TEMP_TOKEN_PATH):
-        print(f"КРИТИЧНО: Не удалось загрузить {TOKEN_PICKLE_GCS_PATH}. Проверьте имя бакета и путь к файлу в GCS, а также права доступа сервисного аккаунта ({os.environ.get('GOOGLE_APPLICATION_CREDENTIALS', 'Default Compute SA')}) к бакету.")
+    temp_token_path = _temp_path_for(token_gcs_path, TOKEN_PICKLE_GCS_PATH, TEMP_TOKEN_PATH)
+    if not download_from_gcs(BUCKET_NAME, token_gcs_path, temp_token_path):
+        print(f"КРИТИЧНО: Не удалось загрузить {token_gcs_path}. Проверьте имя бакета и путь к файлу в GCS, а также права доступа сервисного аккаунта ({os.environ.get('GOOGLE_APPLICATION_CREDENTIALS', 'Default Compute SA')}) к бакету.")
         return None
-    if os.path.exists(TEMP_TOKEN_PATH):
+    if os.path.exists(temp_token_path):
         try:
-            with open(TEMP_TOKEN_PATH, 'rb') as token_file:
+            with open(temp_token_path, 'rb') as token_file:
                 creds = pickle.load(token_file)
         except Exception as e:
-            print(f"Ошибка загрузки/десериализации токена из {TEMP_TOKEN_PATH}: {e}. Файл может быть поврежден.")
-            if os.path.exists(TEMP_TOKEN_PATH): os.remove(TEMP_TOKEN_PATH)
+            print(f"Ошибка загрузки/десериализации токена из {temp_token_path}: {e}. Файл может быть поврежден.")
+            if os.path.exists(temp_token_path): os.remove(temp_token_path)
             return None
     else:
-        print(f"КРИТИЧНО: Файл токена {TEMP_TOKEN_PATH} не существует после попытки загрузки.")
+        print(f"КРИТИЧНО: Файл токена {temp_token_path} не существует после попытки загрузки.")
         return None
     
     if not isinstance(creds, Credentials):
-        print(f"КРИТИЧНО: Загруженный объект не Credentials. Тип: {type(creds)}. Файл токена {TOKEN_PICKLE_GCS_PATH} в GCS, вероятно, поврежден или имеет неверный формат.")
-        if os.path.exists(TEMP_TOKEN_PATH): os.remove(TEMP_TOKEN_PATH)
+        print(f"КРИТИЧНО: Загруженный объект не Credentials. Тип: {type(creds)}. Файл токена {token_gcs_path} в GCS, вероятно, поврежден или имеет неверный формат.")
+        if os.path.exists(temp_token_path): os.remove(temp_token_path)
         return None
+    return creds
 
-    if not creds.valid:
-        if creds.expired and creds.refresh_token:
-            print("Токен истек, пытаемся обновить...")
-            if not download_from_gcs(BUCKET_NAME, CLIENT_SECRET_GCS_PATH, TEMP_CLIENT_SECRET_PATH):
-                print(f"КРИТИЧНО: Не удалось загрузить {CLIENT_SECRET_GCS_PATH} для обновления токена.")
-                return None
-            try:
-                creds.refresh(Request())
-                print("Токен успешно обновлен.")
-                with open(TEMP_TOKEN_PATH, 'wb') as token_file: pickle.dump(creds, token_file)
-                if not upload_to_gcs(BUCKET_NAME, TEMP_TOKEN_PATH, TOKEN_PICKLE_GCS_PATH):
-                    print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось загрузить обновленный токен в GCS.")
-            except Exception as e:
-                print(f"КРИТИЧЕСКАЯ ОШИБКА обновления токена: {e}. Проверьте {CLIENT_SECRET_GCS_PATH}.")
-                if os.path.exists(TEMP_TOKEN_PATH): os.remove(TEMP_TOKEN_PATH)
-                return None
-        else:
-            print("КРИТИЧНО: Нет валидных creds или refresh_token. Пересоздайте token.pickle с SCOPES=['https://mail.google.com/'] и client_secret_desktop.json для Desktop app.")
-            if os.path.exists(TEMP_TOKEN_PATH): os.remove(TEMP_TOKEN_PATH)
-            return None
-    try:
-        service = build('gmail', 'v1', credentials=creds)
-        print("Успешно создан сервис Gmail API!")
-        return service
-    except Exception as e:
-        print(f"Ошибка при создании Gmail API service: {e}")
-        return None
+def refresh_gmail_credentials(creds, token_gcs_path):
+    temp_token_path = _temp_path_for(token_gcs_path, TOKEN_PICKLE_GCS_PATH, TEMP_TOKEN_PATH)
+    if creds.refresh_token:
+        print("Токен истекает или истек, пытаемся обновить...")
+        if not download_from_gcs(BUCKET_NAME, CLIENT_SECRET_GCS_PATH, TEMP_CLIENT_SECRET_PATH):
+            print(f"КРИТИЧНО: Не удалось загрузить {CLIENT_SECRET_GCS_PATH} для обновления токена.")
+            return False
+        try:
+            creds.refresh(Request())
+            print("Токен успешно обновлен.")
+            with open(temp_token_path, 'wb') as token_file: pickle.dump(creds, token_file)
+            if not upload_to_gcs(BUCKET_NAME, temp_token_path, token_gcs_path):
+                print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось загрузить обновленный токен в GCS.")
+            return True
+        except Exception as e:
+            print(f"КРИТИЧЕСКАЯ ОШИБКА обновления токена: {e}. Проверьте {CLIENT_SECRET_GCS_PATH}.")
+            if os.path.exists(temp_token_path): os.remove(temp_token_path)
+            return False
+    print("КРИТИЧНО: Нет валидных creds или refresh_token. Пересоздайте token.pickle с SCOPES=['https://mail.google.com/'] и client_secret_desktop.json для Desktop app.")
+    if os.path.exists(temp_token_path): os.remove(temp_token_path)
+    return False
 
-def get_email_details(service, user_id, msg_id):
-    try:
-        message = service.users().messages().get(userId=user_id, id=msg_id, format='full').execute()
-        email_data = {'id': message.get('id'), 'subject': '', 'from': '', 'date': '', 'body': ''}
+def get_gmail_service_automated(token_gcs_path=None):
+    return SERVICES.gmail_service(token_gcs_path)
+
+def iter_unread_message_ids(service, user_id, max_results=None, query='is:unread'):
+    # Постранично проходим messages().list по nextPageToken, пока не наберем max_results (None — без ограничения).
+    # Генератор: следующая страница запрашивается, только когда вызывающий дочитал текущую.
+    yielded = 0
+    page_token = None
+    while True:
+        page_size = GMAIL_LIST_PAGE_SIZE if max_results is None else min(GMAIL_LIST_PAGE_SIZE, max_results - yielded)
+        if page_size <= 0: return
+        list_kwargs = {'userId': user_id, 'q': query, 'maxResults': page_size}
+        if page_token: list_kwargs['pageToken'] = page_token
+        with span('gmail_list'): response = service.users().messages().list(**list_kwargs).execute()
+        for message in response.get('messages', [])[:page_size]:
+            yield message['id']
+            yielded += 1
+        page_token = response.get('nextPageToken')
+        if not page_token: return
+
+def list_unread_message_ids(service, user_id, max_results=None, query='is:unread'):
+    return list(iter_unread_message_ids(service, user_id, max_results, query))
+
+def parse_email_message(message):
+    email_data = {'id': message.get('id'), 'subject': '', 'from': '', 'date': '', 'body': ''}
+    if 'raw' in message:
+        with span('mime_decode', format='raw'): email_data.update(parse_raw_message(decode_base64url_prefix(message['raw'], MAIL_BODY_MAX_BYTES + MAIL_RAW_HEADERS_MAX_BYTES), MAIL_BODY_MAX_BYTES, SUMMARY_MAX_CHARS))
+    else:
         payload = message.get('payload', {})
-        headers = payload.get('headers', [])
-        
-        for header in headers:
+        for header in payload.get('headers', []):
             name = header.get('name', '').lower()
             value = header.get('value', '')
             if name == 'subject': email_data['subject'] = value
             elif name == 'from': email_data['from'] = value
             elif name == 'date': email_data['date'] = value
+        with span('mime_decode'): email_data['body'] = extract_body_text(payload, MAIL_BODY_MAX_BYTES, SUMMARY_MAX_CHARS)
+
+    body_text = email_data['body'] or message.get('snippet', '')
+    email_data['body'] = body_text.strip()
+    return email_data
+
+def _get_message_request(service, user_id, msg_id, fmt):
+    if fmt == 'metadata': return service.users().messages().get(userId=user_id, id=msg_id, format=fmt, metadataHeaders=METADATA_HEADERS)
+    return service.users().messages().get(userId=user_id, id=msg_id, format=fmt)
 
-        body_text = ""
-        if 'parts' in payload:
-            for part in payload.get('parts', []):
-                if part.get('mimeType') == 'text/plain':
-                    data = part.get('body', {}).get('data')
-                    if data: body_text = base64.urlsafe_b64decode(data).decode('utf-8', errors='replace'); break
-            if not body_text:
-                for part in payload.get('parts', []):
-                    if part.get('mimeType') == 'text/html':
-                        data = part.get('body', {}).get('data')
-                        if data: html_body = base64.urlsafe_b64decode(data).decode('utf-8', errors='replace'); soup = BeautifulSoup(html_body, "html.parser"); body_text = soup.get_text(separator='\n', strip=True); break
-        elif 'body' in payload and 'data' in payload.get('body', {}): 
-            data = payload.get('body', {}).get('data')
-            if data:
-                decoded_body = base64.urlsafe_b64decode(data).decode('utf-8', errors='replace')
-                if payload.get('mimeType') == 'text/html': soup = BeautifulSoup(decoded_body, "html.parser"); body_text = soup.get_text(separator='\n', strip=True)
-                else: body_text = decoded_body
-        
-        if not body_text: body_text = message.get('snippet', '')
-        email_data['body'] = body_text.strip()
-        return email_data
+def get_email_details(service, user_id, msg_id, fmt=None):
+    fmt = fmt or EMAIL_FETCH_FORMAT
+    try:
+        with span('gmail_get', emails=1): message = _get_message_request(service, user_id, msg_id, fmt).execute()
+        return parse_email_message(message)
     except Exception as e:
-        print(f"Ошибка при получении деталей (full) сообщения {msg_id}: {e}")
+        print(f"Ошибка при получении деталей ({fmt}) сообщения {msg_id}: {e}")
         return None
 
+def _http_error_status(error):
+    # HttpError из googleapiclient хранит HTTP-статус в resp.status
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+def fetch_email_details_batch(service, user_id, msg_ids, batch_size=None, fmt=None):
+    # Загружаем письма пачками через HTTP batch: один сетевой round trip на batch_size сообщений вместо одного на письмо.
+    # Ответы разбираются после загрузки, чтобы время разбора MIME не попадало в замер gmail_get.
+    batch_size = batch_size or GMAIL_BATCH_SIZE
+    fmt = fmt or EMAIL_FETCH_FORMAT
+    messages_by_id = {}
+    errors_by_id = {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None: errors_by_id[request_id] = exception
+        else: messages_by_id[request_id] = response
+
+    pending_ids = list(dict.fromkeys(msg_ids)) # request_id в batch должны быть уникальными
+    for attempt in range(1, GMAIL_BATCH_MAX_ATTEMPTS + 1):
+        for start in range(0, len(pending_ids), batch_size):
+            chunk = pending_ids[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=on_response)
+            for msg_id in chunk:
+                batch.add(_get_message_request(service, user_id, msg_id, fmt), request_id=msg_id)
+            try:
+                with span('gmail_get', emails=len(chunk)): batch.execute()
+            except Exception as e:
+                print(f"Ошибка при выполнении batch-запроса ({len(chunk)} писем): {e}")
+                for msg_id in chunk:
+                    if msg_id not in messages_by_id: errors_by_id[msg_id] = e
+        # Повторяем только то, что упало на квотах/временных ошибках сервера
+        pending_ids = [m for m, e in errors_by_id.items() if _http_error_status(e) in (429, 500, 503)]
+        if not pending_ids or attempt == GMAIL_BATCH_MAX_ATTEMPTS: break
+        for msg_id in pending_ids: del errors_by_id[msg_id]
+        print(f"  {len(pending_ids)} писем не загружено из-за лимитов Gmail API, повтор через {attempt} с.")
+        time.sleep(attempt)
+
+    details_by_id = {}
+    for msg_id, message in messages_by_id.items():
+        try: details_by_id[msg_id] = parse_email_message(message)
+        except Exception as e: errors_by_id[msg_id] = e
+    for msg_id, e in errors_by_id.items():
+        print(f"Ошибка при получении деталей ({fmt}) сообщения {msg_id}: {e}")
+    return [details_by_id.get(msg_id) for msg_id in msg_ids]
+
 def mark_email_as_read(service, user_id, msg_id):
     try:
-        service.users().messages().modify(userId=user_id, id=msg_id, body={'removeLabelIds': ['UNREAD']}).execute()
+        with span('gmail_modify', emails=1): service.users().messages().modify(userId=user_id, id=msg_id, body={'removeLabelIds': ['UNREAD']}).execute()
         print(f"  Письмо {msg_id} помечено как прочитанное.")
         return True
     except Exception as e:
         print(f"  Ошибка при пометке письма {msg_id} как прочитанного: {e}")
         return False
 
-def categorize_email(email_details):
-    sender_full = email_details.get('from', '').lower()
-    subject_lower = email_details.get('subject', '').lower()
-    sender_domain = extract_domain(sender_full)
-    for rule in CATEGORIZATION_RULES:
-        if sender_domain and rule.get("senders_domains") and sender_domain in rule["senders_domains"]: return rule["name"]
-        if rule.get("subject_keywords") and any(keyword.lower() in subject_lower for keyword in rule["subject_keywords"]): return rule["name"]
-    return "Прочие письма и адресаты"
-
-def summarize_email_with_gemini(email_text, project_id, location, model_name):
-    if not email_text: return "Текст письма отсутствует, резюме не создано."
+def mark_emails_as_read_batch(service, user_id, msg_ids):
+    # Один batchModify на до 1000 писем вместо отдельного modify на каждое
+    all_marked = True
+    for start in range(0, len(msg_ids), GMAIL_BATCH_MODIFY_LIMIT):
+        chunk = msg_ids[start:start + GMAIL_BATCH_MODIFY_LIMIT]
+        try:
+            with span('gmail_modify', emails=len(chunk)): service.users().messages().batchModify(userId=user_id, body={'ids': chunk, 'removeLabelIds': ['UNREAD']}).execute()
+            print(f"  {len(chunk)} писем помечено как прочитанные.")
+        except Exception as e:
+            print(f"  Ошибка при пометке {len(chunk)} писем как прочитанных: {e}")
+            all_marked = False
+    return all_marked
+
+def new_sync_state():
+    return {'history_id': None, 'pending_ids': [], 'processed_ids': [], 'unmarked_ids': []}
+
+def load_sync_state(state_gcs_path=None):
+    state_gcs_path = state_gcs_path or SYNC_STATE_GCS_PATH
+    temp_state_path = _temp_path_for(state_gcs_path, SYNC_STATE_GCS_PATH, TEMP_SYNC_STATE_PATH)
+    state = new_sync_state()
+    try:
+        if download_from_gcs(BUCKET_NAME, state_gcs_path, temp_state_path):
+            with open(temp_state_path, 'r', encoding='utf-8') as f: state.update(json.load(f))
+    except Exception as e:
+        print(f"Не удалось прочитать состояние синхронизации {state_gcs_path}: {e}. Будет выполнена полная ресинхронизация.")
+        state = new_sync_state()
+    return state
+
+def save_sync_state(state, state_gcs_path=None):
+    state_gcs_path = state_gcs_path or SYNC_STATE_GCS_PATH
+    temp_state_path = _temp_path_for(state_gcs_path, SYNC_STATE_GCS_PATH, TEMP_SYNC_STATE_PATH)
+    state['updated_at'] = datetime.now().isoformat(timespec='seconds')
+    with open(temp_state_path, 'w', encoding='utf-8') as f: json.dump(state, f)
+    if not upload_to_gcs(BUCKET_NAME, temp_state_path, state_gcs_path):
+        print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось сохранить состояние синхронизации в {state_gcs_path}.")
+        return False
+    return True
+
+class StaleHistoryError(Exception):
+    pass
+
+def list_history_message_ids(service, user_id, start_history_id):
+    # Новые непрочитанные письма после start_history_id и текущий historyId ящика (новая контрольная точка)
+    msg_ids = []
+    page_token = None
+    while True:
+        history_kwargs = {'userId': user_id, 'startHistoryId': start_history_id, 'historyTypes': ['messageAdded']}
+        if page_token: history_kwargs['pageToken'] = page_token
+        try:
+            with span('gmail_list', kind='history'): response = service.users().history().list(**history_kwargs).execute()
+        except Exception as e:
+            if _http_error_status(e) == 404: raise StaleHistoryError(f"historyId {start_history_id} устарел") from e
+            raise
+        for record in response.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added.get('message', {})
+                labels = message.get('labelIds', [])
+                if 'UNREAD' in labels and 'DRAFT' not in labels and 'SENT' not in labels: msg_ids.append(message['id'])
+        page_token = response.get('nextPageToken')
+        if not page_token: return msg_ids, response.get('historyId', start_history_id)
+
+def begin_history_sync(service, user_id, state, max_results):
+    # Выбирает письма для этого запуска; контрольная точка обновляется только в памяти и сохраняется в checkpoint_sync_state
+    candidate_ids = list(state['pending_ids'])
+    new_ids = None
+    if state.get('history_id'):
+        try:
+            new_ids, latest_history_id = list_history_message_ids(service, user_id, state['history_id'])
+            print(f"Синхронизация по истории с historyId {state['history_id']}: {len(new_ids)} новых непрочитанных.")
+        except StaleHistoryError as e: print(f"{e}, выполняем полную ресинхронизацию.")
+    if new_ids is None:
+        # historyId берем до листинга, чтобы письма, пришедшие во время листинга, попали в следующую синхронизацию
+        with span('gmail_list', kind='profile'): latest_history_id = service.users().getProfile(userId=user_id).execute().get('historyId')
+        new_ids = list_unread_message_ids(service, user_id, max_results=SYNC_RESYNC_MAX_IDS)
+        print(f"Полная ресинхронизация: {len(new_ids)} непрочитанных, historyId {latest_history_id}.")
+    processed = set(state['processed_ids'])
+    candidate_ids = [m for m in dict.fromkeys(candidate_ids + new_ids) if m not in processed]
+    state['history_id'] = latest_history_id
+    if max_results is None: max_results = len(candidate_ids)
+    state['pending_ids'] = candidate_ids[max_results:]
+    return candidate_ids[:max_results]
+
+def checkpoint_sync_state(state, processed_msg_ids, state_gcs_path=None):
+    # Сохраняем обработанные ID до пометки прочитанными: падение между резюме и batchModify не приведет к повторной обработке
+    state['processed_ids'] = (state['processed_ids'] + [m for m in processed_msg_ids if m not in state['processed_ids']])[-SYNC_PROCESSED_IDS_LIMIT:]
+    state['unmarked_ids'] = list(dict.fromkeys(state['unmarked_ids'] + processed_msg_ids))
+    return save_sync_state(state, state_gcs_path)
+
+def retry_unmarked_emails(service, user_id, state):
+    # Письма, обработанные в прошлом запуске, который упал до batchModify
+    if state['unmarked_ids'] and mark_emails_as_read_batch(service, user_id, state['unmarked_ids']):
+        print(f"Повторно помечено как прочитанные после прошлого запуска: {len(state['unmarked_ids'])}.")
+        state['unmarked_ids'] = []
+
+_active_mailboxes = set() # пути токенов ящиков, которые обрабатываются в этом процессе
+_active_mailboxes_lock = threading.Lock()
+
+def acquire_mailbox_lease(token_gcs_path):
+    # Single-flight на ящик: пересекающиеся запуски (повтор планировщика, второй экземпляр Cloud Run) не обрабатывают
+    # один ящик одновременно. В процессе — множество активных ящиков, между экземплярами — объект аренды рядом с токеном,
+    # который создается только если его нет (if_generation_match=0). Возвращает аренду или None, если ящик уже занят.
+    with _active_mailboxes_lock:
+        if token_gcs_path in _active_mailboxes: return None
+        _active_mailboxes.add(token_gcs_path)
+    lease = {'token_path': token_gcs_path, 'generation': None}
+    if not MAILBOX_LEASE_ENABLED: return lease
+    try: lease = _acquire_gcs_lease(lease)
+    except BaseException:
+        # Ошибка до аренды (например, создание клиента GCS): ящик не должен остаться занятым до перезапуска процесса
+        lease = None
+        raise
+    finally:
+        if lease is None:
+            with _active_mailboxes_lock: _active_mailboxes.discard(token_gcs_path)
+    return lease
+
+def _acquire_gcs_lease(lease):
+    # Объект аренды в GCS; возвращает lease с generation, lease без нее (GCS недоступен) или None, если ящик занят
+    token_gcs_path = lease['token_path']
+    blob = SERVICES.storage_client().bucket(BUCKET_NAME).blob(token_gcs_path + '.lease')
+    body = json.dumps({'owner': f"{socket.gethostname()}:{os.getpid()}", 'expires_at': time.time() + MAILBOX_LEASE_SECONDS})
+    for attempt in range(2):
+        try:
+            with span('gcs_upload', kind='lease'): blob.upload_from_string(body, content_type='application/json', if_generation_match=0)
+            lease['generation'] = blob.generation
+            return lease
+        except PreconditionFailed:
+            if attempt or not _expire_stale_lease(blob): break
+        except Exception as e:
+            print(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось взять аренду ящика {token_gcs_path} в GCS: {e}. Продолжаем с блокировкой только в этом процессе.")
+            return lease
+    print(f"Ящик {token_gcs_path} уже обрабатывается другим запуском.")
+    return None
+
+def _expire_stale_lease(blob):
+    # Удаляет истекшую аренду упавшего запуска; удаление условное по generation, чтобы не снять аренду, только что взятую другим
     try:
-        try: vertexai.init(project=project_id, location=location)
-        except Exception: pass # Игнорируем, если SDK уже инициализирован
+        blob.reload()
+        try: expires_at = float(json.loads(blob.download_as_bytes(if_generation_match=blob.generation)).get('expires_at', 0))
+        except ValueError: expires_at = 0
+        if expires_at > time.time(): return False
+        blob.delete(if_generation_match=blob.generation)
+        print(f"Аренда {blob.name} истекла, перехватываем.")
+        return True
+    except (NotFound, PreconditionFailed): return True # аренду уже сняли или перехватили — пробуем еще раз
+    except Exception as e:
+        print(f"Не удалось проверить аренду {blob.name}: {e}")
+        return False
+
+def release_mailbox_lease(lease):
+    if lease is None: return
+    try:
+        if lease['generation'] is not None: SERVICES.storage_client().bucket(BUCKET_NAME).blob(lease['token_path'] + '.lease').delete(if_generation_match=lease['generation'])
+    except (NotFound, PreconditionFailed): print(f"Аренда ящика {lease['token_path']} истекла и перехвачена до окончания запуска.")
+    except Exception as e: print(f"Не удалось снять аренду ящика {lease['token_path']}: {e}")
+    finally:
+        with _active_mailboxes_lock: _active_mailboxes.discard(lease['token_path'])
+
+def categorize_email(email_details):
+    return CATEGORIZER.categorize(email_details.get('from', ''), email_details.get('subject', ''))
+
+def categorize_emails(emails_details):
+    with span('categorize', emails=len(emails_details)): return CATEGORIZER.categorize_batch(emails_details)
 
-        model = GenerativeModel(model_name)
-        max_chars_for_summary = 25000 
-        email_text_for_summary = email_text[:max_chars_for_summary] if len(email_text) > max_chars_for_summary else email_text
+class RateLimiter:
+    # Скользящее окно в 60 секунд: ограничивает число запросов и оценку токенов в минуту (0 — без ограничения).
+    # Общий GEMINI_RATE_LIMITER — один на процесс, так как квоты Vertex AI считаются на проект, а не на запрос.
+    WINDOW_SECONDS = 60.0
 
-        prompt = f"""Ты — AI ассистент, который помогает анализировать электронные письма.
+    def __init__(self, requests_per_minute, tokens_per_minute, clock=time.monotonic, sleep=time.sleep, parent=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.parent = parent # Общий лимит процесса поверх собственного (квота отдельного аккаунта)
+        self._clock = clock
+        self._sleep = sleep
+        self._events = deque() # (время, токены)
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        if self.tokens_per_minute: tokens = min(tokens, self.tokens_per_minute) # иначе слишком большой запрос ждал бы вечно
+        while True:
+            with self._lock:
+                now = self._clock()
+                while self._events and self._events[0][0] <= now - self.WINDOW_SECONDS:
+                    self._tokens_in_window -= self._events.popleft()[1]
+                requests_ok = not self.requests_per_minute or len(self._events) < self.requests_per_minute
+                tokens_ok = not self.tokens_per_minute or self._tokens_in_window + tokens <= self.tokens_per_minute
+                if requests_ok and tokens_ok:
+                    self._events.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    break
+                wait_seconds = self._events[0][0] + self.WINDOW_SECONDS - now
+            self._sleep(max(wait_seconds, 0.01))
+        if self.parent is not None: self.parent.acquire(tokens)
+
+GEMINI_RATE_LIMITER = RateLimiter(GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE)
+
+def estimate_tokens(text):
+    # Грубая оценка без лишнего вызова count_tokens: ~4 символа на токен
+    return len(text) // 4 + 1
+
+def build_summary_prompt(email_text):
+    email_text_for_summary = email_text[:SUMMARY_MAX_CHARS] if len(email_text) > SUMMARY_MAX_CHARS else email_text
+    return f"""Ты — AI ассистент, который помогает анализировать электронные письма.
 Твоя задача — очень кратко изложить суть следующего письма на русском языке в одном или двух предложениях.
 Сосредоточься на главной теме письма.
 Примеры хороших резюме:
@@ -223,92 +687,1053 @@ def summarize_email_with_gemini(email_text, project_id, location, model_name):
 ---
 Краткое резюме на русском языке:"""
 
-        generation_config = {"max_output_tokens": 150, "temperature": 0.3, "top_p": 0.95}
-        response = model.generate_content(prompt, generation_config=generation_config)
-        
-        if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-            return response.candidates[0].content.parts[0].text.strip()
-        elif hasattr(response, 'text') and response.text: return response.text.strip()
-        else: print(f"Не удалось получить валидный ответ от Gemini. Ответ: {response}"); return "Резюме не создано (ответ API не содержит ожидаемых данных)."
+_BATCH_PROMPT_EMAIL_OVERHEAD_TOKENS = 12 # Разметка <email id="..."> вокруг каждого письма
+
+def build_batch_summary_prompt(keyed_email_texts):
+    # keyed_email_texts: [(id, текст)]; тексты приходят уже нормализованными и обрезанными до SUMMARY_BATCH_EMAIL_MAX_CHARS
+    emails_block = "\n".join(f'<email id="{key}">\n{text}\n</email>' for key, text in keyed_email_texts)
+    return f"""Ты — AI ассистент, который помогает анализировать электронные письма.
+Твоя задача — для каждого из следующих писем очень кратко изложить его суть на русском языке в одном или двух предложениях.
+Сосредоточься на главной теме каждого письма. Письма не связаны между собой.
+Примеры хороших резюме:
+- "Рекламная кампания по продаже велосипедов компании X."
+- "Анонс конференции на тему 'AI и ничего больше'."
+- "Уведомление о предстоящем вебинаре по машинному обучению."
+- "Запрос дополнительной информации по проекту Y."
+
+Не добавляй никаких вступлений вроде "Это письмо о..." или "Резюме письма:". Просто предоставь саму суть.
+Ответ — JSON-объект: ключ — id письма, значение — краткое резюме на русском языке. Резюме нужно для каждого id.
+
+Письма для анализа:
+{emails_block}"""
+
+def _batch_response_schema(keys):
+    return {"type": "OBJECT", "properties": {key: {"type": "STRING"} for key in keys}, "required": list(keys)}
+
+def parse_batch_summaries(response_text, keys):
+    # Только валидные записи: непустая строка под ожидаемым id. Отсутствующие id вызывающий суммирует по одному.
+    if not response_text: return {}
+    response_text = response_text.strip()
+    if response_text.startswith("```"): response_text = response_text.strip("`").partition("\n")[2] # ответ без response_schema бывает в ```json
+    try: parsed = json.loads(response_text)
+    except ValueError:
+        print(f"Пакетный ответ Gemini не является JSON: {response_text[:200]}")
+        return {}
+    if not isinstance(parsed, dict): return {}
+    return {key: parsed[key].strip() for key in keys if isinstance(parsed.get(key), str) and parsed[key].strip()}
+
+def pack_summary_batches(email_texts, token_budget=None, max_emails=None):
+    # Жадная упаковка по порядку в пакеты, укладывающиеся в бюджет входных токенов; возвращает списки индексов email_texts
+    token_budget = (token_budget or SUMMARY_BATCH_TOKEN_BUDGET) - estimate_tokens(build_batch_summary_prompt([]))
+    max_emails = max_emails or SUMMARY_BATCH_MAX_EMAILS
+    batches = []
+    current = []
+    used_tokens = 0
+    for i, text in enumerate(email_texts):
+        cost = estimate_tokens(normalize_email_text(text, SUMMARY_BATCH_EMAIL_MAX_CHARS)) + _BATCH_PROMPT_EMAIL_OVERHEAD_TOKENS
+        if current and (used_tokens + cost > token_budget or len(current) >= max_emails):
+            batches.append(current)
+            current, used_tokens = [], 0
+        current.append(i)
+        used_tokens += cost
+    if current: batches.append(current)
+    return batches
+
+def _is_retryable_llm_error(error):
+    # Исключения google.api_core хранят HTTP-код в атрибуте code (ResourceExhausted — 429, ServiceUnavailable — 503)
+    return getattr(error, 'code', None) in (429, 503)
+
+def _extract_summary_text(response):
+    if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+        return response.candidates[0].content.parts[0].text.strip()
+    elif hasattr(response, 'text') and response.text: return response.text.strip()
+    else: print(f"Не удалось получить валидный ответ от Gemini. Ответ: {response}"); return None
+
+def _record_token_usage(response, span_fields):
+    # usage_metadata — фактический расход токенов по данным Vertex AI
+    usage = getattr(response, 'usage_metadata', None)
+    span_fields['prompt_tokens'] = getattr(usage, 'prompt_token_count', 0) or 0
+    span_fields['output_tokens'] = getattr(usage, 'candidates_token_count', 0) or 0
+    increment('llm_tokens_total', span_fields['prompt_tokens'], kind='prompt')
+    increment('llm_tokens_total', span_fields['output_tokens'], kind='output')
+
+def _generate_content(model, prompt, generation_config, rate_limiter=None, stage='llm_call'):
+    # Вызов Gemini с повторами и экспоненциальной задержкой на 429/503; прочие ошибки пробрасываются
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        if rate_limiter:
+            with span('llm_rate_limit_wait'): rate_limiter.acquire(estimate_tokens(prompt) + generation_config["max_output_tokens"])
+        try:
+            with span(stage, attempt=attempt + 1) as span_fields:
+                response = model.generate_content(prompt, generation_config=generation_config)
+                _record_token_usage(response, span_fields)
+            return response
+        except Exception as e:
+            if attempt == GEMINI_MAX_RETRIES or not _is_retryable_llm_error(e): raise
+            increment('llm_retries_total', code=getattr(e, 'code', '?'))
+            delay = GEMINI_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"  Gemini вернул {getattr(e, 'code', '?')}, повтор {attempt + 1}/{GEMINI_MAX_RETRIES} через {delay:.1f} с.")
+            time.sleep(delay)
+
+def _generate_summary(model, email_text, rate_limiter=None):
+    return _extract_summary_text(_generate_content(model, build_summary_prompt(email_text), SUMMARY_GENERATION_CONFIG, rate_limiter))
+
+def _generate_batch_summaries(model, email_texts, rate_limiter=None):
+    # Один запрос на несколько писем с JSON-ответом по response_schema; возвращает {индекс в email_texts: резюме}
+    keys = [f"m{i + 1}" for i in range(len(email_texts))]
+    prompt = build_batch_summary_prompt([(key, normalize_email_text(text, SUMMARY_BATCH_EMAIL_MAX_CHARS)) for key, text in zip(keys, email_texts)])
+    generation_config = dict(SUMMARY_GENERATION_CONFIG, max_output_tokens=SUMMARY_GENERATION_CONFIG["max_output_tokens"] * len(keys),
+                             response_mime_type="application/json", response_schema=_batch_response_schema(keys))
+    summaries = parse_batch_summaries(_extract_summary_text(_generate_content(model, prompt, generation_config, rate_limiter, 'llm_batch_call')), keys)
+    return {i: summaries[key] for i, key in enumerate(keys) if key in summaries}
+
+def _create_gemini_model(project_id, location, model_name):
+    # Вызывается ServiceContainer один раз на модель за время жизни процесса. vertexai импортируется здесь, а не
+    # в начале модуля: это большая часть времени холодного старта, а модель нужна только после загрузки писем.
+    import vertexai
+    from vertexai.generative_models import GenerativeModel
+    try: vertexai.init(project=project_id, location=location)
+    except Exception: pass # Игнорируем, если SDK уже инициализирован
+    return GenerativeModel(model_name)
+
+SERVICES = ServiceContainer()
+if PREWARM_CLIENTS: SERVICES.warm_up_async(GCP_PROJECT_ID, GCP_REGION, GEMINI_MODEL_NAME)
+
+_summary_cache = None
+_summary_cache_initialized = False
+_summary_cache_lock = threading.Lock()
+
+def get_summary_cache():
+    # Кэш создается один раз на процесс; для бэкенда gcs это единственная загрузка объекта из бакета.
+    # Одновременные первые запросы ждут на блокировке, пока кэш создается, а не получают None.
+    # Возвращает представление кэша для одного запуска (RunSummaryCache) со своими счетчиками попаданий или None.
+    global _summary_cache, _summary_cache_initialized
+    with _summary_cache_lock:
+        if not _summary_cache_initialized:
+            try:
+                _summary_cache = create_summary_cache(SUMMARY_CACHE_BACKEND, SUMMARY_PROMPT_VERSION, SUMMARY_MAX_CHARS, SUMMARY_CACHE_TTL_SECONDS, SUMMARY_CACHE_MAX_ENTRIES,
+                                                      SUMMARY_CACHE_NEAR_DUPLICATE_DISTANCE, sqlite_path=SUMMARY_CACHE_SQLITE_PATH, bucket_name=BUCKET_NAME,
+                                                      gcs_blob_name=SUMMARY_CACHE_GCS_PATH, download_func=download_from_gcs, upload_func=upload_to_gcs)
+            except Exception as e:
+                print(f"Не удалось инициализировать кэш резюме ({SUMMARY_CACHE_BACKEND}): {e}. Работаем без кэша.")
+            _summary_cache_initialized = True
+    return _summary_cache.for_run() if _summary_cache is not None else None
+
+def summarize_email_with_gemini(email_text, project_id, location, model_name, model=None, rate_limiter=None, cache=None):
+    if not email_text: return "Текст письма отсутствует, резюме не создано."
+    if cache is not None:
+        cached_summary = cache.get(email_text, model_name)
+        if cached_summary is not None: return cached_summary
+    return _summarize_uncached(email_text, project_id, location, model_name, model, rate_limiter, cache)
+
+def _summarize_uncached(email_text, project_id, location, model_name, model=None, rate_limiter=None, cache=None):
+    try:
+        if model is None: model = SERVICES.gemini_model(project_id, location, model_name)
+        summary = _generate_summary(model, email_text, rate_limiter)
+        if summary is None: return "Резюме не создано (ответ API не содержит ожидаемых данных)."
+        if cache is not None: cache.put(email_text, model_name, summary)
+        return summary
     except Exception as e:
         print(f"Ошибка при вызове Gemini API ({type(e).__name__}): {e}")
         import traceback; print(traceback.format_exc())
         return f"Ошибка при создании резюме ({type(e).__name__})"
 
-def generate_html_report(processed_emails_info, remaining_unread_count):
+def summarize_email_batch(email_texts, project_id, location, model_name, model=None, rate_limiter=None, cache=None):
+    # Пакетный запрос; письма, для которых в ответе нет валидного резюме (или весь запрос упал), суммируются по одному
+    if len(email_texts) == 1: return [_summarize_uncached(email_texts[0], project_id, location, model_name, model, rate_limiter, cache)]
+    batch_summaries = {}
+    try:
+        if model is None: model = SERVICES.gemini_model(project_id, location, model_name)
+        batch_summaries = _generate_batch_summaries(model, email_texts, rate_limiter)
+    except Exception as e: print(f"Ошибка пакетного запроса к Gemini ({type(e).__name__}): {e}")
+    if len(batch_summaries) < len(email_texts):
+        print(f"  Пакет из {len(email_texts)} писем: {len(email_texts) - len(batch_summaries)} резюме нет в ответе, запрашиваем по одному.")
+        increment('llm_batch_fallbacks_total', len(email_texts) - len(batch_summaries))
+    summaries = []
+    for i, text in enumerate(email_texts):
+        if i not in batch_summaries:
+            summaries.append(_summarize_uncached(text, project_id, location, model_name, model, rate_limiter, cache))
+            continue
+        if cache is not None: cache.put(text, model_name, batch_summaries[i])
+        summaries.append(batch_summaries[i])
+    return summaries
+
+def summarize_emails_concurrently(email_texts, project_id, location, model_name, model=None, max_workers=None, rate_limiter=None, cache=None, batch=None):
+    # Параллельно суммируем тексты в пуле потоков; результаты возвращаются в том же порядке, что и email_texts
+    summaries = [None] * len(email_texts)
+    for i, summary_text in iter_summaries_concurrently(email_texts, project_id, location, model_name, model, max_workers, rate_limiter, cache, batch): summaries[i] = summary_text
+    return summaries
+
+def iter_summaries_concurrently(email_texts, project_id, location, model_name, model=None, max_workers=None, rate_limiter=None, cache=None, batch=None):
+    # Пары (индекс в email_texts, резюме) по мере готовности: попадания в кэш и пустые тексты — сразу, остальные — по мере
+    # ответов Gemini. Одинаковые тексты в пределах одного вызова отправляются в Gemini один раз. В пакетном режиме (batch,
+    # по умолчанию SUMMARY_BATCH_ENABLED) промахи кэша короче SUMMARY_BATCH_EMAIL_MAX_CHARS группируются в пакетные запросы.
+    indexes_by_text = {}
+    for i, text in enumerate(email_texts):
+        if text: indexes_by_text.setdefault(text, []).append(i)
+        else: yield i, "Резюме не создано (нет текста)."
+    if not indexes_by_text: return
+    if model is None:
+        try: model = SERVICES.gemini_model(project_id, location, model_name)
+        except Exception as e: print(f"Не удалось создать модель Gemini ({type(e).__name__}): {e}") # каждое письмо попробует создать модель само
+    max_workers = max_workers or GEMINI_MAX_CONCURRENCY
+    if not (SUMMARY_BATCH_ENABLED if batch is None else batch):
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {submit_with_context(pool, summarize_email_with_gemini, text, project_id, location, model_name, model, rate_limiter, cache): text for text in indexes_by_text}
+            for future in as_completed(futures):
+                for i in indexes_by_text[futures[future]]: yield i, future.result()
+        return
+
+    pending_texts = []
+    for text in indexes_by_text:
+        cached_summary = cache.get(text, model_name) if cache is not None else None
+        if cached_summary is None: pending_texts.append(text)
+        else:
+            for i in indexes_by_text[text]: yield i, cached_summary
+    short_texts = [text for text in pending_texts if len(text) <= SUMMARY_BATCH_EMAIL_MAX_CHARS]
+    jobs = [[text] for text in pending_texts if len(text) > SUMMARY_BATCH_EMAIL_MAX_CHARS]
+    jobs += [[short_texts[i] for i in batch_indexes] for batch_indexes in pack_summary_batches(short_texts)]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {submit_with_context(pool, summarize_email_batch, texts, project_id, location, model_name, model, rate_limiter, cache): texts for texts in jobs}
+        for future in as_completed(futures):
+            for text, summary_text in zip(futures[future], future.result()):
+                for i in indexes_by_text[text]: yield i, summary_text
+
+def _iter_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+def _fetch_next_chunk(gmail_service, user_id, id_chunks):
+    # Выполняется в потоке Gmail: очередная страница messages().list (если нужна) и batch-загрузка писем блока
+    msg_ids = next(id_chunks, None)
+    if not msg_ids: return None
+    return msg_ids, fetch_email_details_batch(gmail_service, user_id, msg_ids)
+
+def _mark_chunk_as_read(gmail_service, user_id, msg_ids):
+    # Выполняется в потоке Gmail; возвращает ID, которые удалось пометить прочитанными
+    return msg_ids if msg_ids and mark_emails_as_read_batch(gmail_service, user_id, msg_ids) else []
+
+def iter_email_chunk(msg_ids, emails_details, summary_cache=None, rate_limiter=None):
+    # Категоризация и резюме одного блока загруженных писем: пары (ID письма, строка отчета) в порядке готовности резюме,
+    # чтобы строка уходила клиенту, как только готово ее резюме, а не после самого медленного вызова Gemini в блоке
+    fetched_emails = [(msg_id, email_details) for msg_id, email_details in zip(msg_ids, emails_details) if email_details]
+    categories = categorize_emails([email_details for _, email_details in fetched_emails])
+    categorized_emails = []
+    for (msg_id, email_details), category in zip(fetched_emails, categories):
+        print(f"  Письмо ID [{msg_id}] от '{email_details.get('from', 'N/A')}' тема '{email_details.get('subject', 'N/A')}' -> категория: '{category}'.")
+        categorized_emails.append((msg_id, email_details, category))
+
+    email_bodies = [email_details.get('body', '') for _, email_details, _ in categorized_emails]
+    print(f"\nОтправка {sum(1 for body in email_bodies if body)} писем на суммирование (параллельно до {GEMINI_MAX_CONCURRENCY}).")
+    for i, summary_text in iter_summaries_concurrently(email_bodies, GCP_PROJECT_ID, GCP_REGION, GEMINI_MODEL_NAME, rate_limiter=rate_limiter or GEMINI_RATE_LIMITER, cache=summary_cache):
+        msg_id, email_details, category = categorized_emails[i]
+        print(f"  Резюме LLM [{msg_id}]: {summary_text}")
+        yield msg_id, {"category": category, "date": email_details.get('date', 'н/д'), "from": email_details.get('from', 'н/д'), "subject": email_details.get('subject', 'Без темы'), "summary": summary_text}
+
+def _chunk_plan(max_emails, deadline, chunk_size):
+    # Без дедлайна — до max_emails писем, с дедлайном — без общего лимита по умолчанию; в обоих случаях блоками по chunk_size,
+    # чтобы прочитанные письма помечались и контрольная точка сохранялась по ходу запуска, а не только в конце
+    if deadline is None: max_emails = max_emails or MAX_EMAILS_TO_PROCESS
+    chunk_size = chunk_size or DRAIN_CHUNK_SIZE
+    return max_emails, min(max_emails, chunk_size) if max_emails else chunk_size
+
+def _select_mailbox_ids(gmail_service, user_id, max_emails, sync_state_path, chunk_size):
+    # Письма запуска: (состояние синхронизации или None, ID из истории, отложенные ID, генератор блоков ID).
+    # В режиме query листинг ленивый — страницы messages().list запрашиваются при загрузке блоков.
+    if SYNC_MODE != 'history': return None, [], [], _iter_chunks(iter_unread_message_ids(gmail_service, user_id, max_results=max_emails), chunk_size)
+    sync_state = load_sync_state(sync_state_path)
+    retry_unmarked_emails(gmail_service, user_id, sync_state)
+    candidate_ids = begin_history_sync(gmail_service, user_id, sync_state, max_emails)
+    print(f"Найдено {len(candidate_ids)} непрочитанных для обработки (максимум {max_emails or 'без ограничения'}).")
+    return sync_state, candidate_ids, sync_state['pending_ids'], _iter_chunks(candidate_ids, chunk_size)
+
+def _checkpoint_chunk(sync_state, pending_ids, processed_msg_ids, marked_ids, sync_state_path):
+    sync_state['pending_ids'] = pending_ids
+    sync_state['unmarked_ids'] = [m for m in sync_state['unmarked_ids'] if m not in marked_ids]
+    checkpoint_sync_state(sync_state, processed_msg_ids, sync_state_path)
+
+def _finish_mailbox_pass(gmail_service, user_id, sync_state, marked_ids, sync_state_path, processed_count):
+    # Итоговая контрольная точка и число оставшихся непрочитанных
+    if sync_state is not None:
+        # Контрольная точка сохраняется и при пустом запуске: в ней новый historyId
+        sync_state['unmarked_ids'] = [m for m in sync_state['unmarked_ids'] if m not in marked_ids]
+        save_sync_state(sync_state, sync_state_path)
+    
+    remaining_unread_count = "н/д"
+    try:
+        unread_label_info = gmail_service.users().labels().get(userId=user_id, id='UNREAD').execute()
+        remaining_unread_count = unread_label_info.get('messagesUnread', 0)
+    except Exception as e_unread: print(f"Не удалось получить кол-во непрочитанных: {e_unread}")
+    print(f"Обработано {processed_count} писем. Оставшееся количество непрочитанных: {remaining_unread_count}")
+    return remaining_unread_count
+
+def open_mailbox_pass(gmail_service, user_id='me', max_emails=None, sync_state_path=None, deadline=None, chunk_size=None):
+    # Выбор писем и загрузка первого блока. Потоковый отчет вызывает ее до ответа клиенту: отзыв доступа, ошибки листинга
+    # и недоступное состояние синхронизации дают 5xx, а не 200 с ошибкой внутри страницы. Исключения пробрасываются.
+    # Ошибки загрузки отдельных писем (404 — письмо удалено после листинга) запуск не прерывают: такие письма считаются
+    # разобранными и уходят из pending_ids, иначе один удаленный блок останавливал бы ящик при каждом запуске.
+    max_emails, chunk_size = _chunk_plan(max_emails, deadline, chunk_size)
+    sync_state, candidate_ids, overflow_ids, id_chunks = _select_mailbox_ids(gmail_service, user_id, max_emails, sync_state_path, chunk_size)
+    first_chunk = _fetch_next_chunk(gmail_service, user_id, id_chunks)
+    return {'max_emails': max_emails, 'chunk_size': chunk_size, 'sync_state': sync_state, 'candidate_ids': candidate_ids, 'overflow_ids': overflow_ids,
+            'id_chunks': id_chunks, 'first_chunk': first_chunk}
+
+class MailboxPassProgress:
+    # Учет одного прохода по ящику, общий для iter_mailbox_emails и aiter_mailbox_emails: письма из open_mailbox_pass,
+    # проверка дедлайна перед блоком, разобранные ID (остаток — в pending_ids) и скользящая оценка времени блока
+    def __init__(self, mailbox_pass, deadline):
+        self.sync_state = mailbox_pass['sync_state']
+        self.candidate_ids = mailbox_pass['candidate_ids']
+        self.overflow_ids = mailbox_pass['overflow_ids']
+        self.id_chunks = mailbox_pass['id_chunks']
+        self.first_chunk = mailbox_pass['first_chunk']
+        self.deadline = deadline
+        self.processed_count = 0
+        self.consumed_count = 0
+        self.deadline_reached = False
+        self.chunk_seconds = None
+        if deadline is not None: print(f"Разбор очереди блоками по {mailbox_pass['chunk_size']} писем, до дедлайна {max(deadline - time.monotonic(), 0):.0f} с.")
+
+    def out_of_time(self):
+        # Новый блок не начинается, если по времени прошлых блоков он не успеет до дедлайна
+        if self.deadline is None or self.chunk_seconds is None or time.monotonic() + self.chunk_seconds <= self.deadline: return False
+        self.deadline_reached = True
+        print(f"До дедлайна {max(self.deadline - time.monotonic(), 0):.1f} с, блок занимает ~{self.chunk_seconds:.1f} с: останавливаемся.")
+        return True
+
+    def chunk_done(self, msg_ids, processed_msg_ids, chunk_started, idle_seconds=0.0):
+        # Блок разобран: счетчики и оценка времени блока; возвращает pending_ids для контрольной точки.
+        # idle_seconds — время, пока потребитель отправлял строки блока: в оценку блока оно не входит
+        self.processed_count += len(processed_msg_ids)
+        increment('emails_processed_total', len(processed_msg_ids))
+        self.consumed_count += len(msg_ids)
+        elapsed = time.monotonic() - chunk_started - idle_seconds
+        self.chunk_seconds = elapsed if self.chunk_seconds is None else 0.5 * (self.chunk_seconds + elapsed)
+        return self.candidate_ids[self.consumed_count:] + self.overflow_ids
+
+    def finish(self, outcome, remaining_unread_count):
+        outcome.update(remaining_unread=remaining_unread_count, deadline_reached=self.deadline_reached)
+
+def iter_mailbox_emails(gmail_service, user_id='me', max_emails=None, sync_state_path=None, summary_cache=None, rate_limiter=None, deadline=None, chunk_size=None, outcome=None, mailbox_pass=None):
+    # Проход по ящику: выбор писем, загрузка, категоризация, резюме, пометка прочитанными.
+    # Генератор строк отчета: строка письма отдается, как только готово его резюме (порядок внутри блока — порядок готовности),
+    # и может сразу уходить клиенту; контрольная точка и пометка прочитанными — после блока.
+    # Без deadline — до max_emails писем одним блоком. С deadline (момент по time.monotonic()) — разбор очереди: письма идут
+    # блоками по chunk_size, загрузка следующего блока перекрывается с суммированием текущего, после каждого блока сохраняется
+    # контрольная точка и письма помечаются прочитанными. Новый блок не начинается, если по времени прошлых блоков он не успеет
+    # до дедлайна; необработанные письма остаются непрочитанными (в режиме history — в pending_ids) до следующего запуска.
+    # Итоги ('remaining_unread', 'deadline_reached') записываются в outcome после последней строки; исключения пробрасываются.
+    # mailbox_pass — результат open_mailbox_pass, если выбор писем и первый блок уже загружены.
+    outcome = outcome if outcome is not None else {}
+    progress = MailboxPassProgress(mailbox_pass or open_mailbox_pass(gmail_service, user_id, max_emails, sync_state_path, deadline, chunk_size), deadline)
+    marking = None
+    # Один поток на все вызовы Gmail: клиент googleapiclient (httplib2) не потокобезопасен
+    gmail_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gmail')
+    try:
+        next_chunk = Future()
+        next_chunk.set_result(progress.first_chunk)
+        while True:
+            chunk_started = time.monotonic()
+            chunk = next_chunk.result()
+            if chunk is None or progress.out_of_time(): break
+            msg_ids, emails_details = chunk
+            next_chunk = submit_with_context(gmail_executor, _fetch_next_chunk, gmail_service, user_id, progress.id_chunks)
+            chunk_rows = iter_email_chunk(msg_ids, emails_details, summary_cache, rate_limiter)
+            processed_msg_ids = []
+            idle_seconds = 0.0
+            try:
+                for msg_id, row in chunk_rows:
+                    processed_msg_ids.append(msg_id)
+                    idle_started = time.monotonic()
+                    yield row
+                    idle_seconds += time.monotonic() - idle_started
+            except GeneratorExit:
+                # Клиент отключился посреди блока: блок дорабатывается без отправки строк и сохраняется целиком
+                processed_msg_ids += [msg_id for msg_id, _ in chunk_rows]
+                marking = _finish_chunk(progress, msg_ids, processed_msg_ids, chunk_started, idle_seconds, marking, gmail_executor, gmail_service, user_id, sync_state_path)
+                raise
+            marking = _finish_chunk(progress, msg_ids, processed_msg_ids, chunk_started, idle_seconds, marking, gmail_executor, gmail_service, user_id, sync_state_path)
+
+        marked_ids = set(marking.result()) if marking is not None else set()
+    finally: gmail_executor.shutdown(wait=True)
+    progress.finish(outcome, _finish_mailbox_pass(gmail_service, user_id, progress.sync_state, marked_ids, sync_state_path, progress.processed_count))
+
+def _finish_chunk(progress, msg_ids, processed_msg_ids, chunk_started, idle_seconds, marking, gmail_executor, gmail_service, user_id, sync_state_path):
+    # Контрольная точка блока и пометка его писем прочитанными в потоке Gmail; возвращает Future этой пометки
+    marked_ids = set(marking.result()) if marking is not None else set()
+    pending_ids = progress.chunk_done(msg_ids, processed_msg_ids, chunk_started, idle_seconds)
+    if progress.sync_state is not None: _checkpoint_chunk(progress.sync_state, pending_ids, processed_msg_ids, marked_ids, sync_state_path)
+    return submit_with_context(gmail_executor, _mark_chunk_as_read, gmail_service, user_id, processed_msg_ids)
+
+def process_mailbox(gmail_service, user_id='me', max_emails=None, sync_state_path=None, summary_cache=None, rate_limiter=None, deadline=None, chunk_size=None):
+    # Весь проход целиком; возвращает {'processed', 'remaining_unread', 'deadline_reached'}
+    outcome = {}
+    processed = list(iter_mailbox_emails(gmail_service, user_id, max_emails, sync_state_path, summary_cache, rate_limiter, deadline, chunk_size, outcome))
+    return dict(outcome, processed=processed)
+
+_blocking_executor = None
+_blocking_executor_lock = threading.Lock()
+
+def _get_blocking_executor():
+    global _blocking_executor
+    with _blocking_executor_lock:
+        if _blocking_executor is None: _blocking_executor = ThreadPoolExecutor(max_workers=ASYNC_BLOCKING_THREADS, thread_name_prefix='blocking')
+        return _blocking_executor
+
+def shutdown_blocking_executor():
+    global _blocking_executor
+    with _blocking_executor_lock: executor, _blocking_executor = _blocking_executor, None
+    if executor is not None: executor.shutdown(wait=False)
+
+async def run_blocking(fn, *args, executor=None):
+    # Блокирующий вызов (клиенты GCS, Gmail, Gemini синхронные) из цикла событий: в пуле потоков процесса,
+    # в контексте текущей задачи — метрики попадают в ее запуск, как у submit_with_context
+    return await asyncio.get_running_loop().run_in_executor(executor or _get_blocking_executor(), functools.partial(contextvars.copy_context().run, fn, *args))
+
+async def aiter_blocking(gen_fn, *args):
+    # Синхронный генератор в пуле потоков процесса (как run_blocking): элементы передаются в цикл событий по мере готовности.
+    # При досрочном закрытии генератор в потоке дорабатывает до конца — им передаются ограниченные куски работы (блок писем).
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    done = object()
+
+    def produce():
+        try:
+            for item in gen_fn(*args): loop.call_soon_threadsafe(items.put_nowait, (item, None))
+            loop.call_soon_threadsafe(items.put_nowait, (done, None))
+        except BaseException as e: loop.call_soon_threadsafe(items.put_nowait, (done, e))
+
+    producer = asyncio.ensure_future(run_blocking(produce))
+    try:
+        while True:
+            item, error = await items.get()
+            if error is not None: raise error
+            if item is done: return
+            yield item
+    finally: await producer
+
+async def aiter_mailbox_emails(gmail_service, user_id='me', max_emails=None, sync_state_path=None, summary_cache=None, rate_limiter=None, deadline=None, chunk_size=None, outcome=None, mailbox_pass=None):
+    # Асинхронный вариант iter_mailbox_emails для asgi_app с теми же параметрами и итогами в outcome. Загрузка, резюме и
+    # пометка прочитанными — три этапа-задачи в цикле событий, связанные очередями по ASYNC_STAGE_QUEUE_SIZE блоков:
+    # загрузка не уходит дальше резюме больше чем на очередь, резюме ждет, если отстает пометка (GCS и batchModify).
+    # Вызовы Gmail — в одном потоке на ящик, резюме и GCS — в общем пуле процесса; пока этапы ждут сеть, цикл событий
+    # обслуживает другие запросы. Ошибка этапа пробрасывается из генератора; уже просуммированные блоки помечаются прочитанными.
+    outcome = outcome if outcome is not None else {}
+    gmail_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gmail')
+    fetched = asyncio.Queue(maxsize=ASYNC_STAGE_QUEUE_SIZE)
+    summarized = asyncio.Queue(maxsize=ASYNC_STAGE_QUEUE_SIZE)
+    marked_ids = set()
+    stage_errors = []
+    fetcher = marker = None
+
+    async def fetch_stage():
+        try:
+            chunk = progress.first_chunk
+            while True:
+                await fetched.put(chunk)
+                if chunk is None: return
+                chunk = await run_blocking(_fetch_next_chunk, gmail_service, user_id, progress.id_chunks, executor=gmail_executor)
+        except Exception as e:
+            stage_errors.append(e)
+            await fetched.put(None)
+
+    async def mark_stage():
+        failed = False
+        while True:
+            item = await summarized.get()
+            if item is None: return
+            if failed: continue # после своей ошибки только освобождаем очередь; после ошибки загрузки блоки дописываются
+            pending_ids, processed_msg_ids = item
+            try:
+                if progress.sync_state is not None: await run_blocking(_checkpoint_chunk, progress.sync_state, pending_ids, processed_msg_ids, set(marked_ids), sync_state_path)
+                marked_ids.update(await run_blocking(_mark_chunk_as_read, gmail_service, user_id, processed_msg_ids, executor=gmail_executor))
+            except Exception as e:
+                failed = True
+                stage_errors.append(e)
+
+    try:
+        if mailbox_pass is None: mailbox_pass = await run_blocking(open_mailbox_pass, gmail_service, user_id, max_emails, sync_state_path, deadline, chunk_size, executor=gmail_executor)
+        progress = MailboxPassProgress(mailbox_pass, deadline)
+        fetcher = asyncio.ensure_future(fetch_stage())
+        marker = asyncio.ensure_future(mark_stage())
+        while True:
+            chunk_started = time.monotonic()
+            chunk = await fetched.get()
+            if stage_errors: raise stage_errors[0]
+            if chunk is None or progress.out_of_time(): break
+            msg_ids, emails_details = chunk
+            chunk_rows = aiter_blocking(iter_email_chunk, msg_ids, emails_details, summary_cache, rate_limiter)
+            processed_msg_ids = []
+            idle_seconds = 0.0
+            try:
+                async for msg_id, row in chunk_rows:
+                    processed_msg_ids.append(msg_id)
+                    idle_started = time.monotonic()
+                    yield row
+                    idle_seconds += time.monotonic() - idle_started
+            except GeneratorExit:
+                # Как в iter_mailbox_emails: блок дорабатывается без отправки строк и уходит на пометку целиком
+                processed_msg_ids += [msg_id async for msg_id, _ in chunk_rows]
+                await summarized.put((progress.chunk_done(msg_ids, processed_msg_ids, chunk_started, idle_seconds), processed_msg_ids))
+                raise
+            await summarized.put((progress.chunk_done(msg_ids, processed_msg_ids, chunk_started, idle_seconds), processed_msg_ids))
+    finally:
+        if fetcher is not None: fetcher.cancel()
+        if marker is not None:
+            await summarized.put(None)
+            await marker
+        await run_blocking(gmail_executor.shutdown)
+    if stage_errors: raise stage_errors[0]
+    progress.finish(outcome, await run_blocking(_finish_mailbox_pass, gmail_service, user_id, progress.sync_state, marked_ids, sync_state_path, progress.processed_count))
+
+def load_accounts_manifest(manifest_gcs_path=None):
+    # Манифест: {"accounts": [{"name": "alice", "token_path": "gmail_tokens/alice/token.pickle", "max_emails": 20, "llm_requests_per_minute": 30}]}
+    manifest_gcs_path = manifest_gcs_path or ACCOUNTS_MANIFEST_GCS_PATH
+    # Свой временный файл на вызов: манифест читают одновременные запросы (asgi_app, триггеры ?account=)
+    descriptor, temp_manifest_path = tempfile.mkstemp(prefix='accounts_', suffix='.json', dir=os.path.dirname(TEMP_ACCOUNTS_MANIFEST_PATH))
+    os.close(descriptor)
+    try:
+        if not download_from_gcs(BUCKET_NAME, manifest_gcs_path, temp_manifest_path): return None
+        with open(temp_manifest_path, 'r', encoding='utf-8') as f: manifest = json.load(f)
+    finally: os.remove(temp_manifest_path)
+    accounts = []
+    for index, account in enumerate(manifest.get('accounts', [])):
+        if not account.get('token_path'):
+            print(f"Аккаунт #{index} в манифесте {manifest_gcs_path} без token_path, пропущен.")
+            continue
+        account.setdefault('name', account['token_path'])
+        accounts.append(account)
+    return accounts
+
+def _account_options(account):
+    # Квоты и пути аккаунта из манифеста: (rate_limiter, sync_state_path, max_emails)
+    rate_limiter = GEMINI_RATE_LIMITER
+    if account.get('llm_requests_per_minute'): rate_limiter = RateLimiter(int(account['llm_requests_per_minute']), 0, parent=GEMINI_RATE_LIMITER)
+    sync_state_path = account.get('sync_state_path') or posixpath.join(posixpath.dirname(account['token_path']), 'sync_state.json')
+    max_emails = int(account['max_emails']) if account.get('max_emails') else None
+    return rate_limiter, sync_state_path, max_emails
+
+def process_account(account, summary_cache=None, deadline=None):
+    # Изоляция аккаунта: свой токен, сервис Gmail, состояние синхронизации и квоты; любая ошибка остается в результате
+    result = {'name': account['name'], 'processed': [], 'remaining_unread': "н/д", 'deadline_reached': False, 'error': None}
+    started = time.monotonic()
+    lease = None
+    try:
+        lease = acquire_mailbox_lease(account['token_path'])
+        if lease is None: raise RuntimeError("ящик уже обрабатывается другим запуском")
+        gmail_service = get_gmail_service_automated(account['token_path'])
+        if gmail_service is None: raise RuntimeError(f"Не удалось получить сервис Gmail для токена {account['token_path']}")
+        rate_limiter, sync_state_path, max_emails = _account_options(account)
+        result.update(process_mailbox(gmail_service, 'me', max_emails, sync_state_path, summary_cache, rate_limiter, deadline))
+    except Exception as e:
+        import traceback; print(f"Ошибка обработки аккаунта {account['name']}: {e}\n{traceback.format_exc()}")
+        result['error'] = f"{type(e).__name__}: {e}"
+    finally: release_mailbox_lease(lease)
+    result['duration_seconds'] = time.monotonic() - started
+    return result
+
+def process_accounts(accounts, max_workers=None, summary_cache=None, deadline=None):
+    # Потоки, а не процессы: работа упирается в сеть, а кэш резюме, лимиты Gemini и клиенты общие на процесс
+    max_workers = max_workers or MULTI_ACCOUNT_MAX_WORKERS
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='account') as pool:
+        futures = [submit_with_context(pool, process_account, account, summary_cache, deadline) for account in accounts]
+        return [future.result() for future in futures]
+
+_REPORT_STYLE = """<style>body{font-family:Arial,sans-serif;margin:20px;background-color:#f4f4f4;color:#333}h1{color:#333}h2{color:#555}
+table{border-collapse:collapse;width:100%;margin-bottom:20px;box-shadow:0 2px 3px rgba(0,0,0,0.1);background-color:white}
+th,td{border:1px solid #ddd;padding:10px;text-align:left;word-break:break-word}th{background-color:#e9e9e9}
+tr:nth-child(even){background-color:#f9f9f9}.summary{margin-top:20px;padding:15px;background-color:#e7f3fe;border-left:5px solid #2196F3}
+.summary p{margin:5px 0}.error{color:#b00020}</style>"""
+
+def _render_report_footer(cache_stats):
+    cache_footer = ""
+    if cache_stats:
+        cache_footer = (f"<p><small>Кэш резюме ({html.escape(SUMMARY_CACHE_BACKEND)}): попаданий {cache_stats['hits'] + cache_stats['near_hits']} из {cache_stats['lookups']} "
+                        f"({cache_stats['hit_rate']:.0%}), из них близких дубликатов: {cache_stats['near_hits']}</small></p>")
+    return f"<footer><p><small>Project ID: {GCP_PROJECT_ID}, Region: {GCP_REGION}, Model: {GEMINI_MODEL_NAME}</small></p>{cache_footer}</footer>"
+
+_REPORT_TABLE_HEADER = '<table><tr><th>Категория</th><th>Дата</th><th>Отправитель</th><th>Тема (начало)</th><th>Резюме LLM (RU)</th></tr>'
+
+def render_report_row(item):
+    category = html.escape(item.get('category', 'н/д'))
+    date_str = item.get('date', 'н/д')
+    date_display = html.escape(date_str) # Упрощенный вывод даты
+    sender = html.escape(item.get('from', 'н/д'))
+    subject_full = item.get('subject', 'Без темы')
+    subject_preview = html.escape(" ".join(subject_full.split()[:5]) + ("..." if len(subject_full.split()) > 5 else ""))
+    summary_llm = html.escape(item.get('summary', 'Резюме отсутствует'))
+    return f"<tr><td>{category}</td><td>{date_display}</td><td>{sender}</td><td>{subject_preview}</td><td>{summary_llm}</td></tr>\n"
+
+def _render_section_heading(max_emails=None, drain=False):
+    if not drain: heading = f"до {max_emails or MAX_EMAILS_TO_PROCESS} за запуск"
+    else: heading = f"разбор очереди до дедлайна{f', не больше {max_emails}' if max_emails else ''}"
+    return f"<h2>Обработанные письма ({heading}):</h2>\n"
+
+class ReportSectionRenderer:
+    # Раздел отчета одного ящика по строке, общий для iter_report_section и aiter_html_report: шапка таблицы перед первой
+    # строкой, счетчик строк и время рендера (этап report_render)
+    def __init__(self):
+        self.count = 0
+        self.render_seconds = 0.0
+
+    def row(self, item):
+        render_started = time.perf_counter()
+        row_html = (_REPORT_TABLE_HEADER if not self.count else "") + render_report_row(item)
+        self.render_seconds += time.perf_counter() - render_started
+        self.count += 1
+        return row_html
+
+    def summary(self, outcome):
+        observe('report_render', self.render_seconds)
+        return _render_section_summary(self.count, outcome)
+
+def iter_report_section(rows, outcome, max_emails=None, drain=False):
+    # rows — любой итерируемый объект строк, в том числе генератор конвейера: HTML отдается по строке, не накапливаясь.
+    # Итоги (remaining_unread, deadline_reached, error) берутся из outcome, когда rows исчерпан.
+    section = ReportSectionRenderer()
+    yield _render_section_heading(max_emails, drain)
+    for item in rows: yield section.row(item)
+    yield section.summary(outcome)
+
+def _render_section_summary(count, outcome):
+    table_end = "</table>\n" if count else "<p>В этом запуске письма для детальной обработки не найдены или не были обработаны.</p>\n"
+    error_notice = f'<p class="error">Запуск прерван ошибкой: {html.escape(outcome["error"])}</p>' if outcome.get('error') else ""
+    deadline_notice = "<p class=\"error\">Запуск остановлен по лимиту времени до обработки всех писем; следующий запуск продолжит с этого места.</p>" if outcome.get('deadline_reached') else ""
+    return table_end + f"""<div class="summary"><p>Всего обработано и помечено как прочитанные в этом запуске: {count} писем.</p>
+<p>Оставшееся количество непрочитанных сообщений в ящике: {html.escape(str(outcome.get('remaining_unread', 'н/д')))}</p>{deadline_notice}{error_notice}</div>\n"""
+
+def render_report_section(processed_emails_info, remaining_unread_count, max_emails=None, drain=False, deadline_reached=False):
+    return "".join(iter_report_section(processed_emails_info, {'remaining_unread': remaining_unread_count, 'deadline_reached': deadline_reached}, max_emails, drain))
+
+def _render_report_head(title="Отчет о проверке Gmail (с LLM резюме)", checked_at=None):
+    current_time = checked_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return f"""<!DOCTYPE html><html lang="ru"><head><meta charset="UTF-8"><title>Отчет Gmail Агента c LLM</title>
+{_REPORT_STYLE}</head><body><h1>{html.escape(title)}</h1><p>Время проверки: {html.escape(current_time)}</p>
+"""
+
+def iter_html_report(rows, outcome, max_emails=None, drain=False, title="Отчет о проверке Gmail (с LLM резюме)", checked_at=None):
+    # Потоковый отчет: шапка уходит клиенту сразу, строки — по мере обработки писем, подвал (кэш резюме из outcome) — в конце
+    yield _render_report_head(title, checked_at)
+    yield from iter_report_section(rows, outcome, max_emails, drain)
+    yield _render_report_end(outcome)
+
+async def aiter_html_report(rows, outcome, max_emails=None, drain=False):
+    # То же, что iter_html_report, для асинхронного итератора строк (aiter_mailbox_emails)
+    section = ReportSectionRenderer()
+    yield _render_report_head()
+    yield _render_section_heading(max_emails, drain)
+    async for item in rows: yield section.row(item)
+    yield section.summary(outcome)
+    yield _render_report_end(outcome)
+
+def _render_report_end(outcome):
+    return f"""{_render_report_footer(outcome.get('cache_stats'))}
+</body></html>"""
+
+def generate_html_report(processed_emails_info, remaining_unread_count, cache_stats=None, max_emails=None, drain=False, deadline_reached=False):
+    outcome = {'remaining_unread': remaining_unread_count, 'deadline_reached': deadline_reached, 'cache_stats': cache_stats}
+    return "".join(iter_html_report(processed_emails_info, outcome, max_emails, drain))
+
+def generate_multi_account_report(account_results, cache_stats=None, max_emails_by_account=None, drain=False):
     current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    max_emails_by_account = max_emails_by_account or {}
+    overview_rows = ""
+    sections = ""
+    for index, result in enumerate(account_results):
+        name = html.escape(result['name'])
+        status = f'<span class="error">{html.escape(result["error"])}</span>' if result['error'] else "OK"
+        overview_rows += (f"<tr><td><a href=\"#account-{index}\">{name}</a></td><td>{len(result['processed'])}</td><td>{html.escape(str(result['remaining_unread']))}</td>"
+                          f"<td>{result.get('duration_seconds', 0):.1f} с</td><td>{status}</td></tr>")
+        sections += f'<hr><h2 id="account-{index}">Аккаунт: {name}</h2>'
+        sections += f'<p class="error">Ошибка: {html.escape(result["error"])}</p>' if result['error'] else render_report_section(result['processed'], result['remaining_unread'], max_emails_by_account.get(result['name']), drain, result['deadline_reached'])
+    total_processed = sum(len(result['processed']) for result in account_results)
+    failed_accounts = sum(1 for result in account_results if result['error'])
+    return f"""<!DOCTYPE html><html lang="ru"><head><meta charset="UTF-8"><title>Отчет Gmail Агента c LLM (несколько ящиков)</title>
+{_REPORT_STYLE}</head><body><h1>Отчет о проверке Gmail: {len(account_results)} ящиков</h1><p>Время проверки: {current_time}</p>
+<table><tr><th>Аккаунт</th><th>Обработано</th><th>Осталось непрочитанных</th><th>Время</th><th>Статус</th></tr>{overview_rows}</table>
+<div class="summary"><p>Всего обработано и помечено как прочитанные: {total_processed} писем.</p><p>Аккаунтов с ошибками: {failed_accounts}</p></div>
+{sections}
+{_render_report_footer(cache_stats)}
+</body></html>"""
+
+def _request_arg(request, name, default=None):
+    # Flask/Functions Framework: параметры запроса в request.args
+    args = getattr(request, 'args', None)
+    return args.get(name, default) if args is not None else default
+
+def _drain_options(request, started):
+    # ?max_emails=N — сколько писем обработать; ?mode=drain или ?deadline_seconds=S — разбор очереди до дедлайна (по умолчанию
+    # DRAIN_DEADLINE_SECONDS). Дедлайн отсчитывается от начала запроса и не выходит за таймаут Cloud Run минус запас.
+    max_emails = _request_arg(request, 'max_emails')
+    max_emails = int(max_emails) if max_emails else None
+    if max_emails is not None and max_emails <= 0: raise ValueError("max_emails должен быть положительным")
+    deadline_seconds = _request_arg(request, 'deadline_seconds')
+    if not deadline_seconds and _request_arg(request, 'mode') != 'drain': return max_emails, _large_run_deadline(max_emails, None, started)
+    deadline_seconds = float(deadline_seconds) if deadline_seconds else DRAIN_DEADLINE_SECONDS
+    if not math.isfinite(deadline_seconds) or deadline_seconds <= 0: raise ValueError("deadline_seconds должен быть положительным числом")
+    return max_emails, started + min(deadline_seconds, REQUEST_TIMEOUT_SECONDS - DRAIN_SAFETY_MARGIN_SECONDS)
+
+def _large_run_deadline(max_emails, deadline, started):
+    # Запуск больше одного блока (?max_emails=5000 или max_emails из манифеста) без явного дедлайна получает дедлайн по умолчанию:
+    # иначе он упрется в таймаут Cloud Run и потеряет недописанные блоки вместе с потраченными вызовами LLM
+    if deadline is None and (max_emails or MAX_EMAILS_TO_PROCESS) > DRAIN_CHUNK_SIZE:
+        return started + min(DRAIN_DEADLINE_SECONDS, REQUEST_TIMEOUT_SECONDS - DRAIN_SAFETY_MARGIN_SECONDS)
+    return deadline
+
+def _bad_request(error):
+    error_message = f"Некорректные параметры запроса: {error}"
+    print(error_message); return (f"<html><body><h1>Ошибка запроса</h1><p>{html.escape(error_message)}</p></body></html>", 400, {'Content-Type': 'text/html; charset=utf-8'})
+
+def _finish_summary_cache(summary_cache):
+    if summary_cache is None: return None
+    cache_stats = summary_cache.stats()
+    print(f"Кэш резюме: {cache_stats}")
+    try: summary_cache.flush()
+    except Exception as e_cache: print(f"Не удалось сохранить кэш резюме: {e_cache}")
+    return cache_stats
+
+def check_all_mailboxes(request, started=None):
+    started = started or time.monotonic()
+    try: max_emails, deadline = _drain_options(request, started)
+    except ValueError as e: return _bad_request(e)
+    accounts = load_accounts_manifest()
+    if not accounts:
+        error_message = f"Манифест аккаунтов {ACCOUNTS_MANIFEST_GCS_PATH} не найден или не содержит аккаунтов."
+        print(error_message); return (f"<html><body><h1>Критическая ошибка конфигурации</h1><p>{html.escape(error_message)}</p></body></html>", 500, {'Content-Type': 'text/html; charset=utf-8'})
+    only_account = _request_arg(request, 'account')
+    if only_account: accounts = [account for account in accounts if account['name'] == only_account]
+    if max_emails is not None:
+        for account in accounts: account['max_emails'] = max_emails
+    deadline = _large_run_deadline(max((int(account.get('max_emails') or MAX_EMAILS_TO_PROCESS) for account in accounts), default=None), deadline, started)
+    print(f"Многоящичный режим: {len(accounts)} аккаунтов, до {MULTI_ACCOUNT_MAX_WORKERS} параллельно.")
+    summary_cache = get_summary_cache()
+    archive = open_run_archive('multi', deadline, max_emails=max_emails, accounts=len(accounts))
+    results = process_accounts(accounts, summary_cache=summary_cache, deadline=deadline)
+    cache_stats = _finish_summary_cache(summary_cache)
+    if archive is not None:
+        for result in results:
+            for row in result['processed']: archive.append(row, account=result['name'])
+    failed = [result['name'] for result in results if result['error']]
+    close_run_archive(archive, deadline_reached=any(result['deadline_reached'] for result in results), cache_stats=cache_stats,
+                      error=f"ошибки в аккаунтах: {', '.join(failed)}" if failed else None,
+                      accounts=[{'name': result['name'], 'processed': len(result['processed']), 'remaining_unread': result['remaining_unread'], 'error': result['error']} for result in results])
+    if only_account and results and not results[0]['error']:
+        return (generate_html_report(results[0]['processed'], results[0]['remaining_unread'], cache_stats, accounts[0].get('max_emails'), deadline is not None, results[0]['deadline_reached']),
+                200, {'Content-Type': 'text/html; charset=utf-8'})
+    max_emails_by_account = {account['name']: account.get('max_emails') for account in accounts}
+    status_code = 500 if results and all(result['error'] for result in results) else 200
+    return (generate_multi_account_report(results, cache_stats, max_emails_by_account, deadline is not None), status_code, {'Content-Type': 'text/html; charset=utf-8'})
+
+def open_run_archive(mode, deadline=None, **header):
+    # None, если архив выключен или файл не создать: отчет клиенту важнее архива
+    if not RUN_ARCHIVE_ENABLED: return None
+    started_at = time.time()
+    run_id = new_run_id(started_at)
+    try: return RunArchiveWriter(os.path.join(TEMP_RUN_ARCHIVE_DIR, f"run_{run_id}.jsonl.gz"), run_id, started_at, mode='drain' if deadline is not None and mode == 'single' else mode, **header)
+    except OSError as e:
+        print(f"Не удалось создать архив запуска: {e}")
+        return None
+
+def close_run_archive(archive, **summary):
+    # Дописывает итоги и выгружает архив в GCS отдельным объектом; возвращает имя объекта или None
+    if archive is None: return None
+    try:
+        summary = archive.close(**summary)
+        blob_name = archive_blob_name(RUN_ARCHIVE_GCS_PREFIX, archive.run_id, archive.started_at)
+        if upload_to_gcs(BUCKET_NAME, archive.local_path, blob_name, metadata=archive.metadata(summary)): return blob_name
+    except Exception as e: print(f"Не удалось сохранить архив запуска {archive.run_id}: {e}")
+    finally:
+        if os.path.exists(archive.local_path): os.remove(archive.local_path)
+    return None
+
+class ReportBody:
+    # Тело потокового ответа: части отчета из генератора chunks, а finish освобождает то, что взято до ответа
+    # (аренда ящика и запуск метрик, скачанный архив). finally генератора, который сервер закрыл не начав читать
+    # (HEAD, обрыв соединения до первой части), не выполняется — поэтому close() вызывает finish сам. finish идемпотентна.
+    def __init__(self, chunks, finish):
+        self.chunks = chunks
+        self.finish = finish
+
+    def __iter__(self): return self
+
+    def __next__(self): return next(self.chunks)
+
+    def close(self):
+        try: self.chunks.close()
+        finally: self.finish()
+
+class AsyncReportBody:
+    # То же для asgi_app: асинхронный генератор chunks и корутина finish
+    def __init__(self, chunks, finish):
+        self.chunks = chunks
+        self.finish = finish
+
+    def __aiter__(self): return self
+
+    async def __anext__(self): return await self.chunks.__anext__()
+
+    async def aclose(self):
+        try: await self.chunks.aclose()
+        finally: await self.finish()
+
+class MailboxReportRun:
+    # Состояние потокового отчета одного ящика, общее для stream_mailbox_report и astream_mailbox_report: архив запуска,
+    # итоги outcome и завершение (архив в GCS, аренда ящика, запуск метрик). Блокирующие шаги — open, finish_rows, close;
+    # асинхронный вариант вызывает их через run_blocking.
+    def __init__(self, run, account, max_emails, deadline, summary_cache, lease):
+        self.run = run
+        self.account = account
+        self.max_emails = max_emails
+        self.deadline = deadline
+        self.summary_cache = summary_cache
+        self.lease = lease
+        self.outcome = {}
+        self.archive = None
+        self.started = False
+        self.finished = False
+
+    def open(self):
+        self.started = True
+        self.archive = open_run_archive('single', self.deadline, max_emails=self.max_emails, account=self.account)
+
+    def add_row(self, row):
+        if self.archive is not None: self.archive.append(row)
+
+    def fail(self, error):
+        # Ошибка посреди потока (статус 200 уже отправлен) выводится в отчет и в архив
+        import traceback; print(f"Ошибка: {error}\n{traceback.format_exc()}")
+        self.outcome['error'] = f"{type(error).__name__}: {error}"
+
+    def finish_rows(self):
+        self.outcome['cache_stats'] = _finish_summary_cache(self.summary_cache)
+
+    def claim_finish(self):
+        # finish идемпотентна: True только для первого вызова
+        if self.finished: return False
+        self.finished = True
+        return True
+
+    def close(self):
+        close_run_archive(self.archive, remaining_unread=self.outcome.get('remaining_unread'), deadline_reached=self.outcome.get('deadline_reached', False),
+                          error=self.outcome.get('error'), cache_stats=self.outcome.get('cache_stats'))
+        release_mailbox_lease(self.lease)
+
+    def end(self):
+        if not self.started: self.run.fields['status'] = 'closed' # тело закрыто до отправки первой части
+        else: self.run.fields['status'] = 'error' if self.outcome.get('error') else 200
+        end_run(self.run)
+
+def stream_mailbox_report(gmail_service, run, account, max_emails=None, deadline=None, sync_state_path=None, rate_limiter=None, summary_cache=None, lease=None, mailbox_pass=None):
+    # HTML-отчет одного ящика (ReportBody): следующий блок писем обрабатывается, пока сервер отправляет клиенту готовые строки,
+    # и строки сразу пишутся в архив запуска. По завершении или закрытии тела снимается аренда ящика и закрывается запуск метрик run.
+    report = MailboxReportRun(run, account, max_emails, deadline, summary_cache, lease)
+
+    def rows():
+        try:
+            for row in iter_mailbox_emails(gmail_service, 'me', max_emails, sync_state_path, summary_cache, rate_limiter, deadline=deadline, outcome=report.outcome, mailbox_pass=mailbox_pass):
+                report.add_row(row)
+                yield row
+        except Exception as e: report.fail(e)
+        report.finish_rows()
+
+    def finish():
+        if not report.claim_finish(): return
+        try: report.close()
+        finally: report.end()
+
+    def chunks():
+        try:
+            report.open()
+            yield from iter_html_report(rows(), report.outcome, max_emails, deadline is not None)
+        finally: finish()
+
+    return ReportBody(chunks(), finish)
+
+def astream_mailbox_report(gmail_service, run, account, max_emails=None, deadline=None, sync_state_path=None, rate_limiter=None, summary_cache=None, lease=None, mailbox_pass=None):
+    # Асинхронный вариант stream_mailbox_report (AsyncReportBody) на aiter_mailbox_emails
+    report = MailboxReportRun(run, account, max_emails, deadline, summary_cache, lease)
+
+    async def rows():
+        pipeline = aiter_mailbox_emails(gmail_service, 'me', max_emails, sync_state_path, summary_cache, rate_limiter, deadline=deadline, outcome=report.outcome, mailbox_pass=mailbox_pass)
+        try:
+            async for row in pipeline:
+                report.add_row(row)
+                yield row
+        except Exception as e: report.fail(e)
+        finally: await pipeline.aclose()
+        await run_blocking(report.finish_rows)
+
+    async def finish():
+        if not report.claim_finish(): return
+        try: await run_blocking(report.close)
+        finally: report.end()
+
+    async def chunks():
+        row_stream = rows()
+        try:
+            report.open()
+            async for chunk in aiter_html_report(row_stream, report.outcome, max_emails, deadline is not None): yield chunk
+        finally:
+            await row_stream.aclose() # клиент отключился: конвейер завершается здесь, а не сборщиком мусора
+            await finish()
+
+    return AsyncReportBody(chunks(), finish)
+
+def list_archived_runs(page_token=None, page_size=None):
+    # Одна страница листинга GCS: от новых запусков к старым, итоги — из метаданных объектов
+    iterator = SERVICES.storage_client().list_blobs(BUCKET_NAME, prefix=posixpath.join(RUN_ARCHIVE_GCS_PREFIX, ''), max_results=page_size or RUN_HISTORY_PAGE_SIZE, page_token=page_token)
+    with span('gcs_list'): blobs = list(next(iter(iterator.pages), []))
+    return [dict(blob.metadata or {}, blob_name=blob.name) for blob in blobs], iterator.next_page_token
+
+def _remove_file(path):
+    if os.path.exists(path): os.remove(path)
+
+def archived_report_response(blob_name):
+    # Отчет прошлого запуска из архива, без повторного прохода по ящику; строки читаются из gzip по одной
+    if not is_archive_blob_name(RUN_ARCHIVE_GCS_PREFIX, blob_name): return _bad_request(f"неизвестный архив {blob_name}")
+    with tempfile.NamedTemporaryFile(dir=TEMP_RUN_ARCHIVE_DIR, prefix='history_', suffix='.jsonl.gz', delete=False) as f: local_path = f.name
+    if not download_from_gcs(BUCKET_NAME, blob_name, local_path):
+        os.remove(local_path)
+        return (f"<html><body><h1>Архив не найден</h1><p>{html.escape(blob_name)}</p></body></html>", 404, {'Content-Type': 'text/html; charset=utf-8'})
+    try: header, rows, summary = read_archive(local_path)
+    except BaseException:
+        _remove_file(local_path)
+        raise
+    if header.get('mode') == 'multi': rows = (dict(row, category=f"[{row.get('account', '?')}] {row.get('category', 'н/д')}") for row in rows)
+    body = iter_html_report(rows, summary, header.get('max_emails'), header.get('mode') == 'drain', title=f"Архив запуска {header.get('run_id', '')} ({header.get('mode', 'н/д')})",
+                            checked_at=f"{header.get('started_at', 'н/д')} UTC")
+
+    def chunks():
+        try: yield from body
+        finally: _remove_file(local_path)
+
+    # ReportBody: скачанный архив удаляется и тогда, когда сервер закрыл тело, не начав его читать
+    return (ReportBody(chunks(), lambda: _remove_file(local_path)), 200, {'Content-Type': 'text/html; charset=utf-8'})
+
+def history_http_response(request):
+    # /history — постраничный список прошлых запусков; /history?run=<объект> — отчет одного запуска
+    if _request_arg(request, 'run'): return archived_report_response(_request_arg(request, 'run'))
+    try: page_size = min(max(int(_request_arg(request, 'page_size') or RUN_HISTORY_PAGE_SIZE), 1), RUN_HISTORY_MAX_PAGE_SIZE)
+    except ValueError as e: return _bad_request(e)
+    runs, next_page_token = list_archived_runs(_request_arg(request, 'page_token'), page_size)
     html_rows = ""
-    for item in processed_emails_info:
-        category = html.escape(item.get('category', 'н/д'))
-        date_str = item.get('date', 'н/д')
-        date_display = html.escape(date_str) # Упрощенный вывод даты
-        sender = html.escape(item.get('from', 'н/д'))
-        subject_full = item.get('subject', 'Без темы')
-        subject_preview = html.escape(" ".join(subject_full.split()[:5]) + ("..." if len(subject_full.split()) > 5 else ""))
-        summary_llm = html.escape(item.get('summary', 'Резюме отсутствует'))
-        html_rows += f"<tr><td>{category}</td><td>{date_display}</td><td>{sender}</td><td>{subject_preview}</td><td>{summary_llm}</td></tr>"
-
-    html_content = f"""<!DOCTYPE html><html lang="ru"><head><meta charset="UTF-8"><title>Отчет Gmail Агента c LLM</title>
-<style>body{{font-family:Arial,sans-serif;margin:20px;background-color:#f4f4f4;color:#333}}h1{{color:#333}}h2{{color:#555}}
-table{{border-collapse:collapse;width:100%;margin-bottom:20px;box-shadow:0 2px 3px rgba(0,0,0,0.1);background-color:white}}
-th,td{{border:1px solid #ddd;padding:10px;text-align:left;word-break:break-word}}th{{background-color:#e9e9e9}}
-tr:nth-child(even){{background-color:#f9f9f9}}.summary{{margin-top:20px;padding:15px;background-color:#e7f3fe;border-left:5px solid #2196F3}}
-.summary p{{margin:5px 0}}</style></head><body><h1>Отчет о проверке Gmail (с LLM резюме)</h1><p>Время проверки: {current_time}</p>
-<h2>Обработанные письма (до {MAX_EMAILS_TO_PROCESS} за запуск):</h2>
-{'<table><tr><th>Категория</th><th>Дата</th><th>Отправитель</th><th>Тема (начало)</th><th>Резюме LLM (RU)</th></tr>' + html_rows + '</table>' if processed_emails_info else "<p>В этом запуске письма для детальной обработки не найдены или не были обработаны.</p>"}
-<div class="summary"><p>Всего обработано и помечено как прочитанные в этом запуске: {len(processed_emails_info)} писем.</p>
-<p>Оставшееся количество непрочитанных сообщений в ящике: {remaining_unread_count}</p></div>
-<footer><p><small>Project ID: {GCP_PROJECT_ID}, Region: {GCP_REGION}, Model: {GEMINI_MODEL_NAME}</small></p></footer>
+    for item in runs:
+        link = "/history?" + urlencode({'run': item['blob_name']})
+        status = f'<span class="error">{html.escape(item["error"])}</span>' if item.get('error') else "OK"
+        html_rows += (f"<tr><td><a href=\"{html.escape(link)}\">{html.escape(item.get('started_at', 'н/д'))}</a></td><td>{html.escape(item.get('mode', 'н/д'))}</td>"
+                      f"<td>{html.escape(item.get('processed', 'н/д'))}</td><td>{html.escape(item.get('remaining_unread', '') or 'н/д')}</td>"
+                      f"<td>{'да' if item.get('deadline_reached') == 'True' else 'нет'}</td><td>{html.escape(item.get('duration_seconds', 'н/д'))} с</td><td>{status}</td></tr>")
+    next_link = f'<p><a href="{html.escape("/history?" + urlencode({"page_token": next_page_token, "page_size": page_size}))}">Следующая страница &rarr;</a></p>' if next_page_token else ""
+    body = f"""<!DOCTYPE html><html lang="ru"><head><meta charset="UTF-8"><title>История запусков Gmail Агента</title>
+{_REPORT_STYLE}</head><body><h1>История запусков</h1>
+{'<table><tr><th>Начало (UTC)</th><th>Режим</th><th>Обработано</th><th>Осталось непрочитанных</th><th>Остановлен по дедлайну</th><th>Длительность</th><th>Статус</th></tr>' + html_rows + '</table>' if runs else "<p>Архивных запусков нет.</p>"}
+{next_link}
 </body></html>"""
-    return html_content
+    return (body, 200, {'Content-Type': 'text/html; charset=utf-8'})
+
+def metrics_http_response():
+    return (PROCESS_METRICS.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
 def check_unread_emails_http(request):
+    # Синхронная точка входа (Functions Framework, gunicorn с синхронными воркерами), сохранена для совместимости;
+    # в Dockerfile сервис запускается через asgi_app и check_unread_emails_async.
+    # /metrics — гистограммы этапов за время жизни процесса в формате Prometheus; /history — архив прошлых запусков;
+    # любой другой путь — проверка почты. Отчет одного ящика — генератор: gunicorn отправляет его по мере обработки писем,
+    # каждый шаг выполняется в контексте этого запроса (метрики запуска).
+    path = getattr(request, 'path', '/').rstrip('/')
+    if path == '/metrics': return metrics_http_response()
+    if path == '/history': return history_http_response(request)
+    context = contextvars.copy_context()
+    body, status_code, headers = context.run(_check_unread_emails, request, time.monotonic())
+    if isinstance(body, str): return (body, status_code, headers)
+    return (iter_in_context(body, context), status_code, headers)
+
+def _check_unread_emails(request, started):
+    run = begin_run('check_unread_emails', mode=_request_arg(request, 'mode') or ('multi' if MULTI_ACCOUNT_MODE else 'single'))
+    try: response = _start_check_unread_emails(request, started, run)
+    except BaseException:
+        end_run(run)
+        raise
+    if isinstance(response[0], str):
+        run.fields['status'] = response[1]
+        end_run(run)
+    return response
+
+def _start_check_unread_emails(request, started, run):
     print(f"Функция check_unread_emails_http вызвана. Project ID: {GCP_PROJECT_ID}, Region: {GCP_REGION}")
-    
+    config_error = config_error_response()
+    if config_error: return config_error
+    if MULTI_ACCOUNT_MODE or _request_arg(request, 'mode') == 'multi': return check_all_mailboxes(request, started)
+    error_response, options = prepare_mailbox_check(request, started)
+    if error_response: return error_response
+    return (stream_mailbox_report(run=run, **options), 200, {'Content-Type': 'text/html; charset=utf-8'})
+
+def config_error_response():
     if 'not-set' in BUCKET_NAME or 'not-set' in TOKEN_PICKLE_GCS_PATH or 'not-set' in CLIENT_SECRET_GCS_PATH:
         error_message = "КРИТИЧНО: Переменные окружения для GCS (GCS_BUCKET_NAME, TOKEN_PICKLE_GCS_PATH, CLIENT_SECRET_GCS_PATH) не установлены корректно в Cloud Run."
         print(error_message); return (f"<html><body><h1>Критическая ошибка конфигурации</h1><p>{html.escape(error_message)}</p></body></html>", 500, {'Content-Type': 'text/html; charset=utf-8'})
+    return None
 
-    gmail_service = get_gmail_service_automated()
-    processed_emails_info_for_html = [] 
-    if gmail_service:
-        try:
-            response_list = gmail_service.users().messages().list(userId='me', q='is:unread', maxResults=MAX_EMAILS_TO_PROCESS).execute()
-            messages = response_list.get('messages', [])
-            print(f"Найдено {len(messages)} непрочитанных для обработки (максимум {MAX_EMAILS_TO_PROCESS}).")
-
-            if messages:
-                for msg_summary in messages:
-                    msg_id = msg_summary['id']
-                    print(f"\nОбработка письма ID: {msg_id}")
-                    email_details = get_email_details(gmail_service, 'me', msg_id)
-                    if email_details:
-                        category = categorize_email(email_details)
-                        print(f"  Письмо ID [{msg_id}] от '{email_details.get('from', 'N/A')}' тема '{email_details.get('subject', 'N/A')}' -> категория: '{category}'.")
-                        
-                        email_body = email_details.get('body', '')
-                        summary_text = "Резюме не создано (нет текста)."
-                        if email_body:
-                            print(f"  Отправка текста (первые 100 сим: '{email_body[:100]}...') на суммирование.")
-                            summary_text = summarize_email_with_gemini(email_body, GCP_PROJECT_ID, GCP_REGION, GEMINI_MODEL_NAME)
-                            print(f"  Резюме LLM: {summary_text}")
-                        
-                        processed_emails_info_for_html.append({"category": category, "date": email_details.get('date', 'н/д'), "from": email_details.get('from', 'н/д'), "subject": email_details.get('subject', 'Без темы'), "summary": summary_text})
-                        mark_email_as_read(gmail_service, 'me', msg_id)
-            
-            remaining_unread_count = "н/д"
-            try:
-                unread_label_info = gmail_service.users().labels().get(userId='me', id='UNREAD').execute()
-                remaining_unread_count = unread_label_info.get('messagesUnread', 0)
-            except Exception as e_unread: print(f"Не удалось получить кол-во непрочитанных: {e_unread}")
-            print(f"Оставшееся количество непрочитанных: {remaining_unread_count}")
-            return (generate_html_report(processed_emails_info_for_html, remaining_unread_count), 200, {'Content-Type': 'text/html; charset=utf-8'})
-        except Exception as e:
-            import traceback; error_message = f"Ошибка: {e}\n{traceback.format_exc()}"
-            print(error_message); return (f"<html><body><h1>Ошибка</h1><pre>{html.escape(error_message)}</pre></body></html>", 500, {'Content-Type': 'text/html; charset=utf-8'})
-    else:
+def prepare_mailbox_check(request, started):
+    # Все, что проверяется до начала потокового отчета одного ящика: параметры, аренда ящика (single-flight), сервис Gmail.
+    # ?account=<имя> — аккаунт из манифеста (триггер планировщика на каждый ящик), иначе TOKEN_PICKLE_GCS_PATH.
+    # Выбор писем и первый блок тоже загружаются здесь (open_mailbox_pass): ошибки доступа к ящику дают 502, а не 200.
+    # Возвращает (ответ с ошибкой, None) или (None, параметры stream_mailbox_report/astream_mailbox_report без run).
+    try: max_emails, deadline = _drain_options(request, started)
+    except ValueError as e: return _bad_request(e), None
+    account = {'name': TOKEN_PICKLE_GCS_PATH, 'token_path': TOKEN_PICKLE_GCS_PATH, 'sync_state_path': SYNC_STATE_GCS_PATH}
+    if _request_arg(request, 'account'):
+        account = next((item for item in load_accounts_manifest() or [] if item['name'] == _request_arg(request, 'account')), None)
+        if account is None: return _bad_request(f"аккаунта {_request_arg(request, 'account')} нет в манифесте {ACCOUNTS_MANIFEST_GCS_PATH}"), None
+    lease = acquire_mailbox_lease(account['token_path'])
+    if lease is None:
+        error_message = f"Ящик {account['name']} уже обрабатывается другим запуском; этот запуск пропущен."
+        return (f"<html><body><h1>Запуск пропущен</h1><p>{html.escape(error_message)}</p></body></html>", 409, {'Content-Type': 'text/html; charset=utf-8'}), None
+    try:
+        gmail_service = get_gmail_service_automated(account['token_path'])
+        summary_cache = get_summary_cache()
+    except BaseException:
+        release_mailbox_lease(lease)
+        raise
+    if not gmail_service:
+        release_mailbox_lease(lease)
         error_message = "Не удалось получить сервис Gmail. Проверьте конфигурацию токенов и GCS."
-        print(error_message); return (f"<html><body><h1>Критическая ошибка</h1><p>{html.escape(error_message)}</p></body></html>", 500, {'Content-Type': 'text/html; charset=utf-8'})
+        print(error_message); return (f"<html><body><h1>Критическая ошибка</h1><p>{html.escape(error_message)}</p></body></html>", 500, {'Content-Type': 'text/html; charset=utf-8'}), None
+    rate_limiter, sync_state_path, account_max_emails = _account_options(account)
+    max_emails = max_emails or account_max_emails
+    deadline = _large_run_deadline(max_emails, deadline, started)
+    try: mailbox_pass = open_mailbox_pass(gmail_service, 'me', max_emails, sync_state_path, deadline)
+    except Exception as e:
+        release_mailbox_lease(lease)
+        import traceback; print(f"Ошибка доступа к ящику {account['name']}: {e}\n{traceback.format_exc()}")
+        error_message = f"Не удалось получить письма ящика {account['name']}: {type(e).__name__}: {e}"
+        return (f"<html><body><h1>Ошибка доступа к ящику</h1><p>{html.escape(error_message)}</p></body></html>", 502, {'Content-Type': 'text/html; charset=utf-8'}), None
+    return None, {'gmail_service': gmail_service, 'account': account['name'], 'max_emails': max_emails, 'deadline': deadline, 'sync_state_path': sync_state_path,
+                  'rate_limiter': rate_limiter, 'summary_cache': summary_cache, 'lease': lease, 'mailbox_pass': mailbox_pass}
+
+async def check_unread_emails_async(request):
+    # Обработчик asgi_app: тот же ответ (тело, статус, заголовки), что у check_unread_emails_http, но отчет одного ящика —
+    # асинхронный генератор на aiter_mailbox_emails, и запуск не занимает поток на время ожидания сети.
+    # /history и многоящичный режим без ?account= выполняются синхронным обработчиком в пуле потоков.
+    path = getattr(request, 'path', '/').rstrip('/')
+    if path == '/metrics': return metrics_http_response()
+    multi = MULTI_ACCOUNT_MODE or _request_arg(request, 'mode') == 'multi'
+    if path == '/history' or config_error_response() or (multi and not _request_arg(request, 'account')): return await run_blocking(check_unread_emails_http, request)
+    started = time.monotonic()
+    run = begin_run('check_unread_emails', mode=_request_arg(request, 'mode') or ('multi' if multi else 'single'), entry='async')
+    try: error_response, options = await run_blocking(prepare_mailbox_check, request, started)
+    except BaseException:
+        end_run(run)
+        raise
+    if error_response:
+        run.fields['status'] = error_response[1]
+        end_run(run)
+        return error_response
+    return (astream_mailbox_report(run=run, **options), 200, {'Content-Type': 'text/html; charset=utf-8'})
 
 if __name__ == '__main__':
     print("Запуск локального теста...")
@@ -329,6 +1754,7 @@ if __name__ == '__main__':
     print(f"Локальный тест использует: Бакет GCS='{BUCKET_NAME}', Project ID='{GCP_PROJECT_ID}', Region='{GCP_REGION}'")
     class MockRequest: method = 'GET'
     response_content, status_code, _ = check_unread_emails_http(MockRequest())
+    if not isinstance(response_content, str): response_content = "".join(response_content) # потоковый отчет
     print(f"\nЛокальный тест завершен. Статус: {status_code}")
     if status_code == 200:
         with open("local_gmail_report.html", "w", encoding="utf-8") as f: f.write(response_content)
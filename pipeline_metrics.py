@@ -0,0 +1,204 @@
+# pipeline_metrics.py
+# Замеры этапов конвейера. with span('gmail_get'): ... добавляет длительность в гистограмму этапа — общую на процесс
+# (отдается в текстовом формате Prometheus на /metrics) и гистограмму текущего запуска (metrics_run), по которой в конце
+# запуска пишется одна JSON-строка лога с p50/p95 по этапам. Cloud Run разбирает JSON из stdout как structured logging.
+# Запуск привязан к contextvars: задачи пулов потоков нужно отправлять через submit_with_context.
+
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_PREFIX = 'gmail_agent'
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LOG_SPANS = os.environ.get('METRICS_LOG_SPANS', '0') == '1' # JSON-строка на каждый span, а не только сводка запуска
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS, keep_samples=False):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1) # последний — выше максимальной границы (+Inf)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = [] if keep_samples else None # сырые значения для точных перцентилей в пределах запуска
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]: index += 1
+        self.bucket_counts[index] += 1
+        if self.samples is not None: self.samples.append(value)
+
+    def percentile(self, q):
+        # По сырым значениям (метод ближайшего ранга), иначе — верхняя граница корзины, как histogram_quantile
+        if self.samples:
+            ordered = sorted(self.samples)
+            return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+        if not self.count: return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= rank: return bound
+        return math.inf
+
+
+class MetricsRegistry:
+    def __init__(self, keep_samples=False, **fields):
+        self.keep_samples = keep_samples
+        self.fields = fields # поля, попадающие в JSON-сводку запуска (режим, статус ответа...)
+        self.started = time.monotonic()
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None: histogram = self._histograms[stage] = Histogram(keep_samples=self.keep_samples)
+            histogram.observe(seconds)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + value
+
+    def stage_stats(self):
+        with self._lock: histograms = list(self._histograms.items())
+        stats = {}
+        for stage, histogram in sorted(histograms):
+            stats[stage] = {'count': histogram.count, 'total_seconds': round(histogram.sum, 4), 'p50_ms': _milliseconds(histogram.percentile(0.5)),
+                            'p95_ms': _milliseconds(histogram.percentile(0.95)), 'max_ms': _milliseconds(max(histogram.samples)) if histogram.samples else None}
+        return stats
+
+    def counters(self):
+        with self._lock: counters = list(self._counters.items())
+        return {name + ('{' + ','.join(f"{k}={v}" for k, v in labels) + '}' if labels else ''): value for (name, labels), value in sorted(counters)}
+
+    def summary(self):
+        return {'duration_seconds': round(time.monotonic() - self.started, 4), 'stages': self.stage_stats(), 'counters': self.counters()}
+
+    def render_prometheus(self, prefix=METRICS_PREFIX):
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        name = f"{prefix}_stage_duration_seconds"
+        lines = [f"# HELP {name} Duration of pipeline stages.", f"# TYPE {name} histogram"]
+        for stage, histogram in histograms:
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + (math.inf,), histogram.bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{"+Inf" if bound == math.inf else bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        declared = set()
+        for (counter, labels), value in counters:
+            if counter not in declared:
+                lines.append(f"# TYPE {prefix}_{counter} counter")
+                declared.add(counter)
+            label_text = '{' + ','.join(f'{k}="{_escape_label(v)}"' for k, v in labels) + '}' if labels else ''
+            lines.append(f"{prefix}_{counter}{label_text} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+PROCESS_METRICS = MetricsRegistry() # за время жизни процесса (gunicorn-воркера), без сырых значений
+_current_run = contextvars.ContextVar('pipeline_metrics_run', default=None)
+
+
+def current_run():
+    return _current_run.get()
+
+
+def observe(stage, seconds):
+    PROCESS_METRICS.observe(stage, seconds)
+    run = _current_run.get()
+    if run is not None: run.observe(stage, seconds)
+
+
+def increment(name, value=1, **labels):
+    PROCESS_METRICS.increment(name, value, **labels)
+    run = _current_run.get()
+    if run is not None: run.increment(name, value, **labels)
+
+
+def log_event(message, severity='INFO', **fields):
+    print(json.dumps(dict(fields, severity=severity, message=message), ensure_ascii=False, default=str), flush=True)
+
+
+@contextmanager
+def span(stage, **fields):
+    # fields можно дополнять внутри блока (число токенов, писем); они попадают в JSON-строку span при METRICS_LOG_SPANS=1
+    started = time.perf_counter()
+    try: yield fields
+    except BaseException as e:
+        fields['error'] = type(e).__name__
+        increment('stage_errors_total', stage=stage)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        observe(stage, seconds)
+        if LOG_SPANS: log_event('stage', stage=stage, duration_ms=_milliseconds(seconds), **fields)
+
+
+def begin_run(name, **fields):
+    # Гистограммы одного запуска становятся текущими в этом контексте до end_run
+    run = MetricsRegistry(keep_samples=True, **fields)
+    run.name = name
+    run.token = _current_run.set(run)
+    return run
+
+
+def end_run(run):
+    # JSON-сводка запуска в лог и длительность запуска в этап 'run' процесса; вызывается в том же контексте, что и begin_run
+    try: _current_run.reset(run.token)
+    except ValueError: pass # генератор потокового ответа закрыт сборщиком мусора вне своего контекста
+    summary = run.summary()
+    PROCESS_METRICS.observe('run', summary['duration_seconds'])
+    PROCESS_METRICS.increment('runs_total', run=run.name)
+    log_event('pipeline_run', run=run.name, **run.fields, **summary)
+    return summary
+
+
+@contextmanager
+def metrics_run(name, **fields):
+    run = begin_run(name, **fields)
+    try: yield run
+    finally: end_run(run)
+
+
+class ContextIterator:
+    # Каждый шаг итератора выполняется в одном и том же контексте: потоковый ответ, который сервер дочитывает
+    # после возврата из обработчика, продолжает писать метрики в свой запуск и может его завершить.
+    # Не генератор: close() сервера (клиент отключился, HEAD без чтения тела) доходит до исходного итератора,
+    # даже если чтение так и не началось, и его close выполняется в своем контексте.
+    def __init__(self, iterable, context):
+        self.iterator = iter(iterable)
+        self.context = context
+
+    def __iter__(self): return self
+
+    def __next__(self): return self.context.run(next, self.iterator)
+
+    def close(self):
+        close = getattr(self.iterator, 'close', None)
+        if close is not None: self.context.run(close)
+
+
+def iter_in_context(iterable, context):
+    return ContextIterator(iterable, context)
+
+
+def submit_with_context(pool, fn, *args, **kwargs):
+    # Задача в пуле потоков видит текущий запуск: у каждой задачи своя копия контекста
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
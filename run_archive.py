@@ -0,0 +1,77 @@
+# run_archive.py
+# Архив запусков: каждый запуск — отдельный неизменяемый объект GCS, gzip JSONL из заголовка запуска, строк отчета и итогов.
+# Объекты только добавляются, поэтому параллельные экземпляры Cloud Run не мешают друг другу. Имя объекта начинается
+# с обратной метки времени: листинг по префиксу идет от новых запусков к старым, и страница истории — это один
+# list_blobs(max_results, page_token). Итоги запуска дублируются в метаданных объекта, чтобы список строился без загрузки архивов.
+
+import gzip
+import json
+import os
+import posixpath
+import time
+from datetime import datetime
+
+ARCHIVE_FORMAT_VERSION = 1
+_TIMESTAMP_CEILING = 10 ** 13 # миллисекунды
+_ARCHIVE_SUFFIX = '.jsonl.gz'
+
+
+def new_run_id(started_at=None):
+    started_at = started_at or time.time()
+    return f"{datetime.utcfromtimestamp(started_at).strftime('%Y%m%dT%H%M%SZ')}-{os.urandom(3).hex()}"
+
+
+def archive_blob_name(prefix, run_id, started_at):
+    return posixpath.join(prefix, f"{_TIMESTAMP_CEILING - int(started_at * 1000):013d}-{run_id}{_ARCHIVE_SUFFIX}")
+
+
+def is_archive_blob_name(prefix, blob_name):
+    # Имя объекта приходит из параметра запроса: разрешены только объекты архива непосредственно под префиксом
+    directory, name = posixpath.split(blob_name)
+    return directory == prefix.rstrip('/') and name.endswith(_ARCHIVE_SUFFIX) and not name.startswith('.')
+
+
+class RunArchiveWriter:
+    # Строки пишутся в сжатый локальный файл по мере обработки писем; в памяти весь отчет не держится
+    def __init__(self, local_path, run_id, started_at, **header):
+        self.local_path = local_path
+        self.run_id = run_id
+        self.started_at = started_at
+        self.header = dict(header, started_at=datetime.utcfromtimestamp(started_at).strftime('%Y-%m-%d %H:%M:%S'))
+        self.count = 0
+        self._file = gzip.open(local_path, 'wt', encoding='utf-8')
+        self._write(dict(self.header, type='run', run_id=run_id, version=ARCHIVE_FORMAT_VERSION))
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def append(self, row, **extra):
+        self._write(dict(row, type='email', **extra))
+        self.count += 1
+
+    def close(self, **summary):
+        summary = dict(summary, processed=self.count, duration_seconds=round(time.time() - self.started_at, 2))
+        self._write(dict(summary, type='summary'))
+        self._file.close()
+        return summary
+
+    def metadata(self, summary):
+        # Метаданные объекта GCS — только строки
+        return {key: '' if value is None else str(value) for key, value in dict(self.header, run_id=self.run_id, **summary).items() if not isinstance(value, (dict, list))}
+
+
+def read_archive(local_path):
+    # (заголовок, генератор строк, итоги): итоги заполняются, когда генератор строк дочитан до конца
+    with gzip.open(local_path, 'rt', encoding='utf-8') as f: header = json.loads(f.readline())
+    header.pop('type', None)
+    summary = {}
+
+    def rows():
+        with gzip.open(local_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                kind = record.pop('type', None)
+                if kind == 'email': yield record
+                elif kind == 'summary': summary.update(record)
+
+    return header, rows(), summary
@@ -0,0 +1,266 @@
+# summary_cache.py
+# Кэш резюме Gemini с адресацией по содержимому: ключ — SHA-256 от нормализованного и обрезанного текста письма,
+# имени модели и версии промпта. Вытеснение по TTL и LRU, хранилище подключаемое: память, SQLite или объект в GCS.
+# Опционально ищет близкие дубликаты по SimHash (рассылки, отличающиеся только ссылками отписки, датой и т.п.).
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SIMHASH_BITS = 64
+SIMHASH_MIN_WORDS = 50 # Короткие письма (коды, уведомления) различаются парой слов — для них близкие дубликаты не ищем
+_WHITESPACE_RE = re.compile(r'\s+')
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize_email_text(text, max_chars):
+    # Режем так же, как перед отправкой в промпт, затем схлопываем пробельные символы
+    return _WHITESPACE_RE.sub(' ', text[:max_chars]).strip()
+
+
+def simhash(text):
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < SIMHASH_MIN_WORDS: return None
+    weights = [0] * SIMHASH_BITS
+    for i in range(len(words) - 2):
+        shingle = ' '.join(words[i:i + 3]).encode('utf-8')
+        value = int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), 'big')
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class MemoryCacheBackend:
+    # Записи: ключ -> {'summary', 'namespace', 'simhash', 'created_at'}; порядок OrderedDict — порядок последнего доступа.
+    def __init__(self):
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None: self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def find_near(self, namespace, fingerprint, max_distance):
+        for key, entry in reversed(self._entries.items()):
+            if entry['namespace'] == namespace and entry['simhash'] is not None and hamming_distance(entry['simhash'], fingerprint) <= max_distance:
+                return key, entry
+        return None
+
+    def prune(self, max_entries, expire_before):
+        for key in [k for k, e in self._entries.items() if e['created_at'] < expire_before]: del self._entries[key]
+        while len(self._entries) > max_entries: self._entries.popitem(last=False)
+
+    def flush(self):
+        pass
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteCacheBackend:
+    # Локальный файл SQLite; переживает перезапуск процесса, но не контейнера Cloud Run (если путь в /tmp).
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, namespace TEXT NOT NULL, summary TEXT NOT NULL,
+                              simhash TEXT, created_at REAL NOT NULL, accessed_at REAL NOT NULL)""")
+        self._conn.commit()
+
+    def get(self, key):
+        row = self._conn.execute("SELECT summary, namespace, simhash, created_at FROM summaries WHERE key = ?", (key,)).fetchone()
+        if row is None: return None
+        self._conn.execute("UPDATE summaries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return {'summary': row[0], 'namespace': row[1], 'simhash': int(row[2], 16) if row[2] else None, 'created_at': row[3]}
+
+    def put(self, key, entry):
+        fingerprint = format(entry['simhash'], 'x') if entry['simhash'] is not None else None
+        self._conn.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?)",
+                           (key, entry['namespace'], entry['summary'], fingerprint, entry['created_at'], time.time()))
+
+    def delete(self, key):
+        self._conn.execute("DELETE FROM summaries WHERE key = ?", (key,))
+
+    def find_near(self, namespace, fingerprint, max_distance):
+        rows = self._conn.execute("SELECT key, summary, simhash, created_at FROM summaries WHERE namespace = ? AND simhash IS NOT NULL ORDER BY accessed_at DESC", (namespace,))
+        for key, summary, row_simhash, created_at in rows:
+            if hamming_distance(int(row_simhash, 16), fingerprint) <= max_distance:
+                return key, {'summary': summary, 'namespace': namespace, 'simhash': int(row_simhash, 16), 'created_at': created_at}
+        return None
+
+    def prune(self, max_entries, expire_before):
+        self._conn.execute("DELETE FROM summaries WHERE created_at < ?", (expire_before,))
+        self._conn.execute("DELETE FROM summaries WHERE key NOT IN (SELECT key FROM summaries ORDER BY accessed_at DESC LIMIT ?)", (max_entries,))
+
+    def flush(self):
+        self._conn.commit()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+
+
+class GcsCacheBackend(MemoryCacheBackend):
+    # Кэш в памяти, который при создании читается из JSON-объекта в GCS, а при flush() записывается обратно.
+    # download_func/upload_func — download_from_gcs/upload_to_gcs из main.py. Параллельные экземпляры
+    # перезаписывают объект целиком (выигрывает последний), что для кэша допустимо.
+    def __init__(self, bucket_name, blob_name, download_func, upload_func, local_path):
+        super().__init__()
+        self._bucket_name = bucket_name
+        self._blob_name = blob_name
+        self._upload_func = upload_func
+        self._local_path = local_path
+        self._dirty = False
+        try:
+            if download_func(bucket_name, blob_name, local_path):
+                with open(local_path, 'r', encoding='utf-8') as f:
+                    for key, entry in json.load(f).get('entries', []): super().put(key, entry)
+        except Exception as e:
+            print(f"Не удалось загрузить кэш резюме из GCS ({blob_name}): {e}. Начинаем с пустого кэша.")
+
+    def put(self, key, entry):
+        super().put(key, entry)
+        self._dirty = True
+
+    def delete(self, key):
+        super().delete(key)
+        self._dirty = True
+
+    def prune(self, max_entries, expire_before):
+        size_before = len(self)
+        super().prune(max_entries, expire_before)
+        self._dirty = self._dirty or len(self) != size_before
+
+    def flush(self):
+        if not self._dirty: return
+        with open(self._local_path, 'w', encoding='utf-8') as f:
+            json.dump({'entries': list(self._entries.items())}, f, ensure_ascii=False)
+        if self._upload_func(self._bucket_name, self._local_path, self._blob_name): self._dirty = False
+
+
+class CacheStats:
+    # Счетчики поиска в кэше. У SummaryCache — общие на процесс, у каждого запуска — свои (SummaryCache.for_run):
+    # параллельные запуски делят один кэш, но не счетчики.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = self.near_hits = self.misses = 0
+
+    def record(self, result):
+        with self._lock: setattr(self, result, getattr(self, result) + 1)
+
+    def as_dict(self):
+        with self._lock: hits, near_hits, misses = self.hits, self.near_hits, self.misses
+        lookups = hits + near_hits + misses
+        return {'hits': hits, 'near_hits': near_hits, 'misses': misses, 'lookups': lookups,
+                'hit_rate': (hits + near_hits) / lookups if lookups else 0.0}
+
+
+class SummaryCache:
+    def __init__(self, backend, prompt_version, max_chars, ttl_seconds, max_entries, near_duplicate_distance=0, clock=time.time):
+        self.backend = backend
+        self.prompt_version = prompt_version
+        self.max_chars = max_chars
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.near_duplicate_distance = near_duplicate_distance
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.totals = CacheStats()
+
+    def stats(self):
+        return self.totals.as_dict()
+
+    def for_run(self):
+        return RunSummaryCache(self)
+
+    def _namespace(self, model_name):
+        return f"{model_name}:{self.prompt_version}"
+
+    def key_for(self, email_text, model_name):
+        normalized = normalize_email_text(email_text, self.max_chars)
+        return hashlib.sha256(f"{self._namespace(model_name)}\0{normalized}".encode('utf-8')).hexdigest()
+
+    def _fresh(self, entry):
+        return entry['created_at'] >= self._clock() - self.ttl_seconds
+
+    def get(self, email_text, model_name, run_stats=None):
+        result, summary = self._lookup(email_text, model_name)
+        self.totals.record(result)
+        if run_stats is not None: run_stats.record(result)
+        return summary
+
+    def _lookup(self, email_text, model_name):
+        key = self.key_for(email_text, model_name)
+        with self._lock:
+            entry = self.backend.get(key)
+            if entry is not None and self._fresh(entry): return 'hits', entry['summary']
+            if entry is not None: self.backend.delete(key)
+            if self.near_duplicate_distance:
+                fingerprint = simhash(normalize_email_text(email_text, self.max_chars))
+                near = self.backend.find_near(self._namespace(model_name), fingerprint, self.near_duplicate_distance) if fingerprint is not None else None
+                if near is not None and self._fresh(near[1]): return 'near_hits', near[1]['summary']
+            return 'misses', None
+
+    def put(self, email_text, model_name, summary):
+        normalized = normalize_email_text(email_text, self.max_chars)
+        entry = {'summary': summary, 'namespace': self._namespace(model_name), 'created_at': self._clock(),
+                 'simhash': simhash(normalized) if self.near_duplicate_distance else None}
+        with self._lock:
+            self.backend.put(self.key_for(email_text, model_name), entry)
+
+    def flush(self):
+        with self._lock:
+            self.backend.prune(self.max_entries, self._clock() - self.ttl_seconds)
+            self.backend.flush()
+
+    def __len__(self):
+        return len(self.backend)
+
+
+class RunSummaryCache:
+    # Кэш одного запуска: поиск и запись — в общем SummaryCache, а stats() — только по поискам этого запуска
+    def __init__(self, cache):
+        self.cache = cache
+        self.run_stats = CacheStats()
+
+    def get(self, email_text, model_name):
+        return self.cache.get(email_text, model_name, self.run_stats)
+
+    def put(self, email_text, model_name, summary):
+        self.cache.put(email_text, model_name, summary)
+
+    def stats(self):
+        return self.run_stats.as_dict()
+
+    def flush(self):
+        self.cache.flush()
+
+    def __len__(self):
+        return len(self.cache)
+
+
+def create_summary_cache(backend_name, prompt_version, max_chars, ttl_seconds, max_entries, near_duplicate_distance=0,
+                         sqlite_path=None, bucket_name=None, gcs_blob_name=None, download_func=None, upload_func=None):
+    backend_name = (backend_name or 'none').lower()
+    if backend_name == 'none': return None
+    if backend_name == 'memory': backend = MemoryCacheBackend()
+    elif backend_name == 'sqlite': backend = SqliteCacheBackend(sqlite_path)
+    elif backend_name == 'gcs': backend = GcsCacheBackend(bucket_name, gcs_blob_name, download_func, upload_func, os.path.join('/tmp', os.path.basename(gcs_blob_name)))
+    else: raise ValueError(f"Неизвестный тип кэша резюме: {backend_name}. Допустимо: none, memory, sqlite, gcs.")
+    return SummaryCache(backend, prompt_version, max_chars, ttl_seconds, max_entries, near_duplicate_distance)
@@ -0,0 +1,91 @@
+# test_batch_summaries.py
+# Пакетное суммирование на заглушке FakeGenerativeModel: разбор JSON-ответа, упаковка пакетов, откат по одному и порядок результатов.
+# Запуск: python -m pytest -q test_batch_summaries.py
+
+import random
+
+import pytest
+
+import main
+from local_fakes import FakeGenerativeModel
+
+KEYS = ['m1', 'm2', 'm3']
+
+
+def summarize_batch(texts, model):
+    return main.summarize_email_batch(texts, main.GCP_PROJECT_ID, main.GCP_REGION, main.GEMINI_MODEL_NAME, model=model, rate_limiter=main.RateLimiter(0, 0))
+
+
+def summarize_concurrently(texts, model, batch):
+    return main.summarize_emails_concurrently(texts, main.GCP_PROJECT_ID, main.GCP_REGION, main.GEMINI_MODEL_NAME, model=model,
+                                              rate_limiter=main.RateLimiter(0, 0), batch=batch)
+
+
+def short_texts(count, seed=1):
+    rng = random.Random(seed)
+    return [f"Письмо {i}: " + " ".join(f"слово{rng.randint(0, 999)}" for _ in range(rng.randint(5, 40))) for i in range(count)]
+
+
+@pytest.mark.parametrize('response_text, expected', [
+    ('{"m1": "a", "m2": "b", "m3": "c"}', {'m1': 'a', 'm2': 'b', 'm3': 'c'}),
+    ('{"m1": " a ", "m2": " ", "m3": 5, "m9": "x"}', {'m1': 'a'}), # пустые, нестроковые и лишние id отбрасываются
+    ('```json\n{"m2": "b"}\n```', {'m2': 'b'}),
+    ('["m1"]', {}),
+    ('не JSON', {}),
+    ('', {}),
+    (None, {}),
+])
+def test_parse_batch_summaries(response_text, expected):
+    assert main.parse_batch_summaries(response_text, KEYS) == expected
+
+
+@pytest.mark.parametrize('token_budget, max_emails', [(6000, 20), (800, 20), (6000, 3), (300, 1)])
+def test_pack_summary_batches_respects_budget_and_max_emails(token_budget, max_emails):
+    texts = short_texts(50)
+    batches = main.pack_summary_batches(texts, token_budget, max_emails)
+    assert [i for batch in batches for i in batch] == list(range(len(texts)))
+    prompt_budget = token_budget - main.estimate_tokens(main.build_batch_summary_prompt([]))
+    for batch in batches:
+        assert 1 <= len(batch) <= max_emails
+        cost = sum(main.estimate_tokens(main.normalize_email_text(texts[i], main.SUMMARY_BATCH_EMAIL_MAX_CHARS)) + main._BATCH_PROMPT_EMAIL_OVERHEAD_TOKENS for i in batch)
+        assert len(batch) == 1 or cost <= prompt_budget # письмо больше бюджета уходит отдельным пакетом
+
+
+def test_summarize_email_batch_uses_one_request():
+    texts = short_texts(5)
+    model = FakeGenerativeModel()
+    assert summarize_batch(texts, model) == [FakeGenerativeModel.summary_for(text) for text in texts]
+    assert (model.calls, model.batch_calls) == (1, 1)
+
+
+@pytest.mark.parametrize('drop_rate, malformed_rate', [(1.0, 0.0), (0.0, 1.0), (0.5, 0.0)])
+def test_summarize_email_batch_falls_back_per_email(drop_rate, malformed_rate):
+    texts = short_texts(8)
+    model = FakeGenerativeModel(batch_drop_rate=drop_rate, batch_malformed_rate=malformed_rate, seed=3)
+    assert summarize_batch(texts, model) == [FakeGenerativeModel.summary_for(text) for text in texts]
+    assert model.batch_calls == 1
+    assert 1 < model.calls <= len(texts) + 1 # отсутствующие в ответе письма запрошены по одному
+    if drop_rate == 1.0 or malformed_rate == 1.0: assert model.calls == len(texts) + 1
+
+
+def test_summarize_email_batch_falls_back_when_batch_request_fails():
+    class FailingBatchModel(FakeGenerativeModel):
+        def summarize_batch(self, prompt): raise RuntimeError("batch endpoint down")
+
+    texts = short_texts(4)
+    model = FailingBatchModel()
+    assert summarize_batch(texts, model) == [FakeGenerativeModel.summary_for(text) for text in texts]
+    assert model.calls == len(texts) + 1
+
+
+def test_summarize_emails_concurrently_batch_preserves_order():
+    texts = short_texts(30)
+    texts[4] = texts[17] # дубликат суммируется один раз
+    texts[9] = "" # пустой текст не отправляется
+    texts[12] += " " + "длинный " * (main.SUMMARY_BATCH_EMAIL_MAX_CHARS // 4) # длиннее порога — отдельным запросом
+    reference = summarize_concurrently(texts, FakeGenerativeModel(), batch=False)
+    model = FakeGenerativeModel(batch_drop_rate=0.2, seed=5)
+    assert summarize_concurrently(texts, model, batch=True) == reference
+    assert reference[9] == "Резюме не создано (нет текста)."
+    assert reference[4] == reference[17]
+    assert model.batch_calls >= 1 and model.calls < len(texts) - 2
@@ -0,0 +1,24 @@
+# test_mail_body.py
+# html_to_text: текст HTML-части письма без тегов, script/style/title и комментариев, в том числе для неполного и обрезанного HTML.
+# Запуск: python -m pytest -q test_mail_body.py
+
+import pytest
+
+from mail_body import html_to_text
+
+
+@pytest.mark.parametrize('html_text, expected', [
+    ('<html><head><title>T</title></head><body><p>Hello</p></body></html>', 'Hello'),
+    ('<html><head><title>T</title><body><p>Hello</p>', 'Hello'), # </head> в HTML5 необязателен
+    ('<html><head><meta charset="utf-8"><style>p{color:red}</style><p>Hello', 'Hello'), # ни </head>, ни <body>
+    ('<header><h1>News</h1></header><p>Body</p>', 'News\nBody'),
+    ('<p>One</p><script>var s = "<p>x</p>";</script><p>Two &amp; three</p>', 'One\nTwo & three'),
+    ('<!-- comment --><p>Text</p><style>td{}', 'Text'), # незакрытый style обрезанного HTML
+    ('<p>a  \n  b</p>', 'a b'),
+])
+def test_html_to_text(html_text, expected):
+    assert html_to_text(html_text) == expected
+
+
+def test_html_to_text_stops_at_max_chars():
+    assert html_to_text('<p>' + '</p><p>'.join(['word'] * 1000) + '</p>', 20) == 'word\nword\nword\nword'